@@ -1,22 +1,342 @@
+import time
+# cold start timings of this process, reported by /ready and /metrics
+startup = {'import_s': None, 'load_s': None, 'warm_up_s': None}
+_import_start = time.perf_counter()
 import flask
 from flask import request, jsonify
+import codecs
+import json
 import sys
 import os
-sys.path.insert(0, '../ml_ds')
+import threading
+import zlib
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml_ds'))
 import encode_score2
+import queue
+from concurrent.futures import TimeoutError as InferenceTimeout
+from micro_batcher import MicroBatcher
+from cleaning_profiler import CleaningProfiler
+from email_cleaning import set_profiler, set_regex_guard, set_terms_source
+from regex_guard import RegexBudgetExceeded, RegexGuard
+from thread_cleaner import ThreadCleaner
+startup['import_s'] = time.perf_counter() - _import_start
+
+# model and average vector are loaded once per process, not per request. Under gunicorn (see gunicorn.conf.py) this happens
+# in the master before forking, so workers share the weights, and each worker warms up after the fork instead
+scorer = encode_score2.get_scorer()
+startup['load_s'] = scorer.load_time
+# /ready answers 503 until the warm-up is done, /health answers as soon as the process is up
+warmed_up = threading.Event()
+_warm_up_lock = threading.Lock()
+_warm_up_started = False
+
+
+def warm_up():
+    """Warms the scorer up once per process and marks it ready"""
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    start = time.perf_counter()
+    # on the batcher's thread like all inference, between two batches (submitting a text instead could be answered by
+    # the embedding cache without running the model)
+    batcher.call(scorer.warm_up)
+    startup['warm_up_s'] = time.perf_counter() - start
+    warmed_up.set()
+
+
+def start_warm_up():
+    """warm_up in a background thread, so the process answers /health (and /ready with 503) meanwhile"""
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+
+# batch functions of the jobs the batcher runs, a job is (kind, cleaned email). 'intents' scores every configured intent
+# (INTENTS_PATH) on one embedding per email
+JOB_FUNS = {'score': scorer.score_cleaned_batch, 'intents': scorer.classify_cleaned_batch}
+
+
+def run_jobs(jobs):
+    """Batch function of the batcher: the jobs of every kind go through their batch function together, in one call"""
+    results = [None] * len(jobs)
+    for kind, batch_fun in JOB_FUNS.items():
+        positions = [i for i, (job_kind, cleaned) in enumerate(jobs) if job_kind == kind]
+        if positions:
+            for i, result in zip(positions, batch_fun([jobs[i][1] for i in positions])):
+                results[i] = result
+    return results
+
+
+# all inference (/, /batch, /intents and the warm-up) goes through the batcher's single thread (a bounded executor), so
+# request threads only do I/O and cleaning. Concurrent requests are encoded together: up to MICRO_BATCH_SIZE emails
+# arriving within MICRO_BATCH_WAIT_MS
+batcher = MicroBatcher(run_jobs,
+                       max_batch_size=int(os.environ.get('MICRO_BATCH_SIZE', 32)),
+                       max_wait_ms=float(os.environ.get('MICRO_BATCH_WAIT_MS', 5)),
+                       max_queue_size=int(os.environ.get('MICRO_BATCH_QUEUE_SIZE', 0)))
+
+if os.environ.get('SCORER_WARM_UP', '1') == '1':
+    warm_up()
+
+# per-step timings of the cleaning (rolling percentiles and the slowest emails, by hash) in /metrics. Opt-in, it takes a lock per email
+profiler = None
+if os.environ.get('CLEANING_PROFILE') == '1':
+    slow_ms = os.environ.get('CLEANING_SLOW_MS')
+    profiler = CleaningProfiler(window=int(os.environ.get('CLEANING_PROFILE_WINDOW', 1000)),
+                                slow_threshold_ms=float(slow_ms) if slow_ms else None)
+    set_profiler(profiler)
+# REGEX_BUDGET_MS caps the time each cleaning step may spend in regexes on one email, so one pathological email can't pin
+# a worker (a single 200-letter word takes about a minute in the email address patterns under plain re). On by default,
+# REGEX_BUDGET_MS=0 turns it off. A step over budget is skipped (REGEX_FALLBACK=skip), only run on the start of the email
+# (truncate) or the request is answered with 422 (reject)
+regex_guard = None
+if float(os.environ.get('REGEX_BUDGET_MS', 250)) > 0:
+    regex_guard = RegexGuard(budget_ms=float(os.environ.get('REGEX_BUDGET_MS', 250)),
+                             fallback=os.environ.get('REGEX_FALLBACK', 'skip'),
+                             engine=os.environ.get('REGEX_ENGINE', 'regex'))
+    set_regex_guard(regex_guard)
+# CLEANING_TERMS_PATH replaces the phrase dictionaries of the cleaning (greetings, sign-offs, fixed terms, see
+# ml_ds/cleaning_terms.json). Workers pick up an edited file, checked every CLEANING_TERMS_CHECK_INTERVAL seconds
+cleaning_terms = None
+if os.environ.get('CLEANING_TERMS_PATH'):
+    from cleaning_terms import ReloadingTerms
+    cleaning_terms = ReloadingTerms(os.environ['CLEANING_TERMS_PATH'],
+                                    check_interval=float(os.environ.get('CLEANING_TERMS_CHECK_INTERVAL', 5)))
+    set_terms_source(cleaning_terms)
+# THREAD_CLEANING=1: messages sent with a conversation id (X-Conversation-Id header or "conversation_id" in JSON) only get
+# their new part cleaned, the quoted history seen in earlier messages of the conversation is skipped. State is per worker
+# process, at most THREAD_CACHE_SIZE conversations and THREAD_CACHE_MB megabytes. Off by default: on benchmark threads
+# it isn't faster than cleaning the whole message yet (python benchmark.py threads)
+thread_cleaner = None
+if os.environ.get('THREAD_CLEANING') == '1':
+    thread_cleaner = ThreadCleaner(scorer.clean, max_threads=int(os.environ.get('THREAD_CACHE_SIZE', 10000)),
+                                   max_bytes=int(float(os.environ.get('THREAD_CACHE_MB', 64)) * 2 ** 20))
 
 app = flask.Flask(__name__)
-app.config["DEBUG"] = True
+app.config["DEBUG"] = os.environ.get('FLASK_DEBUG') == '1'
+# seconds a request waits for the model before giving up with 503
+app.config["INFERENCE_TIMEOUT"] = float(os.environ.get('INFERENCE_TIMEOUT', 30))
+# score below which an email counts as a thank-you (THANKS_THRESHOLD, see encode_score2.get_scorer)
+app.config["THANKS_THRESHOLD"] = scorer.threshold
+# maximum number of emails accepted by /batch in one request
+app.config["MAX_BATCH_SIZE"] = 256
+# maximum size of the (possibly gzipped) request body, larger requests get 413 from flask
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+# emails are cut to this many characters before cleaning. It bounds the work per email, not its time: a short email can
+# still send re into backtracking, the regex guard (REGEX_BUDGET_MS) is what caps that
+app.config["MAX_EMAIL_CHARS"] = int(os.environ.get('MAX_EMAIL_CHARS', 50000))
+# maximum size of a JSON body after decompression (protects against gzip bombs)
+app.config["MAX_JSON_LENGTH"] = int(os.environ.get('MAX_JSON_LENGTH', 64 * 1024 * 1024))
+BODY_CHUNK_SIZE = 64 * 1024
+
+
+class BadRequestBody(Exception):
+    pass
+
+
+def read_body(limit):
+    """Reads the request body in chunks, gunzipping it on the fly if it was sent with Content-Encoding: gzip.
+    Stops reading as soon as more than limit (decompressed) bytes were seen
+
+    Args:
+        limit (int): Maximum number of decompressed bytes to keep
+
+    Returns:
+        (bytes, bool): Body cut to limit bytes and whether it had to be cut
+    """
+    encoding = request.headers.get('Content-Encoding', '').lower()
+    if encoding not in ('', 'identity', 'gzip'):
+        raise BadRequestBody('Unsupported Content-Encoding: %s' % encoding)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding == 'gzip' else None
+
+    def decoded_chunks():
+        while True:
+            chunk = request.stream.read(BODY_CHUNK_SIZE)
+            if not chunk:
+                break
+            if decompressor is None:
+                yield chunk
+                continue
+            # bounded decompression, the rest of the input waits in unconsumed_tail
+            while chunk:
+                yield decompressor.decompress(chunk, BODY_CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+        if decompressor is not None:
+            yield decompressor.flush()
+
+    body = bytearray()
+    try:
+        for chunk in decoded_chunks():
+            body += chunk
+            if len(body) > limit:
+                return bytes(body[:limit]), True
+    except zlib.error:
+        raise BadRequestBody('Body is not valid gzip')
+    return bytes(body), False
+
+
+def request_charset():
+    """charset of the request's Content-Type (utf-8 if there is none), BadRequestBody if Python can't decode text with it"""
+    charset = request.mimetype_params.get('charset', 'utf-8')
+    try:
+        codecs.lookup(charset)
+        # codecs that aren't text encodings (rot13, base64, ..) are known to lookup but can't decode bytes to text
+        b' '.decode(charset, errors='ignore')
+    except LookupError:
+        raise BadRequestBody('Unknown charset: %s' % charset)
+    return charset
+
+
+def truncate_email(body_text):
+    return body_text[:app.config["MAX_EMAIL_CHARS"]]
+
+
+def read_email():
+    """Gets the email from the request body (raw text, or JSON {"email": "...", "conversation_id": "..."}, both optionally
+    gzipped). Falls back to the email-body-text header used by older clients
+
+    Returns:
+        (Str, Str): Email truncated to MAX_EMAIL_CHARS, and the conversation id (JSON field or X-Conversation-Id header, None if neither)
+    """
+    conversation_id = request.headers.get('X-Conversation-Id') or None
+    if not request.content_length and 'chunked' not in request.headers.get('Transfer-Encoding', '').lower():
+        return truncate_email(request.headers.get('email-body-text', '')), conversation_id
+    charset = request_charset()
+    if request.is_json:
+        body, cut = read_body(app.config["MAX_JSON_LENGTH"])
+        if cut:
+            raise BadRequestBody('JSON body too large')
+        try:
+            payload = json.loads(body.decode(charset))
+        except ValueError:
+            raise BadRequestBody('Body is not valid JSON')
+        body_text = payload.get('email') if isinstance(payload, dict) else payload
+        if not isinstance(body_text, str):
+            raise BadRequestBody('Expected JSON {"email": "..."}')
+        if isinstance(payload, dict) and payload.get('conversation_id') is not None:
+            conversation_id = str(payload['conversation_id'])
+        return truncate_email(body_text), conversation_id
+    # a character is at most 4 bytes in utf-8, no need to read more than that
+    body, cut = read_body(4 * app.config["MAX_EMAIL_CHARS"])
+    return truncate_email(body.decode(charset, errors='replace')), conversation_id
+
+
+def read_emails():
+    """Gets the list of emails for /batch from a JSON (optionally gzipped) body. Each email is truncated to MAX_EMAIL_CHARS"""
+    body, cut = read_body(app.config["MAX_JSON_LENGTH"])
+    if cut:
+        raise BadRequestBody('JSON body too large')
+    try:
+        payload = json.loads(body.decode(request_charset()))
+    except ValueError:
+        raise BadRequestBody('Body is not valid JSON')
+    emails = payload.get('emails') if isinstance(payload, dict) else payload
+    if not isinstance(emails, list) or not all(isinstance(e, str) for e in emails):
+        raise BadRequestBody('Expected JSON {"emails": [list of strings]}')
+    return [truncate_email(e) for e in emails]
+
+
+@app.errorhandler(queue.Full)
+@app.errorhandler(InferenceTimeout)
+def overloaded(error):
+    return jsonify({'error': 'Too many requests waiting for the model'}), 503
+
+
+@app.errorhandler(BadRequestBody)
+def bad_request_body(error):
+    return jsonify({'error': str(error)}), 400
+
+
+@app.errorhandler(RegexBudgetExceeded)
+def regex_budget_exceeded(error):
+    # a cleaning step ran out of REGEX_BUDGET_MS with REGEX_FALLBACK=reject
+    return jsonify({'error': str(error)}), 422
+
+
+def label(thanks_similarity):
+    return 1 if thanks_similarity < app.config["THANKS_THRESHOLD"] else 0
+
+
 @app.route('/', methods=['POST'])
 def home():
-    body_text=request.headers.get('email-body-text')
-    thanks_similarity=encode_score2.get_score(body_text)
-    if thanks_similarity<.4:
-        return jsonify(1)
+    """Scores one email. The email is sent as the request body: text/plain, or application/json {"email": "..."},
+    optionally with Content-Encoding: gzip. The email-body-text header is still accepted if there is no body.
+    With a conversation id (and THREAD_CLEANING=1), only the part of the email not seen in earlier messages of the
+    conversation is cleaned
+    """
+    body_text, conversation_id = read_email()
+    # cleaning happens in the request thread, only the encoding is batched
+    if conversation_id and thread_cleaner is not None:
+        # the prefilter only looks at the part of the message not seen earlier in the conversation
+        body_text, cleaned = thread_cleaner.clean_new_part(conversation_id, body_text)
+    else:
+        cleaned = scorer.clean(body_text)
+    thanks_similarity = scorer.prefilter_score(body_text, cleaned)
+    if thanks_similarity is None:
+        thanks_similarity=batcher.submit(('score', cleaned), timeout=app.config["INFERENCE_TIMEOUT"])
+    return jsonify(label(thanks_similarity))
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Scores a list of emails in one round-trip. Expects JSON (optionally gzipped), either {"emails": [...]} or a plain list of strings.
+    Returns a list of {"score": cosine distance, "label": 0/1} in the same order (emails decided by the prefilter, if it is
+    enabled, get a score of 0.0 or 1.0)
+    """
+    emails = read_emails()
+    if len(emails) > app.config["MAX_BATCH_SIZE"]:
+        return jsonify({'error': 'At most %d emails per batch' % app.config["MAX_BATCH_SIZE"]}), 413
+    cleaned_texts = [scorer.clean(email) for email in emails]
+    # emails the prefilter is sure about (if enabled) don't go to the model
+    scores = [scorer.prefilter_score(email, cleaned) for email, cleaned in zip(emails, cleaned_texts)]
+    uncertain = [('score', cleaned) for cleaned, score in zip(cleaned_texts, scores) if score is None]
+    model_scores = iter(batcher.submit_many(uncertain, timeout=app.config["INFERENCE_TIMEOUT"]) if uncertain else [])
+    scores = [next(model_scores) if score is None else score for score in scores]
+    return jsonify([{'score': score, 'label': label(score)} for score in scores])
+
+
+@app.route('/intents', methods=['POST'])
+def intents():
+    """Scores one email (sent like for /) against every configured intent, each with its own threshold.
+    Returns {intent: {"score": cosine distance, "label": 0/1}}
+    """
+    if scorer.intents is None:
+        return jsonify({'error': 'No intents configured, set INTENTS_PATH'}), 404
+    body_text, conversation_id = read_email()
+    if conversation_id and thread_cleaner is not None:
+        cleaned = thread_cleaner.clean(conversation_id, body_text)
     else:
-        return jsonify(0)
+        cleaned = scorer.clean(body_text)
+    return jsonify(batcher.submit(('intents', cleaned), timeout=app.config["INFERENCE_TIMEOUT"]))
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Liveness check, never touches the model"""
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness check: 200 once the model is loaded and warmed up, 503 before. Starts the warm-up if nothing did yet
+    (SCORER_WARM_UP=0 outside gunicorn)"""
+    if warmed_up.is_set():
+        return jsonify({'status': 'ready', 'startup': startup})
+    start_warm_up()
+    return jsonify({'status': 'warming up', 'startup': startup}), 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({'startup': startup, 'timings': scorer.timings(), 'cache': scorer.cache_stats(), 'batcher': batcher.stats(),
+                    'cleaning': profiler.stats() if profiler is not None else None,
+                    'regex_guard': regex_guard.stats() if regex_guard is not None else None,
+                    'cleaning_terms': cleaning_terms.stats() if cleaning_terms is not None else None,
+                    'threads': thread_cleaner.stats() if thread_cleaner is not None else None,
+                    'prefilter': scorer.prefilter.stats() if scorer.prefilter is not None else None,
+                    'intents': scorer.intents.stats() if scorer.intents is not None else None})
 
 
 if __name__ == "__main__":
-    app.debug = True
-    app.run()
\ No newline at end of file
+    # development server only, see gunicorn.conf.py for production
+    app.run(threaded=True)
@@ -0,0 +1,43 @@
+# Production config for the scoring API. Run from api/:
+#     gunicorn -c gunicorn.conf.py api:app
+# Everything can be overridden with environment variables (or gunicorn's own command line flags)
+import gc
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+# pre-fork: the app (and with it the model and centroid) is imported once in the master, workers get the
+# weights copy-on-write instead of every worker importing encode_score2 and loading its own copy
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# request threads only read bodies, clean and wait on the micro-batcher; inference runs on the batcher's thread,
+# so health checks and I/O are not stuck behind the model
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+# recycle workers every now and then to keep memory in check
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+# model threads per worker (torch or ONNX, see encode_score2.get_scorer), workers * SCORER_THREADS should not exceed
+# the number of cores
+os.environ.setdefault('SCORER_THREADS', '1')
+
+# don't run the model in the master: thread pools started by inference before fork() don't survive into the workers
+os.environ.setdefault('SCORER_WARM_UP', '0')
+
+
+def when_ready(server):
+    # everything allocated so far (model, centroid, modules) is left alone by the garbage collector,
+    # so workers don't copy those pages just by running a collection
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import api
+    # torch's thread count is set again in the worker, the ONNX sessions got theirs when they were created
+    if api.scorer.backend == 'torch' and api.scorer.num_threads:
+        import torch
+        torch.set_num_threads(api.scorer.num_threads)
+    # in the background, the worker serves /health (and /ready with 503) while it warms up
+    api.start_warm_up()
+    server.log.info('Worker %s warming up (model loaded in %.2f s)', worker.pid, api.scorer.load_time)
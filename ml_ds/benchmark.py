@@ -0,0 +1,452 @@
+"""Benchmarks of the cleaning pipeline, encoding and the API on synthetic threads (see thread_generator), by thread size.
+
+Every run can write its results as JSON (--output), and two such files can be compared to catch regressions between commits.
+
+Usage (from ml_ds/):
+    python benchmark.py cleaning [--per-bucket 50] [--output cleaning.json]
+    python benchmark.py patterns [--emails emails.jsonl] [--repeat 5]
+    python benchmark.py encode [--batch-size 32] [--output encode.json]
+    python benchmark.py api [--url http://localhost:8000] [--output api.json]
+    python benchmark.py whitespace [--per-bucket 50] [--fuzz 100000]   (exits with 1 if normalize_whitespace differs)
+    python benchmark.py threads [--per-bucket 20]   (exits with 1 if ThreadCleaner differs from full_clean)
+    python benchmark.py terms [--per-bucket 50] [--extra 0 100 1000]   (cost of the phrase dictionaries as they grow)
+    python benchmark.py coldstart [--runs 5] [--snapshot ../models/snapshot] [--output coldstart.json]
+    python benchmark.py compare before.json after.json [--tolerance 1.2]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import urllib.request
+from contextlib import contextmanager
+
+import email_cleaning
+from cleaning_terms import CleaningTerms
+from email_cleaning import EmailCleaning, FULL_CLEAN_STEPS
+from email_io import load_emails
+from thread_generator import generate_conversation, generate_thread
+from thread_cleaner import ThreadCleaner
+
+# number of messages per thread in each size bucket
+SIZE_BUCKETS = {
+    'single': (1, 1),
+    'short_thread': (2, 4),
+    'long_thread': (5, 15),
+    'huge_thread': (25, 40),
+}
+
+SAMPLE_EMAILS = [
+    'Hi team,\n\nThanks a lot for the quick turnaround on the deck, really appreciated!\n\nBest regards,\nAnna Lee',
+    'Dear John,\n\nPlease find attached the updated model (model_v3.xlsx) and the notes.pdf from yesterday.\n'
+    'The numbers in tab 3 still need to be checked by finance before we send it out, see https://www.example.com/q3?x=1\n\n'
+    'Kind regards\n\nPeter Brown\n+1 212 555 1234 | peter.brown@example.com\n\n'
+    'On Mon, Jan 3, 2020 at 10:15 AM John Smith <john.smith@example.com> wrote:\n> Can you send me the latest model?\n>> Thanks',
+    'thanks!',
+    'From: Maria von Trapp\nSent: Monday, January 6, 2020 9:12 AM\nTo: Team\nSubject: Re: workshop\n\n'
+    'All,\nthe workshop is moved to Thursday 10:00 in room 4B. Agenda:\n- intro\n- results\n- next steps\n\n'
+    '----- Forwarded by Anna Lee/NYC/McKinsey on 01/02/2020 10:15 AM -----\nold agenda attached',
+]
+
+
+def bucket_corpus(per_bucket, seed=0):
+    """per_bucket synthetic threads for each of SIZE_BUCKETS"""
+    rng = random.Random(seed)
+    return dict((bucket, [generate_thread(rng, messages) for _ in range(per_bucket)]) for bucket, messages in SIZE_BUCKETS.items())
+
+
+def summarize(times, **fields):
+    """One result record: fields plus mean/p50/p95/max of times (given in seconds, reported in ms)"""
+    times = sorted(times)
+    fields.update({
+        'n': len(times),
+        'mean_ms': 1000 * sum(times) / len(times),
+        'p50_ms': 1000 * times[len(times) // 2],
+        'p95_ms': 1000 * times[min(len(times) - 1, int(.95 * len(times)))],
+        'max_ms': 1000 * times[-1],
+    })
+    return fields
+
+
+def bench_cleaning(corpus):
+    """Times every step of full_clean (fed with the output of the previous step, like in full_clean) and the whole pipeline"""
+    results = []
+    for bucket, emails in corpus.items():
+        step_times = dict((step, []) for step, kwargs in FULL_CLEAN_STEPS)
+        total_times = []
+        for email in emails:
+            start = time.perf_counter()
+            for step, kwargs in FULL_CLEAN_STEPS:
+                step_start = time.perf_counter()
+                email = getattr(EmailCleaning, step)(email, **kwargs)
+                step_times[step].append(time.perf_counter() - step_start)
+            total_times.append(time.perf_counter() - start)
+        mean_chars = sum(len(e) for e in emails) / len(emails)
+        for step, times in step_times.items():
+            results.append(summarize(times, benchmark='cleaning', bucket=bucket, step=step, mean_chars=mean_chars))
+        results.append(summarize(total_times, benchmark='cleaning', bucket=bucket, step='full_clean', mean_chars=mean_chars))
+    return results
+
+
+def bench_encode(corpus, batch_size):
+    """Times model.encode of cleaned threads, one by one and in batches of batch_size (reported per email)"""
+    from encode_score2 import ThankYouScorer
+
+    scorer = ThankYouScorer().warm_up()
+    results = []
+    for bucket, emails in corpus.items():
+        cleaned = [EmailCleaning.full_clean(email) for email in emails]
+        single_times = []
+        for text in cleaned:
+            start = time.perf_counter()
+            scorer.encode(text)
+            single_times.append(time.perf_counter() - start)
+        batch_times = []
+        for start_index in range(0, len(cleaned), batch_size):
+            batch = cleaned[start_index:start_index + batch_size]
+            start = time.perf_counter()
+            scorer.encode(batch)
+            batch_times.extend([(time.perf_counter() - start) / len(batch)] * len(batch))
+        results.append(summarize(single_times, benchmark='encode', bucket=bucket, step='single'))
+        results.append(summarize(batch_times, benchmark='encode', bucket=bucket, step='batch_%d' % batch_size))
+    return results
+
+
+def bench_api(corpus, url=None):
+    """Times round-trips to POST / (text/plain body). Without url, the app is imported and called in-process"""
+    if url is None:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+        import api
+        client = api.app.test_client()
+
+        def post(email):
+            client.post('/', data=email.encode('utf-8'), content_type='text/plain; charset=utf-8')
+    else:
+        def post(email):
+            request = urllib.request.Request(url.rstrip('/') + '/', data=email.encode('utf-8'),
+                                             headers={'Content-Type': 'text/plain; charset=utf-8'})
+            with urllib.request.urlopen(request) as response:
+                response.read()
+    results = []
+    for bucket, emails in corpus.items():
+        times = []
+        for email in emails:
+            start = time.perf_counter()
+            post(email)
+            times.append(time.perf_counter() - start)
+        results.append(summarize(times, benchmark='api', bucket=bucket, step='round_trip'))
+    return results
+
+
+@contextmanager
+def string_patterns(purge=False):
+    """Temporarily runs the cleaning steps with re.sub(string pattern, ...) like before the pattern table existed"""
+    precompiled = email_cleaning._apply_substitutions
+
+    def apply_string_patterns(step, email, replacement=None):
+        if purge:
+            re.purge()
+        for pattern, repl in email_cleaning._SUBSTITUTIONS[step]:
+            email = re.sub(pattern.pattern, replacement if repl is None else repl, email, flags=pattern.flags)
+        return email
+
+    email_cleaning._apply_substitutions = apply_string_patterns
+    try:
+        yield
+    finally:
+        email_cleaning._apply_substitutions = precompiled
+
+
+def time_full_clean(emails, repeat):
+    """Best-of-repeat mean time of full_clean per email, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for email in emails:
+            EmailCleaning.full_clean(email)
+        best = min(best, (time.perf_counter() - start) / len(emails))
+    return best
+
+
+def bench_patterns(emails, repeat):
+    """Precompiled pattern table against string patterns going through re's cache (warm, and purged before every email)"""
+    precompiled = time_full_clean(emails, repeat)
+    with string_patterns():
+        warm = time_full_clean(emails, repeat)
+    with string_patterns(purge=True):
+        cold = time_full_clean(emails, repeat)
+    return [
+        {'benchmark': 'patterns', 'bucket': 'all', 'step': name, 'n': len(emails), 'mean_ms': 1000 * t, 'speedup': t / precompiled}
+        for name, t in [('precompiled', precompiled), ('string_warm_cache', warm), ('string_purged_cache', cold)]
+    ]
+
+
+def whitespace_chain(email, strict=True):
+    """The three steps EmailCleaning.normalize_whitespace replaces, one after another"""
+    email = EmailCleaning.clean_redundant_new_lines(email)
+    email = EmailCleaning.clean_single_leading_newline(email, strict)
+    return EmailCleaning.collapse_multiple_spaces(email)
+
+
+def whitespace_fuzz(count, seed=0):
+    """Short random strings of whitespace, word characters and look-alikes (tabs, uppercase, unicode digits, ..)"""
+    rng = random.Random(seed)
+    alphabet = [' ', ' ', '\n', '\n', '\n', '\t', 'a', 'Z', '1', '_', '.', 'é', '²', '٣']
+    return [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 16))) for _ in range(count)]
+
+
+def bench_whitespace(corpus, fuzz=100000, seed=0):
+    """Differential check of normalize_whitespace against whitespace_chain, on the synthetic threads (raw, and as they
+    look when they reach the step in full_clean) and on random strings, in both strict modes. Times both (best of 5 per
+    email) on the threads as they reach the step
+
+    Returns:
+        (results, mismatches): Timing records, and the inputs (with strict) on which the outputs differ
+    """
+    before_step = FULL_CLEAN_STEPS[:[step for step, _ in FULL_CLEAN_STEPS].index('normalize_whitespace')]
+    mismatches = []
+    results = []
+    for bucket, emails in corpus.items():
+        staged = []
+        for email in emails:
+            for step, kwargs in before_step:
+                email = getattr(EmailCleaning, step)(email, **kwargs)
+            staged.append(email)
+        for name, function in [('chain', whitespace_chain), ('normalize_whitespace', EmailCleaning.normalize_whitespace)]:
+            times = []
+            for email in staged:
+                # best of 5, the step takes microseconds
+                best = float('inf')
+                for _ in range(5):
+                    start = time.perf_counter()
+                    function(email)
+                    best = min(best, time.perf_counter() - start)
+                times.append(best)
+            results.append(summarize(times, benchmark='whitespace', bucket=bucket, step=name))
+        for email in emails + staged:
+            for strict in [True, False]:
+                if whitespace_chain(email, strict) != EmailCleaning.normalize_whitespace(email, strict):
+                    mismatches.append((email, strict))
+    for email in whitespace_fuzz(fuzz, seed):
+        for strict in [True, False]:
+            if whitespace_chain(email, strict) != EmailCleaning.normalize_whitespace(email, strict):
+                mismatches.append((email, strict))
+    return results, mismatches
+
+
+def bench_threads(per_bucket, seed=0):
+    """Differential check of ThreadCleaner against full_clean on synthetic conversations, message by message, and on
+    copies that bring nothing new (the message resent, and with its whitespace changed, like a CC copy). Times both
+
+    Returns:
+        (results, mismatches): Timing records, and the messages on which the outputs differ
+    """
+    rng = random.Random(seed)
+    results = []
+    mismatches = []
+    for bucket, messages in SIZE_BUCKETS.items():
+        full_times, thread_times = [], []
+        for conversation_id in range(per_bucket):
+            thread_cleaner = ThreadCleaner()
+            for message in generate_conversation(rng, messages):
+                for email in [message, message + ' ', message.replace('\n\n', '\n \n')]:
+                    start = time.perf_counter()
+                    expected = EmailCleaning.full_clean(email)
+                    full_times.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    cleaned = thread_cleaner.clean(conversation_id, email)
+                    thread_times.append(time.perf_counter() - start)
+                    if cleaned != expected:
+                        mismatches.append(email)
+        results.append(summarize(full_times, benchmark='threads', bucket=bucket, step='full_clean'))
+        results.append(summarize(thread_times, benchmark='threads', bucket=bucket, step='ThreadCleaner'))
+    return results, mismatches
+
+
+TERMS_STEPS = ['remove_repeated_replies', 'remove_greetings', 'remove_signatures', 'clean_fixed_terms']
+
+
+def random_phrases(count, rng):
+    """Made-up two-word phrases, which don't occur in the synthetic threads"""
+    word = lambda: ''.join(rng.choice('bcdfghjklmnpqrstvwxz') for _ in range(rng.randint(4, 9)))
+    return ['%s %s' % (word(), word()) for _ in range(count)]
+
+
+def bench_terms(corpus, extra=(0, 100, 1000), seed=0):
+    """Time of the steps using the phrase dictionaries (cleaning_terms.json), with extra made-up phrases added to every
+    list and as many made-up useless words. The emails are the same, so only the size of the dictionaries changes"""
+    rng = random.Random(seed)
+    default = CleaningTerms.load()
+    results = []
+    try:
+        for count in extra:
+            phrases = random_phrases(count, rng)
+            email_cleaning.set_terms(CleaningTerms(
+                list(default.useless_words) + [phrase.split()[0] for phrase in phrases], default.fixed_phrases + phrases,
+                default.fixed_literal_phrases, default.greetings + phrases, default.signature_openers + phrases, default.signature_lines + phrases,
+                default.sign_offs + phrases))
+            for bucket, emails in corpus.items():
+                times = []
+                for email in emails:
+                    start = time.perf_counter()
+                    for step in TERMS_STEPS:
+                        getattr(EmailCleaning, step)(email)
+                    times.append(time.perf_counter() - start)
+                results.append(summarize(times, benchmark='terms', bucket=bucket, step='+%d phrases' % count))
+    finally:
+        email_cleaning.set_terms(default)
+    return results
+
+
+# run in a fresh interpreter per cold start run, prints its timings (in seconds) as JSON
+_COLDSTART_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import email_cleaning
+cleaning = time.perf_counter()
+import encode_score2
+scorer_module = time.perf_counter()
+scorer = encode_score2.ThankYouScorer(snapshot_dir=sys.argv[1] or None, backend=sys.argv[2])
+load = time.perf_counter()
+scorer.score("Thank you so much for your help!")
+first_score = time.perf_counter()
+print(json.dumps({"import_cleaning": cleaning - start, "import_scorer": scorer_module - cleaning, "load": load - scorer_module,
+                  "first_score": first_score - load, "import_to_first_score": first_score - start,
+                  "heavy_modules": [m for m in %r if m in sys.modules]}))
+'''
+HEAVY_MODULES = ['pandas', 'nltk', 'multiprocess', 'torch', 'sentence_transformers', 'onnxruntime', 'regex']
+
+
+def bench_coldstart(runs, snapshot=None, backend='torch'):
+    """Import time and time to first score of a new process (as an autoscaled worker would start), over runs fresh interpreters"""
+    times = {}
+    heavy_modules = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c', _COLDSTART_SCRIPT % HEAVY_MODULES, snapshot or '', backend],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        process = time.perf_counter() - start
+        timings = json.loads(output.decode().strip().splitlines()[-1])
+        heavy_modules = timings.pop('heavy_modules')
+        timings['process_to_first_score'] = process
+        for step, seconds in timings.items():
+            times.setdefault(step, []).append(seconds)
+    print('Heavy modules imported on the way to the first score:', ', '.join(heavy_modules) or 'none')
+    bucket = 'snapshot' if snapshot else backend
+    return [summarize(step_times, benchmark='coldstart', bucket=bucket, step=step) for step, step_times in times.items()]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after, tolerance):
+    """Prints mean_ms of matching records of two result files. Returns the records slower than tolerance * before"""
+    key = lambda r: (r['benchmark'], r['bucket'], r['step'])
+    old = dict((key(r), r) for r in before['results'])
+    regressions = []
+    print('%-10s %-14s %-30s %10s %10s %7s' % ('benchmark', 'bucket', 'step', 'before_ms', 'after_ms', 'ratio'))
+    for record in after['results']:
+        if key(record) not in old:
+            continue
+        ratio = record['mean_ms'] / old[key(record)]['mean_ms'] if old[key(record)]['mean_ms'] else float('inf')
+        flag = ' <-- slower' if ratio > tolerance else ''
+        print('%-10s %-14s %-30s %10.3f %10.3f %7.2f%s' % (key(record) + (old[key(record)]['mean_ms'], record['mean_ms'], ratio, flag)))
+        if ratio > tolerance:
+            regressions.append(record)
+    return regressions
+
+
+def print_results(results):
+    for r in results:
+        print('%-10s %-14s %-30s n=%-5d mean %9.3f ms  p95 %9.3f ms' % (
+            r['benchmark'], r['bucket'], r['step'], r['n'], r['mean_ms'], r.get('p95_ms', r['mean_ms'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name in ['cleaning', 'encode', 'api', 'patterns', 'whitespace', 'terms', 'threads']:
+        sub = subparsers.add_parser(name)
+        sub.add_argument('--per-bucket', type=int, default=50, help='Synthetic threads per size bucket')
+        sub.add_argument('--seed', type=int, default=0)
+        sub.add_argument('--output', help='Write the results to this JSON file')
+        if name == 'encode':
+            sub.add_argument('--batch-size', type=int, default=32)
+        if name == 'api':
+            sub.add_argument('--url', help='Running API to call. Defaults to calling the app in-process')
+        if name == 'patterns':
+            sub.add_argument('--emails', help='JSONL file with emails. Defaults to a few built-in samples')
+            sub.add_argument('--repeat', type=int, default=5)
+        if name == 'whitespace':
+            sub.add_argument('--fuzz', type=int, default=100000, help='Random strings checked on top of the threads')
+        if name == 'terms':
+            sub.add_argument('--extra', type=int, nargs='+', default=[0, 100, 1000], help='Phrases added to every dictionary')
+    coldstart_parser = subparsers.add_parser('coldstart')
+    coldstart_parser.add_argument('--runs', type=int, default=5)
+    coldstart_parser.add_argument('--snapshot', help='Model snapshot (see model_snapshot.py) to load instead of the model name')
+    coldstart_parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch')
+    coldstart_parser.add_argument('--output', help='Write the results to this JSON file')
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--tolerance', type=float, default=1.2, help='Slowdown ratio flagged as regression')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        if compare(before, after, args.tolerance):
+            raise SystemExit(1)
+        return
+
+    if args.command == 'coldstart':
+        results = bench_coldstart(args.runs, args.snapshot, args.backend)
+    elif args.command == 'threads':
+        results, mismatches = bench_threads(args.per_bucket, args.seed)
+        for email in mismatches[:10]:
+            print('ThreadCleaner differs from full_clean on %r' % email[:200])
+        print('%d mismatches' % len(mismatches))
+        if mismatches:
+            print_results(results)
+            raise SystemExit(1)
+    elif args.command == 'patterns':
+        results = bench_patterns(load_emails(args.emails) if args.emails else SAMPLE_EMAILS * 25, args.repeat)
+    else:
+        corpus = bucket_corpus(args.per_bucket, args.seed)
+        if args.command == 'cleaning':
+            results = bench_cleaning(corpus)
+        elif args.command == 'encode':
+            results = bench_encode(corpus, args.batch_size)
+        elif args.command == 'whitespace':
+            results, mismatches = bench_whitespace(corpus, args.fuzz, args.seed)
+            for email, strict in mismatches[:10]:
+                print('normalize_whitespace differs (strict=%s) on %r' % (strict, email[:200]))
+            print('%d mismatches' % len(mismatches))
+            if mismatches:
+                print_results(results)
+                raise SystemExit(1)
+        elif args.command == 'terms':
+            results = bench_terms(corpus, args.extra, args.seed)
+        else:
+            results = bench_api(corpus, args.url)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(), 'timestamp': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+                       'command': sys.argv[1:], 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""Offline scoring of mailbox archives (mbox files, .eml files and JSONL exports) that can be stopped and resumed.
+
+Emails are read lazily, cleaned in a CleaningPool while the main process encodes the previous batches, and written in
+parts (part-00000.jsonl, ...) to the output directory. After every part, checkpoint.json records how far the input
+has been scored, so a crashed or interrupted run started again with the same command picks up after the last part
+written. Scoring uses the same configuration (environment variables) as the API, see encode_score2.get_scorer.
+
+Usage (from ml_ds/):
+    python bulk_score.py archive.mbox exports/ more.jsonl --output ../scores [--format parquet] [--part-size 10000]
+"""
+import argparse
+import email
+import html
+import json
+import mailbox
+import os
+import re
+import time
+from collections import deque
+from email import policy
+
+from email_io import email_text
+
+INPUT_EXTENSIONS = ('.mbox', '.eml', '.jsonl')
+FORMATS = ['jsonl', 'parquet']
+CHECKPOINT = 'checkpoint.json'
+
+_TAG = re.compile(r'<[^>]*>')
+
+
+def input_files(paths):
+    """Files to score, in a stable order: the given files, and the files with one of INPUT_EXTENSIONS found under the given directories"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.lower().endswith(INPUT_EXTENSIONS))
+        else:
+            files.append(path)
+    return [os.path.abspath(path) for path in files]
+
+
+def message_text(message):
+    """Body of an email.message.EmailMessage: the text/plain part, or the text/html part without its tags"""
+    body = message.get_body(preferencelist=('plain', 'html'))
+    if body is None:
+        return ''
+    try:
+        text = body.get_content()
+    except (LookupError, UnicodeError):
+        # unknown or wrong charset
+        text = (body.get_payload(decode=True) or b'').decode('utf-8', 'replace')
+    if body.get_content_type() == 'text/html':
+        text = html.unescape(_TAG.sub(' ', text))
+    return text
+
+
+def _message_id(message, default):
+    message_id = message.get('Message-ID')
+    return str(message_id).strip() if message_id else default
+
+
+def read_file(path, start=0):
+    """Yields (position, id, text) of the emails of one input file, beginning at position start (earlier emails are
+    skipped without being parsed). Positions count emails within the file
+
+    Args:
+        path (Str): .mbox, .eml or JSONL (anything else) file
+        start (int, optional): Position of the first email to yield. Defaults to 0.
+    """
+    if path.lower().endswith('.eml'):
+        if start == 0:
+            with open(path, 'rb') as f:
+                message = email.message_from_binary_file(f, policy=policy.default)
+            yield 0, _message_id(message, path), message_text(message)
+    elif path.lower().endswith('.mbox'):
+        box = mailbox.mbox(path, create=False)
+        try:
+            # the table of contents is one scan of the file, messages are only parsed from start on
+            for position, key in enumerate(box.keys()[start:], start):
+                message = email.message_from_bytes(box.get_bytes(key), policy=policy.default)
+                yield position, _message_id(message, '%s:%d' % (path, position)), message_text(message)
+        finally:
+            box.close()
+    else:
+        with open(path, encoding='utf-8') as f:
+            position = 0
+            for line in f:
+                if not line.strip():
+                    continue
+                if position >= start:
+                    record = json.loads(line)
+                    record_id = record.get('id') if isinstance(record, dict) else None
+                    yield position, str(record_id) if record_id is not None else '%s:%d' % (path, position), email_text(record)
+                position += 1
+
+
+def read_files(files, start_file=0, start_position=0):
+    """Yields (file index, position, id, text) of every email of files, from email start_position of file start_file on"""
+    for file_index in range(start_file, len(files)):
+        for position, record_id, text in read_file(files[file_index], start_position if file_index == start_file else 0):
+            yield file_index, position, record_id, text
+
+
+def load_checkpoint(output_dir, files):
+    """Checkpoint of an earlier run into output_dir, or a fresh one. Refuses to resume a run over other inputs"""
+    path = os.path.join(output_dir, CHECKPOINT)
+    if not os.path.exists(path):
+        return {'files': files, 'file': 0, 'position': 0, 'scored': 0, 'parts': 0, 'elapsed': 0.0}
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['files'] != files:
+        raise SystemExit('%s belongs to a run over other input files, use another --output or --restart' % path)
+    return checkpoint
+
+
+def save_checkpoint(output_dir, checkpoint):
+    # written next to the target and renamed, an interrupted write leaves the previous checkpoint in place
+    path = os.path.join(output_dir, CHECKPOINT)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def write_part(output_dir, part, rows, output_format='jsonl'):
+    """Writes rows (list of dict) to part-<part>.<format> in output_dir, replacing a half-written part of a crashed run"""
+    path = os.path.join(output_dir, 'part-%05d.%s' % (part, output_format))
+    tmp_path = path + '.tmp'
+    if output_format == 'parquet':
+        import pandas as pd
+        pd.DataFrame(rows, columns=['id', 'source', 'score', 'thank_you']).to_parquet(tmp_path, engine='pyarrow', index=False)
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+    return path
+
+
+def bulk_score(paths, output_dir, scorer, pool, part_size=10000, batch_size=256, output_format='jsonl', threshold=None,
+               report=print):
+    """Scores every email of paths into output_dir, resuming from its checkpoint if there is one
+
+    Args:
+        paths (list of Str): Input files and directories, see input_files
+        output_dir (Str): Created if needed
+        scorer (ThankYouScorer): Scorer used on the cleaned emails. Its cleaning runs in pool
+        pool (CleaningPool): Pool running scorer.clean_fun
+        part_size (int, optional): Emails per output part, and between two checkpoints. Defaults to 10000.
+        batch_size (int, optional): Cleaned emails per model.encode call. Defaults to 256.
+        output_format (str, optional): One of ['jsonl', 'parquet']. Defaults to 'jsonl'.
+        threshold (float, optional): Score below which an email is a thank-you. Defaults to scorer.threshold.
+        report (callable, optional): Called with a progress line after every part. Defaults to print.
+
+    Returns:
+        checkpoint (dict): Final checkpoint, with the number of emails scored and the time spent over all runs
+    """
+    assert output_format in FORMATS, "Format must be one of %s" % FORMATS
+    threshold = scorer.threshold if threshold is None else threshold
+    files = input_files(paths)
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = load_checkpoint(output_dir, files)
+    if checkpoint['scored']:
+        report('Resuming after %d emails (%s, email %d)' % (checkpoint['scored'], files[checkpoint['file']]
+                                                             if checkpoint['file'] < len(files) else 'done', checkpoint['position']))
+
+    # emails read but not scored yet, in input order: pool.imap yields the cleaned emails in the same order
+    in_flight = deque()
+
+    def raw_texts():
+        for file_index, position, record_id, text in read_files(files, checkpoint['file'], checkpoint['position']):
+            in_flight.append((file_index, position, record_id, text))
+            yield text
+
+    rows = []
+    batch = []
+    start = time.perf_counter()
+    run_scored = 0
+
+    def score_batch():
+        scores = [scorer.prefilter_score(text, cleaned) for (_, _, _, text), cleaned in batch]
+        model_scores = iter(scorer.score_cleaned_batch([cleaned for (_, cleaned), score in zip(batch, scores) if score is None]))
+        for ((file_index, _, record_id, _), _), score in zip(batch, scores):
+            score = next(model_scores) if score is None else score
+            rows.append({'id': record_id, 'source': files[file_index], 'score': score, 'thank_you': int(score < threshold)})
+        batch.clear()
+
+    def flush(last):
+        nonlocal start, run_scored
+        file_index, position = last[0], last[1]
+        write_part(output_dir, checkpoint['parts'], rows, output_format)
+        now = time.perf_counter()
+        run_scored += len(rows)
+        checkpoint.update(file=file_index, position=position + 1, scored=checkpoint['scored'] + len(rows),
+                          parts=checkpoint['parts'] + 1, elapsed=checkpoint['elapsed'] + now - start)
+        start = now
+        save_checkpoint(output_dir, checkpoint)
+        rows.clear()
+        report('Scored %d emails in %.1f s (%.1f emails/s, cleaning %.1f emails/s)' % (
+            checkpoint['scored'], checkpoint['elapsed'], checkpoint['scored'] / checkpoint['elapsed'],
+            pool.stats()['throughput']))
+
+    last = None
+    for cleaned in pool.imap(raw_texts()):
+        last = in_flight.popleft()
+        batch.append((last, cleaned))
+        if len(batch) >= batch_size or len(rows) + len(batch) >= part_size:
+            score_batch()
+        if len(rows) >= part_size:
+            flush(last)
+    if batch:
+        score_batch()
+    if rows:
+        flush(last)
+    elif last is None and checkpoint['file'] < len(files):
+        # nothing (left) to score
+        checkpoint.update(file=len(files), position=0)
+        save_checkpoint(output_dir, checkpoint)
+    return checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('inputs', nargs='+', help='.mbox, .eml or .jsonl files, or directories containing them')
+    parser.add_argument('--output', required=True, help='Directory for the parts and the checkpoint')
+    parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    parser.add_argument('--part-size', type=int, default=10000, help='Emails per part (and between checkpoints)')
+    parser.add_argument('--batch-size', type=int, default=256, help='Emails per model.encode call')
+    parser.add_argument('--processes', type=int, help='Cleaning processes. Defaults to cleaning_pool.default_num_of_processes()')
+    parser.add_argument('--threshold', type=float, help='Defaults to the scorer\'s threshold')
+    parser.add_argument('--regex-budget-ms', type=float, help='Time budget per cleaning step, see regex_guard')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of an earlier run into --output')
+    args = parser.parse_args()
+
+    if args.format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit('--format parquet needs pyarrow (pip install pyarrow)')
+    if args.restart and os.path.isdir(args.output):
+        for name in os.listdir(args.output):
+            if name == CHECKPOINT or name.startswith('part-'):
+                os.remove(os.path.join(args.output, name))
+
+    from cleaning_pool import CleaningPool
+    from encode_score2 import get_scorer
+
+    regex_guard = None
+    if args.regex_budget_ms:
+        from regex_guard import RegexGuard
+        regex_guard = RegexGuard(budget_ms=args.regex_budget_ms)
+    scorer = get_scorer()
+    with CleaningPool(scorer.clean_fun, args.processes, regex_guard=regex_guard) as pool:
+        checkpoint = bulk_score(args.inputs, args.output, scorer, pool, args.part_size, args.batch_size, args.format,
+                                args.threshold)
+    print('Done: %d emails in %d parts, %.1f s in total' % (checkpoint['scored'], checkpoint['parts'], checkpoint['elapsed']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import time
+
+import email_cleaning
+from email_cleaning import EmailCleaning, FULL_CLEAN_STEPS
+
+# methods of EmailCleaning that don't take and return one email text
+NOT_STEPS = ['full_clean', 'parallelize_cleaning', 'find_names_from_email_adresses', 'insert_breaks', 'remove_dups']
+
+
+class CleaningPipeline:
+    """A configured sequence of EmailCleaning steps, the composable version of EmailCleaning.full_clean
+
+    Steps are given by name, alone or with their keyword arguments:
+        CleaningPipeline(['remove_greetings', ('remove_names', {'methods': ['regex']}), ('anonymize_urls', {'option': 'simple'})])
+    The pipeline only holds names and arguments, so it pickles (and goes to CleaningPool / parallelize_cleaning workers
+    or a gunicorn worker) as is, and it is called like a function: pipeline(email).
+
+    Args:
+        steps (list, optional): Step names or (name, kwargs) pairs, run in this order. Defaults to the steps of full_clean.
+        min_length (int, optional): Remaining steps are skipped as soon as the text is shorter than this (an empty text
+            always stops the pipeline). The text is returned as it is at that point. Defaults to 1.
+        profiler (CleaningProfiler, optional): Records the time of every step that runs. Defaults to None (the one set
+            with email_cleaning.set_profiler, if any).
+    """
+
+    def __init__(self, steps=None, min_length=1, profiler=None):
+        self.steps = [self._parse_step(step) for step in (FULL_CLEAN_STEPS if steps is None else steps)]
+        self.min_length = max(min_length, 1)
+        self.profiler = profiler
+
+    @staticmethod
+    def _parse_step(step):
+        name, kwargs = (step, {}) if isinstance(step, str) else step
+        if name.startswith('_') or name in NOT_STEPS or not callable(getattr(EmailCleaning, name, None)):
+            raise ValueError('Unknown cleaning step: %s' % name)
+        return name, dict(kwargs)
+
+    @classmethod
+    def full_clean(cls, min_length=1, profiler=None):
+        """Same steps as EmailCleaning.full_clean"""
+        return cls(FULL_CLEAN_STEPS, min_length, profiler)
+
+    def without(self, *names):
+        """Copy of the pipeline without the given steps"""
+        return CleaningPipeline([step for step in self.steps if step[0] not in names], self.min_length, self.profiler)
+
+    def __call__(self, email):
+        email_cleaning._refresh_terms()
+        profiler = self.profiler or email_cleaning._profiler
+        step_times = [] if profiler is not None else None
+        start = time.perf_counter()
+        original = email
+        for name, kwargs in self.steps:
+            if len(email) < self.min_length:
+                break
+            if step_times is None:
+                email = getattr(EmailCleaning, name)(email, **kwargs)
+                continue
+            step_start = time.perf_counter()
+            output = getattr(EmailCleaning, name)(email, **kwargs)
+            step_times.append((name, time.perf_counter() - step_start, len(email), len(output)))
+            email = output
+        if profiler is not None:
+            profiler.record(original, step_times, time.perf_counter() - start)
+        return email
+
+    def __getstate__(self):
+        # a profiler holds a lock and belongs to one process, workers use their own (if any)
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        return state
+
+    def __eq__(self, other):
+        return isinstance(other, CleaningPipeline) and (self.steps, self.min_length) == (other.steps, other.min_length)
+
+    def __repr__(self):
+        return 'CleaningPipeline(%r, min_length=%d)' % (self.steps, self.min_length)
@@ -0,0 +1,125 @@
+import itertools
+import math
+import time
+from collections import deque
+from multiprocess import Pool, cpu_count
+from email_cleaning import EmailCleaning, set_regex_guard
+
+# set once per worker process by the pool initializer, so the cleaning function is not shipped with every chunk
+_worker_cleaning_fun = None
+
+
+def _init_worker(cleaning_fun, regex_guard=None):
+    global _worker_cleaning_fun
+    _worker_cleaning_fun = cleaning_fun
+    if regex_guard is not None:
+        set_regex_guard(regex_guard)
+
+
+def _clean_chunk(chunk, cleaning_fun=None):
+    if cleaning_fun is None:
+        cleaning_fun = _worker_cleaning_fun
+    return [cleaning_fun(email) for email in chunk]
+
+
+def default_num_of_processes():
+    """Roughly the number of physical cores minus one, but at least 1"""
+    return max(1, math.ceil((cpu_count() / 2) - 1))
+
+
+class CleaningPool:
+    """Persistent pool of cleaning workers. Start it once and reuse it for as many calls as you like,
+    e.g. for nightly re-cleaning of archived emails:
+
+        with CleaningPool(chunksize=256, progress_every=100000) as pool:
+            for cleaned in pool.imap(read_emails_lazily()):
+                ...
+
+    imap works like Pool.imap with a chunksize, but only keeps max_pending_chunks chunks in flight, so it never reads
+    (or holds the results of) more than max_pending_chunks * chunksize emails at a time, no matter how long the input is.
+
+    Args:
+        cleaning_fun (callable, optional): Needs to be embarassingly parallel. Defaults to EmailCleaning.full_clean.
+        num_of_processes (int, optional): Defaults to default_num_of_processes(). It should match number of physical cores
+        chunksize (int, optional): Number of emails sent to a worker at once. Defaults to 64.
+        max_pending_chunks (int, optional): Chunks in flight at once. Defaults to 2 * num_of_processes.
+        progress_every (int, optional): Report progress every this many emails. Defaults to None (no reporting).
+        progress_callback (callable, optional): Called with self.stats() on each progress report. Defaults to printing it.
+        regex_guard (RegexGuard, optional): Time budget for the cleaning regexes in the workers, see regex_guard. Defaults to None.
+    """
+
+    def __init__(self, cleaning_fun=EmailCleaning.full_clean, num_of_processes=None, chunksize=64,
+                 max_pending_chunks=None, progress_every=None, progress_callback=None, regex_guard=None):
+        self.cleaning_fun = cleaning_fun
+        self.num_of_processes = num_of_processes or default_num_of_processes()
+        self.chunksize = chunksize
+        self.max_pending_chunks = max_pending_chunks or 2 * self.num_of_processes
+        self.progress_every = progress_every
+        self.progress_callback = progress_callback or (lambda stats: print(
+            'Cleaned %(processed)d emails in %(elapsed).1f s (%(throughput).1f emails/s)' % stats))
+        self.pool = Pool(self.num_of_processes, initializer=_init_worker, initargs=(cleaning_fun, regex_guard))
+        self.processed = 0
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Waits for the workers to finish and shuts them down"""
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def stats(self):
+        """Emails cleaned and time spent over all imap calls so far"""
+        return {
+            'processed': self.processed,
+            'elapsed': self.elapsed,
+            'throughput': self.processed / self.elapsed if self.elapsed else 0.0,
+        }
+
+    def imap(self, emails, cleaning_fun=None, chunksize=None):
+        """Cleans emails (any iterable, typically a generator) in the workers and yields the cleaned emails in input order
+
+        Args:
+            emails (iterable of Str): Emails to be cleaned up. Read lazily, chunk by chunk
+            cleaning_fun (callable, optional): Overrides the pool's cleaning function for this call. Defaults to None.
+            chunksize (int, optional): Overrides the pool's chunksize for this call. Defaults to None.
+
+        Yields:
+            email (Str): Cleaned up email
+        """
+        emails = iter(emails)
+        chunksize = chunksize or self.chunksize
+        pending = deque()
+        next_report = self.processed + self.progress_every if self.progress_every else None
+        start = time.perf_counter()
+        try:
+            while True:
+                while len(pending) < self.max_pending_chunks:
+                    chunk = list(itertools.islice(emails, chunksize))
+                    if not chunk:
+                        break
+                    pending.append(self.pool.apply_async(_clean_chunk, (chunk, cleaning_fun)))
+                if not pending:
+                    break
+                cleaned_chunk = pending.popleft().get()
+                self.processed += len(cleaned_chunk)
+                self.elapsed += time.perf_counter() - start
+                start = time.perf_counter()
+                if next_report is not None and self.processed >= next_report:
+                    self.progress_callback(self.stats())
+                    next_report = self.processed + self.progress_every
+                yield from cleaned_chunk
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def map(self, emails, cleaning_fun=None, chunksize=None):
+        """Same as imap, but returns a (flat) list"""
+        return list(self.imap(emails, cleaning_fun, chunksize))
@@ -0,0 +1,117 @@
+import hashlib
+import heapq
+import threading
+import time
+from collections import deque
+
+
+class CleaningProfiler:
+    """Opt-in instrumentation of EmailCleaning.full_clean: wall time and input/output length of every step
+
+    Keeps the last `window` timings of every step (and of the whole pipeline) for rolling percentiles, and the
+    `slow_log_size` slowest emails seen, identified by a hash of their text so they can be found again in the data
+    without keeping (or logging) the emails themselves.
+    Enable it for every full_clean call with email_cleaning.set_profiler(profiler), or pass it to a single call.
+
+    Args:
+        window (int, optional): Number of recent calls the percentiles are computed over. Defaults to 1000.
+        slow_log_size (int, optional): Number of slowest emails to remember. Defaults to 20.
+        slow_threshold_ms (float, optional): Emails slower than this are also reported to slow_callback. Defaults to None (never).
+        slow_callback (function, optional): Called with the slow-log entry. Defaults to printing it.
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, window=1000, slow_log_size=20, slow_threshold_ms=None, slow_callback=None):
+        self.window = window
+        self.slow_log_size = slow_log_size
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slow_callback = slow_callback or (lambda entry: print(
+            'Slow email %s: %.1f ms, %d chars, slowest step %s (%.1f ms)' % (
+                entry['hash'], entry['total_ms'], entry['chars'], entry['slowest_step'], entry['steps'][entry['slowest_step']])))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._times = {}
+            self._chars_in = {}
+            self._chars_out = {}
+            self._calls = 0
+            self._slowest = []
+
+    @staticmethod
+    def sample_hash(email):
+        """Short, stable identifier of an email's text"""
+        return hashlib.sha1(email.encode('utf-8', 'surrogatepass')).hexdigest()[:16]
+
+    def run(self, steps, email, step_function):
+        """Runs the (step, kwargs) pairs of steps through step_function(step, email, kwargs), timing each one"""
+        original = email
+        step_times = []
+        start = time.perf_counter()
+        for step, kwargs in steps:
+            step_start = time.perf_counter()
+            output = step_function(step, email, kwargs)
+            step_times.append((step, time.perf_counter() - step_start, len(email), len(output)))
+            email = output
+        self.record(original, step_times, time.perf_counter() - start)
+        return email
+
+    def record(self, email, step_times, total_time):
+        """Adds one full_clean call: step_times is a list of (step, seconds, input length, output length)"""
+        output_length = step_times[-1][3] if step_times else len(email)
+        with self._lock:
+            self._calls += 1
+            for step, seconds, chars_in, chars_out in step_times + [('full_clean', total_time, len(email), output_length)]:
+                if step not in self._times:
+                    self._times[step] = deque(maxlen=self.window)
+                    self._chars_in[step] = 0
+                    self._chars_out[step] = 0
+                self._times[step].append(seconds)
+                self._chars_in[step] += chars_in
+                self._chars_out[step] += chars_out
+            slow = len(self._slowest) < self.slow_log_size or total_time > self._slowest[0][0]
+        total_ms = 1000 * total_time
+        over_threshold = self.slow_threshold_ms is not None and total_ms > self.slow_threshold_ms
+        if not (slow or over_threshold):
+            return
+        steps = dict((step, 1000 * seconds) for step, seconds, _, _ in step_times)
+        entry = {
+            'hash': self.sample_hash(email),
+            'chars': len(email),
+            'total_ms': total_ms,
+            'slowest_step': max(steps, key=steps.get) if steps else None,
+            'steps': steps,
+            'time': time.time(),
+        }
+        if slow and self.slow_log_size:
+            with self._lock:
+                # (total_time, calls) keeps ties ordered without comparing the dicts
+                item = (total_time, self._calls, entry)
+                if len(self._slowest) < self.slow_log_size:
+                    heapq.heappush(self._slowest, item)
+                else:
+                    heapq.heappushpop(self._slowest, item)
+        if over_threshold:
+            self.slow_callback(entry)
+
+    @staticmethod
+    def _percentile(sorted_times, percentile):
+        return sorted_times[min(len(sorted_times) - 1, int(len(sorted_times) * percentile / 100))]
+
+    def stats(self):
+        """Rolling percentiles (ms) per step and for the whole pipeline, mean lengths in and out, and the slowest emails"""
+        with self._lock:
+            steps = {}
+            for step, times in self._times.items():
+                recent = sorted(times)
+                step_stats = {'samples': len(recent), 'mean_ms': 1000 * sum(recent) / len(recent)}
+                for percentile in self.PERCENTILES:
+                    step_stats['p%d_ms' % percentile] = 1000 * self._percentile(recent, percentile)
+                step_stats['max_ms'] = 1000 * recent[-1]
+                step_stats['mean_chars_in'] = self._chars_in[step] / self._calls
+                step_stats['mean_chars_out'] = self._chars_out[step] / self._calls
+                steps[step] = step_stats
+            slowest = [entry for _, _, entry in sorted(self._slowest, key=lambda item: item[:2], reverse=True)]
+        return {'calls': self._calls, 'window': self.window, 'steps': steps, 'slowest': slowest}
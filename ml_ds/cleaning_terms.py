@@ -0,0 +1,168 @@
+"""Phrase dictionaries of the cleaning (greetings, sign-offs, fixed terms, ..), kept in a JSON file instead of in the
+regexes, so terms can be added or removed without touching the code.
+
+Every list is compiled into a single pattern shaped like a prefix tree (phrase_pattern), so at any position of an
+email the regex engine follows at most one branch per character. Matching cost depends on the length of the
+phrases, not on how many there are. Except for fixed_phrases in an email that contains one of them: those are then
+deleted one pass per phrase, in order, like the substitutions they replace (deleting one can join the pieces of another).
+
+cleaning_terms.json:
+    useless_words       words dropped by clean_fixed_terms (exact, case-sensitive match on space-separated words)
+                        months do not include may because it matches with the verb
+    fixed_phrases       phrases deleted anywhere by clean_fixed_terms, one after another in this order, a space
+                        matches any run of whitespace
+    fixed_literal_phrases   those of fixed_phrases whose spaces only match a single space
+    greetings           openers of the short greetings deleted by remove_greetings
+    signature_openers   line openers of a sign-off followed by a name, deleted by remove_signatures
+    signature_lines     line openers of the rest of a sign-off line, deleted by remove_signatures
+    sign_offs           sign-offs remove_repeated_replies cuts the email at
+Phrases other than fixed_phrases match case-insensitively with literal spaces.
+
+Use another file with email_cleaning.set_terms(CleaningTerms.load(path)), or have it picked up whenever it changes
+with email_cleaning.set_terms_source(ReloadingTerms(path)).
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+DEFAULT_TERMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cleaning_terms.json')
+PHRASE_LISTS = ['fixed_phrases', 'fixed_literal_phrases', 'greetings', 'signature_openers', 'signature_lines', 'sign_offs']
+
+
+def phrase_pattern(phrases, space=' ', literal_phrases=()):
+    """Case-insensitive regex (a string) matching any of phrases, factored into a prefix tree.
+
+    Which phrase wins when several match at the same position is the same as for '|'.join(phrases): only phrases
+    that start with the same characters can match at the same position, and their relative order is kept.
+
+    Args:
+        phrases (list of Str): Literal phrases, in order of priority
+        space (str, optional): Regex a space in a phrase stands for. Defaults to ' ' (a literal space).
+        literal_phrases (list of Str, optional): Those of phrases whose spaces stay literal spaces. Defaults to ().
+    """
+    literal_phrases = set(literal_phrases)
+    phrases = [(phrase, ' ' if phrase in literal_phrases else space) for phrase in phrases]
+    if not phrases:
+        # matches nothing
+        return '(?!)'
+    branches = _branches([[phrase_space if c == ' ' else re.escape(c.lower()) for c in phrase] for phrase, phrase_space in phrases])
+    if not all(phrase and phrase[0] != ' ' for phrase, _ in phrases):
+        return '(?i:%s)' % '|'.join(first + rest for first, rest in branches)
+    # re tries an alternation at every position of the text. Led by a character class of the first characters (in
+    # both cases, re can't scan for a case-insensitive class) it only tries where a phrase can start
+    starts = sorted(set(c for phrase, _ in phrases for c in phrase[0].lower() + phrase[0].upper()))
+    return '[%s](?i:%s)' % (''.join(map(re.escape, starts)), '|'.join('(?<=%s)%s' % branch for branch in branches))
+
+
+def _branches(token_lists):
+    """(first token, regex of the rest) of the alternatives matching the rest of the phrases at one node of the tree"""
+    # token_lists are in order of priority. An empty one (a phrase ending here) can match together with any other, so
+    # nothing moves across it. Between two of them, phrases are grouped by first token, which can't change the
+    # outcome: different first tokens never match at the same position
+    branches = []
+    block = []
+
+    def flush():
+        groups = {}
+        for tokens in block:
+            groups.setdefault(tokens[0], []).append(tokens[1:])
+        for first, rests in groups.items():
+            alternatives = ['%s%s' % branch for branch in _branches(rests)]
+            branches.append((first, alternatives[0] if len(alternatives) == 1 else '(?:%s)' % '|'.join(alternatives)))
+        block.clear()
+
+    for tokens in token_lists:
+        if tokens:
+            block.append(tokens)
+        else:
+            flush()
+            branches.append(('', ''))
+    flush()
+    return branches
+
+
+class CleaningTerms:
+    """Contents of a cleaning_terms.json
+
+    Args:
+        useless_words (iterable of Str)
+        fixed_phrases, fixed_literal_phrases, greetings, signature_openers, signature_lines, sign_offs (list of Str):
+            see the module docstring
+    """
+
+    def __init__(self, useless_words, fixed_phrases, fixed_literal_phrases, greetings, signature_openers, signature_lines,
+                 sign_offs):
+        self.useless_words = frozenset(useless_words)
+        self.fixed_phrases = list(fixed_phrases)
+        self.fixed_literal_phrases = list(fixed_literal_phrases)
+        self.greetings = list(greetings)
+        self.signature_openers = list(signature_openers)
+        self.signature_lines = list(signature_lines)
+        self.sign_offs = list(sign_offs)
+        # changes whenever any term does, see email_cleaning.cleaning_version
+        self.version = hashlib.sha1(json.dumps([sorted(self.useless_words)] + [getattr(self, key) for key in PHRASE_LISTS])
+                                    .encode('utf-8')).hexdigest()[:12]
+
+    @classmethod
+    def load(cls, path=DEFAULT_TERMS_PATH):
+        with open(path, encoding='utf-8') as f:
+            terms = json.load(f)
+        missing = [key for key in ['useless_words'] + PHRASE_LISTS if not isinstance(terms.get(key), list)]
+        if missing:
+            raise ValueError('%s has no list for %s' % (path, ', '.join(missing)))
+        unknown = [phrase for phrase in terms['fixed_literal_phrases'] if phrase not in terms['fixed_phrases']]
+        if unknown:
+            raise ValueError('%s: fixed_literal_phrases not in fixed_phrases: %s' % (path, ', '.join(unknown)))
+        return cls(terms['useless_words'], *[terms[key] for key in PHRASE_LISTS])
+
+    def stats(self):
+        return dict([('version', self.version), ('useless_words', len(self.useless_words))] +
+                    [(key, len(getattr(self, key))) for key in PHRASE_LISTS])
+
+
+class ReloadingTerms:
+    """CleaningTerms read from a file and read again when the file changes, at most every check_interval seconds
+    (the same way intents.ReloadingIntents does). A file that fails to load is reported in stats() and the previous
+    terms stay in use
+
+    Args:
+        path (Str): JSON file, see the module docstring
+        check_interval (float, optional): Seconds between checks of the file's modification time. Defaults to 5.
+    """
+
+    def __init__(self, path, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime_ns
+        self._terms = CleaningTerms.load(path)
+        self._last_check = time.monotonic()
+        self.reloads = 0
+        self.last_error = None
+
+    def current(self):
+        """The terms to use now (reloaded first if the file changed)"""
+        if time.monotonic() - self._last_check >= self.check_interval:
+            with self._lock:
+                if time.monotonic() - self._last_check >= self.check_interval:
+                    self._reload_if_changed()
+        return self._terms
+
+    def _reload_if_changed(self):
+        self._last_check = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            self._terms = CleaningTerms.load(self.path)
+            self._mtime = mtime
+            self.reloads += 1
+            self.last_error = None
+        except Exception as error:
+            self.last_error = '%s: %s' % (type(error).__name__, error)
+
+    def stats(self):
+        return dict(self._terms.stats(), path=self.path, reloads=self.reloads, last_error=self.last_error)
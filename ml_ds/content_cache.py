@@ -0,0 +1,147 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_MISSING = object()
+
+
+def _to_row(value):
+    # text as TEXT, arrays as their raw bytes with dtype and shape: nothing read back from the shared file is unpickled
+    if isinstance(value, str):
+        return value, None, None, None
+    if isinstance(value, np.ndarray):
+        return None, value.tobytes(), value.dtype.str, ','.join(map(str, value.shape))
+    raise TypeError('The on-disk cache stores str or np.ndarray values, not %s' % type(value).__name__)
+
+
+def _from_row(text, data, dtype, shape):
+    if text is not None:
+        return text
+    shape = tuple(int(size) for size in shape.split(',')) if shape else ()
+    return np.frombuffer(data, dtype=np.dtype(dtype)).reshape(shape).copy()
+
+
+class ContentCache:
+    """Bounded in-memory LRU cache with a time-to-live, meant to be keyed by a hash of the content (see ContentCache.key).
+    Optionally backed by a sqlite file, so that entries survive restarts and are shared by workers on the same machine.
+    Values stored on disk must be str or np.ndarray (cleaned emails and embeddings).
+
+    Args:
+        max_entries (int, optional): Entries kept in memory, least recently used ones are evicted first. Defaults to 10000.
+        ttl (float, optional): Seconds after which an entry is considered stale. None means no expiry. Defaults to 24 hours.
+        disk_path (Str, optional): sqlite file for the on-disk tier. Defaults to None (memory only).
+        disk_max_entries (int, optional): Entries kept on disk, oldest ones are deleted first. Defaults to 10 * max_entries.
+    """
+
+    def __init__(self, max_entries=10000, ttl=24 * 3600, disk_path=None, disk_max_entries=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.disk_max_entries = disk_max_entries or 10 * max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+        self._disk_puts = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(text, namespace=''):
+        """Hash of text. namespace stands for whatever else the value depends on (model, cleaning version, ..), entries
+        stored under another namespace are never returned"""
+        return hashlib.sha1((namespace + '\0' + text).encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _disk(self):
+        # sqlite connections can't be shared with forked workers, each process opens its own
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.disk_path, timeout=5, check_same_thread=False)
+            with self._connection:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, text TEXT, data BLOB, '
+                                         'dtype TEXT, shape TEXT, created REAL)')
+                self._connection.execute('CREATE INDEX IF NOT EXISTS entries_created ON entries (created)')
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def _put_memory(self, key, value, created):
+        self._entries[key] = (value, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        """Value stored under key, or default if it's not there (or expired)"""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, created = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+            if self.disk_path is not None:
+                row = self._disk().execute('SELECT text, data, dtype, shape, created FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is not None and not self._expired(row[4]):
+                    value = _from_row(*row[:4])
+                    self._put_memory(key, value, row[4])
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        row = _to_row(value) if self.disk_path is not None else None
+        with self._lock:
+            created = time.time()
+            self._put_memory(key, value, created)
+            if self.disk_path is not None:
+                connection = self._disk()
+                with connection:
+                    connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)', (key,) + row + (created,))
+                self._disk_puts += 1
+                # trimming is not free, do it every now and then instead of on every put
+                if self._disk_puts % 1000 == 0:
+                    self._trim_disk(connection)
+
+    def _trim_disk(self, connection):
+        with connection:
+            if self.ttl is not None:
+                connection.execute('DELETE FROM entries WHERE created < ?', (time.time() - self.ttl,))
+            connection.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                               (self.disk_max_entries,))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.disk_path is not None:
+                with self._disk() as connection:
+                    connection.execute('DELETE FROM entries')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else None,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
@@ -2,99 +2,387 @@
 ## From mck packages
 ## -- developed by Miroslav Fil
 
-import csv
 import re
-import string
 import numpy as np
-import pandas as pd
-import datetime
 import unidecode
-import nltk
 import os
+import sys
 import itertools
 import math
-from multiprocess import Pool, cpu_count
-from nltk import ngrams
-from nltk.corpus import stopwords
-from nltk.corpus import wordnet
-from nltk.tokenize import word_tokenize
-from urllib.parse import urlparse
+from paragraph_index import ParagraphIndex
+from cleaning_terms import CleaningTerms, phrase_pattern
+# pandas and multiprocess are only needed by parallelize_cleaning and imported there: importing this module is on the
+# API's cold start, and those two (with nltk, which the cleaning doesn't use) took seconds to import
+
+
+# Every regex used by the cleaning steps is compiled once, here, instead of being rebuilt (and looked up in re's cache) on every call.
+# _SUBSTITUTIONS maps a step to its ordered list of [compiled pattern, replacement], applied one after another by _apply_substitutions
+_IGNORECASE_MULTILINE = re.IGNORECASE | re.MULTILINE
+
+
+def _compile(substitutions, flags=_IGNORECASE_MULTILINE):
+    return [[re.compile(pattern, flags), replacement] for pattern, replacement in substitutions]
+
+
+_SUBSTITUTIONS = {
+    'fix_whitespace_formatting': _compile([
+        # Merges multiple normal spaces into one, "fox  is dog" -> "fox is dog"
+        [' {2,}', ' '],
+        # remove line dividers including spaces
+        [r'^[^\nA-Za-z0-9]*[^\nA-Za-z0-9]$', ''],
+        # remove tab and '>'
+        [r'^(\t|\>?)+', ''],
+        # remove leading spaces
+        [r'^[^\n]\s+[^\S]', '\n'],
+        # clear extra lines, \n\n\n\t\t\n\n\n\n -> \n\n
+        [r'(\s*[\n]\s*){3,30}', '\n\n'],
+        [r'\n{1}>[>\s]+', '\n'],
+    ]),
+    'remove_email_metadata': _compile([
+        # recipients
+        [r'To: [0-9a-zA-Z-_:@\.;<>\s\w]+Subject:\s*', ' '],
+        # remove Forwarded by
+        [r'----- Forwarded (by)?.+(\n.*)?\s(-----|\d\d\:\d\d\s((P|A)M)?)', ' '],
+        # #various useless metadata
+        [r'^(user|owner|Timezone|FMNO|name|ip|date|time|path|agent|Code|Domain|address|room|Location|Team|Responder|Contact|Office|Telefono|Tel|fax|Mobile|Call Number|cell|callback|direct|voip|Attn|Colleague|phone|Department|Telephone|RSA|Organization|Country|Group|Email|Assistant|EA|Region|Database|view|Tracking|Server|path|Hours|Reference\s?\#|Created|Tracking|t|e|m|f)\s*?:.*?$',
+         ' '],
+        # various useless metadata - partial text
+        [r'^[a-z0-9]+\s(name|ip|date|time|path|agent|Code|Domain)[a-z0-9]*\s*?:.*?$', ' '],
+        # out of the office
+        [r'AUTO:.+out of(\sthe)? office.*(\n.+)*', ''],
+        # tables |xxxxx|
+        [r'^.*?\|.*?$', ' '],
+        # telephone numbers, ..
+        [r'[-_+;:.,\s]+[0-9]+[0-9-_+;:.,\s]*(?:$|\n)', '\n'],
+    ]),
+    # same step, but case sensitive - applied after the ones above
+    'remove_email_metadata_cased': _compile([
+        # remove email and other metadata
+        # this also deletes stuff like "on both"
+        [r'On [0-9a-zA-Z.\s]+ at [0-9]+\:[0-9]{2} [a-zA-Z0-9@_\.\s<]+>\s+wrote:', ' '],
+        [r'Am [0-9a-zA-Z.-/\s]+ um [0-9]+\:[0-9]{2} schrieb\s+[a-zA-Z0-9@_\.\s<]+>:', ' '],
+        [r'(\s|^|\|)(Received from|TO|From|Date|Sent by|sent|CC|BCC|Cc|Bcc|cc|bcc|Copy To|Sender|Deliver to|Recipient Name|Period|sent email|Forwarded At)[\s\S]*?:.*',
+         ' '],
+    ], re.MULTILINE),
+    # remove_signatures, remove_greetings, clean_fixed_terms and remove_repeated_replies are built from the phrase
+    # dictionaries of cleaning_terms.json, see _terms_substitutions
+    'anonymize_email_adresses': _compile([
+        # remove lotus notes email address
+        [r'([a-z\-]+\s?\n?){1,3}(\/[a-z0-9\-?]+){2,5}(\@|\/)mckinsey(\-external|@M[a-z]*)?', None],
+        # remove email address, john.snow@yahoo.com -> ANONYMIZED EMAIL
+        [r'[_a-z0-9-]+(\.[_a-z0-9-]+)*@[a-z0-9-]+(\.[a-z0-9-]+)*(\.[a-z]{2,4})', None],
+    ]),
+    'clean_redundant_new_lines': _compile([
+        # removes >2 newlines at start of line
+        [r'^\n{2,}', r''],
+        # reduces >2 newlines to just two
+        [r'\n{2,}', r'\n\n'],
+        # removes >2 newlines at end of line
+        [r'\n{2,}$', r''],
+    ], 0),
+    # Won't match capital chars (\nJames) - useful to deal with lists of items, but fails on names..
+    'clean_single_leading_newline_strict': _compile([
+        [r'(?<!\n)\n(?=[a-z0-9])', ' '],
+    ], re.MULTILINE),
+    'clean_single_leading_newline': _compile([
+        [r'(?<!\n)\n(?=\w)', ' '],
+    ], re.MULTILINE),
+    'collapse_multiple_spaces': _compile([
+        # "what   is this   shit" -> "what is this shit", wont work on whitespaces like /t etc.
+        [' {2,}', ' '],
+    ]),
+}
+
+# Single patterns used outside of plain substitutions (splitting, searching, ..)
+_PATTERNS = {
+    'names': re.compile(r'[A-Z]([a-z]+|\.)(?:\s+[A-Z]([a-z]+|\.))*(?:\s+[a-z][a-z\-]+){0,2}\s+[A-Z]([a-z]+|\.)'),
+    # The complex alternative is from https://gist.github.com/gruber/8891611 with Python-specific modifications. I also added the lookbehind in the beginning becaues it was matching mails, not sure if I broke it by accident while porting to Python
+    'urls_complex': re.compile(r'(?i)(?<!@)\b((?:https?:(?:\/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\\)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:\'\".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b\?(?!@)))'),
+    # The simple alternative is https://stackoverflow.com/questions/6038061/regular-expression-to-find-urls-within-a-string
+    'urls_simple': re.compile(r'(http|ftp|https)?(://)?([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?'),
+    'files': re.compile(
+        r"([\w\d\-.]+\.pdf|[\w\d\-.]+\.docx|[\w\d\-.]+\.doc|[\w\d\-.]+\.pptx|[\w\d\-.]+\.ppt|[\w\d\-.]+\.txt|[\w\d\-.]+\.zip|[\w\d\-.]+\.xlsx|[\w\d\-.]+\.xls)"),
+    'senders': re.compile(r'\nFrom:([A-Za-z-\s]*)\n'),
+    'email_adresses': re.compile(r"[a-z0-9\.\-+_,&:]+@[a-z0-9\.\-+_]+\.[a-z]+"),
+    'internal_url': re.compile('mckinsey.com'),
+    'paragraph_break': re.compile(r'\n{2,}'),
+    # whitespace runs normalize_whitespace has to look at: 2+ spaces/newlines, or a lone newline (a lone space stays as it is).
+    # Linear (no backtracking), so it doesn't go through the regex guard
+    'whitespace_run': re.compile(r'[ \n]{2,}|\n'),
+    'whitespace_piece': re.compile(r' +|\n+'),
+    'paragraph_break_bounded': re.compile("\n{2,10}"),
+}
+
+
+def _terms_substitutions(terms):
+    """Substitutions of the steps whose phrases come from a cleaning_terms.CleaningTerms. Each list of phrases is a
+    single prefix-tree alternation (see cleaning_terms.phrase_pattern) that matches like the original '|'.join, except
+    the fixed phrases, which were deleted one after another (see clean_fixed_terms)"""
+    return {
+        'remove_signatures': _compile([
+            # 'McKinsey & Co.' ('.' is any character) and 'Thanks (?!to)' aren't plain phrases, they stay here
+            [r'^(?:%s|McKinsey & Co.|Thanks (?!to)).*?(\n){1,3}\s?(([A-Z][a-z]{3,20}\s?){1,3})' % phrase_pattern(terms.signature_openers),
+             ' '],
+            [r'^(?:%s).*?[!\w\s$]*' % phrase_pattern(terms.signature_lines), ' '],
+            [r'^\s*(Re:|Fw:|Subject:).*?(\n){1,3}', '\n'],
+            # remove signatures by phone number and '|'
+            [r'(\n.+){0,5}\+\0{0,2}\s?\d{1,3}\s?\-?\(?\d{1,3}\)?(\s?\-?\d{1,4}){1,5}\s?\|(.+\n){0,5}', '\n'],
+            # remove autogenerated email
+            [r'Voice message from.*?\d\d\:\d\d\s((P|A)M)?\n(.*\n)+?.+contact the Global.*$', ' '],
+            # remove ghd and CC signatures
+            [r'Global Helpdesk\n.+313(\n.+){2,3}', ''],
+            [r'^(Customer Care|IT Customer Experience)\n(.[^\n]+\n){1,4}', ' '],
+        ]),
+        'remove_greetings': _compile([
+            # deletes short greetings that are <20 chars
+            [r'^(?:%s)(\s|,|\.|\n|\!)(([a-z]{3,20}\s?\/?){0,3})(\.|-|,|;|\s)?(\\n)?\n\n' % phrase_pattern(terms.greetings),
+             ''],
+        ]),
+        # any of the fixed phrases, only searched for: emails with none of them skip clean_fixed_phrases
+        'fixed_phrases_any': _compile([[phrase_pattern(terms.fixed_phrases, r'\s+', terms.fixed_literal_phrases), ' ']]),
+        # one pass per fixed phrase, in order (a space matches any whitespace, but in fixed_literal_phrases)
+        'clean_fixed_phrases': _compile([[phrase_pattern([phrase], r'\s+', terms.fixed_literal_phrases), ' ']
+                                         for phrase in terms.fixed_phrases]),
+        'clean_fixed_terms': _compile([
+            [r'This email is confidential and may be privileged(.+\n)+.+\suse it for any purpose.', ' '],
+            [r'Removed.*?can be found in Emails', ' '], [r'[a-z]+\scall was linked to the incident', ' '],
+            [r'Knowledge article KO.*\:\n.*$', ' '],
+        ]),
+        'remove_repeated_replies': _compile([
+            # anchors used in signatures/replies, everything from the anchor onwards gets deleted
+            [r'On.*?wrote:[\s\S]*', ''],
+            [r'am.*?schrieb:[\s\S]*', ''],
+            [r'Le.*?écrit:[\s\S]*', ''],
+            # Data:, Datum:, Sent:, From:, De: merged into one pass. They are plain literals cut to the end of the email,
+            # none of them can start inside another one, so cutting at the first of any of them == cutting at each in turn
+            [r'(?:Data|Datum|Sent|From|De):[\s\S]*', ''],
+            [r'Sent from (my\s)?((blackberry)|(iphone)|(samsung)|(macbook)|(apple)|(pc))[\s\S]*', ''],
+            [r'Von meinem ((blackberry)|(iphone)|(samsung)|(macbook)|(apple)|(pc))[\s\S]*', ''],
+            [r'Subject:[\s\S]*', ''],
+            # 08/20/2019 08:50 -> ''
+            [r'\d{2}/\d{2}/\d{4}\s\d{2}[\s\S]*', ''],
+            # the bars like | are only used in signatures
+            [r'\│.*', ''],
+            # sign-offs, 'McKinsey & Co.' isn't a plain phrase ('.' is any character)
+            [r'(?:%s|McKinsey & Co.)[\s\S]*' % phrase_pattern(terms.sign_offs), ' '],
+        ]),
+    }
+
+
+# cleaning_terms.CleaningTerms in use and its word set, see set_terms
+_terms = None
+_useless_words = frozenset()
+# where full_clean gets its terms from, see set_terms_source
+_terms_source = None
+
+
+def set_terms(terms):
+    """Uses the phrase dictionaries of a cleaning_terms.CleaningTerms in this process. The patterns are compiled first
+    and every step's list is swapped whole, so an email being cleaned meanwhile sees either the old or the new ones"""
+    global _terms, _useless_words
+    substitutions = _terms_substitutions(terms)
+    _SUBSTITUTIONS.update(substitutions)
+    _useless_words = terms.useless_words
+    _terms = terms
+
+
+def set_terms_source(source):
+    """Takes the terms from source.current() (e.g. a cleaning_terms.ReloadingTerms, so an edited file is picked up) at
+    the start of every full_clean, or keeps the ones in use (None)"""
+    global _terms_source
+    _terms_source = source
+    _refresh_terms()
+
+
+def _refresh_terms():
+    if _terms_source is not None:
+        terms = _terms_source.current()
+        if terms is not _terms:
+            set_terms(terms)
+
+
+set_terms(CleaningTerms.load())
+
+# bump it whenever a change to the cleaning steps changes their output: it is part of the key of cached cleanings
+CLEANING_VERSION = 2
+
+
+def cleaning_version():
+    """What the output of the cleaning depends on besides the email: CLEANING_VERSION and the terms in use (reloaded first)"""
+    _refresh_terms()
+    return '%d-%s' % (CLEANING_VERSION, _terms.version)
+
+
+# Steps of EmailCleaning.full_clean, in order, with their arguments
+FULL_CLEAN_STEPS = [
+    ('remove_names', {'methods': ['regex']}),
+    ('remove_repeated_replies', {}),
+    ('remove_greetings', {}),
+    ('fix_whitespace_formatting', {}),
+    ('remove_email_metadata', {}),
+    ('remove_signatures', {}),
+    ('clean_fixed_terms', {}),
+    ('anonymize_urls', {}),
+    ('anonymize_files', {}),
+    ('anonymize_email_adresses', {}),
+    # clean_redundant_new_lines, clean_single_leading_newline and collapse_multiple_spaces, in one pass
+    ('normalize_whitespace', {}),
+    # this one depends on previous cleaning of paragraphs (/n/n), might delete more than you would like
+    ('remove_repeating_parags', {}),
+]
+
+
+# CleaningProfiler used by every full_clean call, see set_profiler
+_profiler = None
+
+
+def set_profiler(profiler):
+    """Turns per-step instrumentation of full_clean on (with a cleaning_profiler.CleaningProfiler) or off (None) for this process"""
+    global _profiler
+    _profiler = profiler
+
+
+# regex_guard.RegexGuard the cleaning regexes run through, see set_regex_guard
+_regex_guard = None
+
+
+def set_regex_guard(guard):
+    """Runs the cleaning regexes with a time budget per step (with a regex_guard.RegexGuard) or unguarded (None) in this process"""
+    global _regex_guard
+    _regex_guard = guard
+
+
+def _run_step(step, email, kwargs):
+    return getattr(EmailCleaning, step)(email, **kwargs)
+
+
+def _apply_substitutions(step, email, replacement=None):
+    """Runs the precompiled substitutions of one step over the email. replacement overrides entries that have None"""
+    if _regex_guard is not None:
+        return _regex_guard.apply(step, email, replacement)
+    for pattern, repl in _SUBSTITUTIONS[step]:
+        email = pattern.sub(replacement if repl is None else repl, email)
+    return email
+
+
+def _follows_word(string, position, strict):
+    """Whether string[position] exists and is what clean_single_leading_newline's lookahead accepts"""
+    if position >= len(string):
+        return False
+    if strict:
+        return string[position] in _LOWERCASE_OR_DIGIT
+    return string[position].isalnum() or string[position] == '_'
+
+
+def _normalize_whitespace_run(match, strict=True):
+    run = match.group()
+    string = match.string
+    # the two common cases first: a lone newline, a run of spaces
+    if run == '\n':
+        return ' ' if _follows_word(string, match.end(), strict) else '\n'
+    if '\n' not in run:
+        return ' '
+    position = match.start()
+    pieces = []
+    for piece in _PATTERNS['whitespace_piece'].findall(run):
+        end = position + len(piece)
+        if piece[0] == ' ':
+            piece = ' '
+        elif len(piece) > 1:
+            # clean_redundant_new_lines: dropped at the start and the end of the email, two newlines anywhere else
+            piece = '' if position == 0 or end == len(string) else '\n\n'
+        elif _follows_word(string, end, strict):
+            # clean_single_leading_newline: a lone newline in front of a word
+            piece = ' '
+        position = end
+        # collapse_multiple_spaces
+        if piece and not (piece == ' ' and pieces and pieces[-1] == ' '):
+            pieces.append(piece)
+    return ''.join(pieces)
+
+
+_LOWERCASE_OR_DIGIT = frozenset('abcdefghijklmnopqrstuvwxyz0123456789')
+
+# str.translate table deleting what remove_short_lines doesn't count: every character with isdigit() (not only 0-9) and spaces
+_DIGITS_AND_SPACE = None
+
+
+def _digits_and_space_table():
+    global _DIGITS_AND_SPACE
+    if _DIGITS_AND_SPACE is None:
+        table = dict.fromkeys((c for c in range(sys.maxunicode + 1) if chr(c).isdigit()), None)
+        table[ord(' ')] = None
+        _DIGITS_AND_SPACE = table
+    return _DIGITS_AND_SPACE
+
+
+def _sub(name, replacement, email):
+    """_PATTERNS[name].sub(replacement, email), through the regex guard if there is one"""
+    if _regex_guard is not None:
+        return _regex_guard.sub(name, replacement, email)
+    return _PATTERNS[name].sub(replacement, email)
 
 
 class EmailCleaning:
     @staticmethod
-    def full_clean(email):
+    def full_clean(email, profiler=None):
         """Used in EIG. For other use-cases, it might be better to compose individual parts. This is end-to-end cleaning pipeline
 
         Args:
             email (Str): Text to be cleaned. It is expected to be full of escapes such as \n, \t,..
+            profiler (CleaningProfiler, optional): Records the time of every step. Defaults to None (the one set with set_profiler, if any).
 
         Returns:
             email (Str): Cleaned up email
         """
-        email = EmailCleaning.remove_names(email, methods=['regex'])
-        email = EmailCleaning.remove_repeated_replies(email)
-        email = EmailCleaning.remove_greetings(email)
-        email = EmailCleaning.fix_whitespace_formatting(email)
-        email = EmailCleaning.remove_email_metadata(email)
-        email = EmailCleaning.remove_signatures(email)
-        email = EmailCleaning.clean_fixed_terms(email)
-        email = EmailCleaning.anonymize_urls(email)
-        email = EmailCleaning.anonymize_files(email)
-        email = EmailCleaning.anonymize_email_adresses(email)
-        email = EmailCleaning.clean_redundant_new_lines(email)
-        email = EmailCleaning.clean_single_leading_newline(email)
-        email = EmailCleaning.collapse_multiple_spaces(email)
-        # this one depends on previous cleaning of paragraphs (/n/n), might delete more than you would like
-        email = EmailCleaning.remove_repeating_parags(email)
+        _refresh_terms()
+        profiler = profiler or _profiler
+        if profiler is not None:
+            return profiler.run(FULL_CLEAN_STEPS, email, _run_step)
+        for step, kwargs in FULL_CLEAN_STEPS:
+            email = _run_step(step, email, kwargs)
         return email
 
     @staticmethod
     def parallelize_cleaning(ordered_iterable, cleaning_fun=full_clean,
-                             num_of_processes=math.ceil((cpu_count() / 2) - 1), wrapper='pd.apply'):
+                             num_of_processes=None, wrapper='pd.apply', pool=None):
         """A wrapper to parallelize pandas.apply. Meant for data parallelism
+        For repeated calls or inputs that don't fit in memory, use cleaning_pool.CleaningPool directly
 
         Args:
             ordered_iterable (Ordered iterable): Typically a DataFrame. Should support splitting into n parts
-            cleaning_fun ([type], optional): [description]. Defaults to full_clean. Needs to be embarassingly parallel
-            num_of_processes ([type], optional): [description]. Defaults to math.ceil((cpu_count()/2)-1). It should match number of physical cores
+            cleaning_fun ([type], optional): [description]. Defaults to full_clean. Needs to be embarassingly parallel (a cleaning_pipeline.CleaningPipeline works too)
+            num_of_processes ([type], optional): [description]. Defaults to None (math.ceil((cpu_count()/2)-1)). It should match number of physical cores
             wrapper (str, optional): [description]. Defaults to 'pd.apply'. Whether to use it in pd.apply or as standalone (for example, when not operating on DataFrames)
+            pool (CleaningPool, optional): Persistent pool to run on instead of starting (and tearing down) a new one. Defaults to None.
 
         Returns:
-            transformed_iterable: The cleaned up ordered_iterable returned in the same shape
+            transformed_iterable: The cleaned up ordered_iterable returned in the same shape (a flat list for wrapper='none')
         """
 
+        import pandas as pd
+        from multiprocess import Pool
+
         def pandas_wrapper(fun):
             return lambda x: x.apply(fun)
 
-        ordered_iterable_split = np.array_split(ordered_iterable, num_of_processes)
-        pool = Pool(num_of_processes)
+        if num_of_processes is None:
+            num_of_processes = math.ceil((os.cpu_count() / 2) - 1)
+        processes = pool.pool if pool is not None else Pool(num_of_processes)
+        ordered_iterable_split = np.array_split(ordered_iterable, pool.num_of_processes if pool is not None else num_of_processes)
         if wrapper == 'pd.apply':
             cleaning_fun = pandas_wrapper(cleaning_fun)
-            transformed_data = pd.concat(pool.map(cleaning_fun, ordered_iterable_split))
+            transformed_data = pd.concat(processes.map(cleaning_fun, ordered_iterable_split))
         if wrapper == 'none':
-            transformed_data = itertools.chain(pool.map(cleaning_fun, ordered_iterable_split))
-        pool.close()
-        pool.join()
+            transformed_data = list(itertools.chain.from_iterable(processes.map(cleaning_fun, ordered_iterable_split)))
+        if pool is None:
+            processes.close()
+            processes.join()
         return transformed_data
 
     @staticmethod
     def fix_whitespace_formatting(email):
-        regex = []
-        # Merges multiple normal spaces into one, "fox  is dog" -> "fox is dog"
-        regex.append([' {2,}', ' '])
-        # remove line dividers including spaces
-        regex.append([r'^[^\nA-Za-z0-9]*[^\nA-Za-z0-9]$', ''])
-        # remove tab and '>'
-        regex.append([r'^(\t|\>?)+', ''])
-        # remove leading spaces
-        regex.append([r'^[^\n]\s+[^\S]', '\n'])
-        # clear extra lines, \n\n\n\t\t\n\n\n\n -> \n\n
-        regex.append([r'(\s*[\n]\s*){3,30}', '\n\n'])
-        regex.append([r'\n{1}>[>\s]+', '\n'])
-        for rg in regex:
-            email = re.sub(rg[0], rg[1], email, flags=re.IGNORECASE | re.MULTILINE)
-        return email
+        return _apply_substitutions('fix_whitespace_formatting', email)
 
     @staticmethod
     def remove_email_metadata(email):
@@ -107,35 +395,8 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up email
         """
-        # recipients
-        regex = []
-        regex_cased = []
-        regex.append([r'To: [0-9a-zA-Z-_:@\.;<>\s\w]+Subject:\s*', ' '])
-        # remove email and other metadata
-        # this also deletes stuff like "on both"
-        regex_cased.append([r'On [0-9a-zA-Z.\s]+ at [0-9]+\:[0-9]{2} [a-zA-Z0-9@_\.\s<]+>\s+wrote:', ' '])
-        regex_cased.append([r'Am [0-9a-zA-Z.-/\s]+ um [0-9]+\:[0-9]{2} schrieb\s+[a-zA-Z0-9@_\.\s<]+>:', ' '])
-        regex_cased.append([
-                               r'(\s|^|\|)(Received from|TO|From|Date|Sent by|sent|CC|BCC|Cc|Bcc|cc|bcc|Copy To|Sender|Deliver to|Recipient Name|Period|sent email|Forwarded At)[\s\S]*?:.*',
-                               ' '])
-        # remove Forwarded by
-        regex.append([r'----- Forwarded (by)?.+(\n.*)?\s(-----|\d\d\:\d\d\s((P|A)M)?)', ' '])
-        # #various useless metadata
-        regex.append([
-                         r'^(user|owner|Timezone|FMNO|name|ip|date|time|path|agent|Code|Domain|address|room|Location|Team|Responder|Contact|Office|Telefono|Tel|fax|Mobile|Call Number|cell|callback|direct|voip|Attn|Colleague|phone|Department|Telephone|RSA|Organization|Country|Group|Email|Assistant|EA|Region|Database|view|Tracking|Server|path|Hours|Reference\s?\#|Created|Tracking|t|e|m|f)\s*?:.*?$',
-                         ' '])
-        # various useless metadata - partial text
-        regex.append([r'^[a-z0-9]+\s(name|ip|date|time|path|agent|Code|Domain)[a-z0-9]*\s*?:.*?$', ' '])
-        # out of the office
-        regex.append([r'AUTO:.+out of(\sthe)? office.*(\n.+)*', ''])
-        # tables |xxxxx|
-        regex.append([r'^.*?\|.*?$', ' '])
-        # telephone numbers, ..
-        regex.append([r'[-_+;:.,\s]+[0-9]+[0-9-_+;:.,\s]*(?:$|\n)', '\n'])
-        for rg in regex:
-            email = re.sub(rg[0], rg[1], email, flags=re.IGNORECASE | re.MULTILINE)
-        for rg in regex_cased:
-            email = re.sub(rg[0], rg[1], email, flags=re.MULTILINE)
+        email = _apply_substitutions('remove_email_metadata', email)
+        email = _apply_substitutions('remove_email_metadata_cased', email)
         return email
 
     @staticmethod
@@ -148,24 +409,7 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up email
         """
-        regex = []
-        regex.append([
-                         r'^(McKinsey & Company|McKinsey & Co.|Cheers|Sincerely|Best (regards)?|Many thanks|kind regards|Regards|Warm regards|tnx|thx|Thank you|Thanks (?!to)|Assistant|Assistant:|Executive Assistant:).*?(\n){1,3}\s?(([A-Z][a-z]{3,20}\s?){1,3})',
-                         ' '])
-        regex.append([
-                         r'^(McKinsey & Company|Cheers|Sincerely|Best (regards)?|Many thanks|kind regards|Regards|Warm regards|thanks|tnx|thx|Thank you|Thanks (?!to)Assistant|Assistant:|Executive Assistant:).*?[!\w\s$]*',
-                         ' '])
-        regex.append([r'^\s*(Re:|Fw:|Subject:).*?(\n){1,3}', '\n'])
-        # remove signatures by phone number and '|'
-        regex.append([r'(\n.+){0,5}\+\0{0,2}\s?\d{1,3}\s?\-?\(?\d{1,3}\)?(\s?\-?\d{1,4}){1,5}\s?\|(.+\n){0,5}', '\n'])
-        # remove autogenerated email
-        regex.append([r'Voice message from.*?\d\d\:\d\d\s((P|A)M)?\n(.*\n)+?.+contact the Global.*$', ' '])
-        # remove ghd and CC signatures
-        regex.append([r'Global Helpdesk\n.+313(\n.+){2,3}', ''])
-        regex.append([r'^(Customer Care|IT Customer Experience)\n(.[^\n]+\n){1,4}', ' '])
-        for rg in regex:
-            email = re.sub(rg[0], rg[1], email, flags=re.IGNORECASE | re.MULTILINE)
-        return email
+        return _apply_substitutions('remove_signatures', email)
 
     @staticmethod
     def remove_greetings(email):
@@ -177,15 +421,7 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up email
         """
-        # deletes short greetings that are <20 chars
-        regex = []
-        # remove greetings
-        regex.append([
-                         r'^(Folks|All|Hej|hey|hi|hello|good|dear|friends|team|Good day|Greetings)(\s|,|\.|\n|\!)(([a-z]{3,20}\s?\/?){0,3})(\.|-|,|;|\s)?(\\n)?\n\n',
-                         ''])
-        for rg in regex:
-            email = re.sub(rg[0], rg[1], email, flags=re.IGNORECASE | re.MULTILINE)
-        return email
+        return _apply_substitutions('remove_greetings', email)
 
     @staticmethod
     def clean_fixed_terms(email):
@@ -197,26 +433,16 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up email
         """
-        useless_ngrams = ["mckinsey\s+company", "best\s+regards", "kind\s+regards", "thank\s+you",
-                          "sent from my iphone", "Von meinem iPhone gesendet", "pacific\s+time",
-                          'This email is confidential and may be privileged(.+\n)+.+\suse it for any purpose.',
-                          'Removed.*?can be found in Emails', '[a-z]+\scall was linked to the incident',
-                          'Knowledge article KO.*\:\n.*$']
-        # months do not include may because it matches with the verb
-        useless_words = ["folks", "hi", "hello", "dear", "sincerely",
-                         "friends", "please", "tnx", "thanks", "fw", "re", "fwd", "january", "jan", "february", "feb",
-                         "march", "mar", "april",
-                         "apr", "june", "jun", "july", "jul", "august", "aug", "september", "sep", "october", "oct",
-                         "november", "nov", "december", "dec",
-                         "sunday", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "pm", "am",
-                         "est", "today", "tomorrow", "yesterday"]
-        for useless_ngram in useless_ngrams:
-            email = re.sub(useless_ngram, ' ', email, flags=re.IGNORECASE | re.MULTILINE)
+        # useless ngrams, and then useless words (cleaning_terms.json). The phrases are deleted one after another: deleting
+        # one can join the pieces of a later one ("best mckinsey company regards"). Most emails contain none of them,
+        # which one pass of their alternation finds out, and then none of the passes would change anything
+        if _SUBSTITUTIONS['fixed_phrases_any'][0][0].search(email) is not None:
+            email = _apply_substitutions('clean_fixed_phrases', email)
+        email = _apply_substitutions('clean_fixed_terms', email)
         # could also use regex to remove direct words but would be harder for no benefit
         # email.split without any argument would also strip newlines in \ncompendium
-        admissible_words = [w for w in email.split(" ") if not w in useless_words]
-        email = ' '.join(admissible_words)
-        return email
+        useless_words = _useless_words
+        return ' '.join([w for w in email.split(" ") if w not in useless_words])
 
     @staticmethod
     def remove_short_lines(email, threshold=35, threshold_with_punctuation=20):
@@ -233,25 +459,22 @@ class EmailCleaning:
 
         # need to be careful about applying this because emails have line delimiters
         # by nature (be it as normal text or from lists of items..) and even single words in sentences might then get deleted..
-        def longer_than(line, lnt):
-            value = len(
-                ''.join([i for i in line if not i.isdigit() and i != ' ']).replace('ANONYMIZED_NAME', '').replace(
-                    'ANONYMIZED_LINK', '').replace('ANONYMIZED_FILE', '')) > lnt
+        # the line without digits and spaces, computed once per line (instead of character by character in both checks)
+        def longer_than(bare_line, lnt):
+            value = len(bare_line.replace('ANONYMIZED_NAME', '').replace('ANONYMIZED_LINK', '').replace('ANONYMIZED_FILE', '')) > lnt
             return value
 
-        def ends_with_punctuation(line):
-            value = ''.join([i for i in line if not i.isdigit() and i != ' ']).replace('ANONYMIZED_NAME', '').replace(
-                'ANONYMIZED_LINK', '').replace('d', '')[-1] in ".,;:!?-"
+        def ends_with_punctuation(bare_line):
+            value = bare_line.replace('ANONYMIZED_NAME', '').replace('ANONYMIZED_LINK', '').replace('d', '')[-1] in ".,;:!?-"
             return value
 
-        new_email = ""
-        paragraphs = re.split(r'\n{2,}', email)
-        for p in paragraphs:
-            lines = p.split('\n')
-            new_paragraph = '\n'.join([line for line in lines if longer_than(line, threshold) or (
-                        longer_than(line, threshold_with_punctuation) and ends_with_punctuation(line))])
-            new_email = new_email + "\n\n" + new_paragraph
-        return new_email
+        def keep(line):
+            bare_line = line.translate(_digits_and_space_table())
+            return longer_than(bare_line, threshold) or (
+                longer_than(bare_line, threshold_with_punctuation) and ends_with_punctuation(bare_line))
+
+        paragraphs = _PATTERNS['paragraph_break'].split(email)
+        return ''.join("\n\n" + '\n'.join([line for line in p.split('\n') if keep(line)]) for p in paragraphs)
 
     @staticmethod
     def clean_redundant_new_lines(email):
@@ -263,13 +486,7 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up mail
         """
-        # removes >2 newlines at start of line
-        email = re.sub(r'^\n{2,}', r'', email)
-        # reduces >2 newlines to just two
-        email = re.sub(r'\n{2,}', r'\n\n', email)
-        # removes >2 newlines at end of line
-        email = re.sub(r'\n{2,}$', r'', email)
-        return email
+        return _apply_substitutions('clean_redundant_new_lines', email)
 
     @staticmethod
     def clean_multiple_leading_whitespaces(email):
@@ -283,9 +500,23 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up email
         """
-        email = [w for w in email.split()]
-        email = ' '.join(email)
-        return email
+        return ' '.join(email.split())
+
+    @staticmethod
+    def normalize_whitespace(email, strict=True):
+        """clean_redundant_new_lines, clean_single_leading_newline and collapse_multiple_spaces (in this order) in a single
+        pass over the email, with the same output. Only whitespace runs with a newline or several spaces are looked at
+
+        Args:
+            email (Str): Email to be cleaned up
+            strict (bool, optional): Passed on as clean_single_leading_newline's strict. Defaults to True.
+
+        Returns:
+            email (Str): Cleaned up email
+        """
+        if strict:
+            return _PATTERNS['whitespace_run'].sub(_normalize_whitespace_run, email)
+        return _PATTERNS['whitespace_run'].sub(lambda match: _normalize_whitespace_run(match, strict=False), email)
 
     @staticmethod
     def clean_single_leading_newline(email, strict=True):
@@ -301,15 +532,9 @@ class EmailCleaning:
             email (Str): Cleaned up email
         """
         # Think about whether you even want this, this is probably not good if in your text, people use \n to format the text, especially in lists of items.
-        regex = []
         if strict == True:
-            # Won't match capital chars (\nJames) - useful to deal with lists of items, but fails on names..
-            regex.append([r'(?<!\n)\n(?=[a-z0-9])', ' '])
-        else:
-            regex.append([r'(?<!\n)\n(?=\w)', ' '])
-        for rg in regex:
-            email = re.sub(rg[0], rg[1], email, flags=re.MULTILINE)
-        return email
+            return _apply_substitutions('clean_single_leading_newline_strict', email)
+        return _apply_substitutions('clean_single_leading_newline', email)
 
     @staticmethod
     def collapse_multiple_spaces(email):
@@ -322,12 +547,7 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up email
         """
-        regex = []
-        # "what   is this   shit" -> "what is this shit", wont work on whitespaces like /t etc.
-        regex.append([' {2,}', ' '])
-        for rg in regex:
-            email = re.sub(rg[0], rg[1], email, flags=re.IGNORECASE | re.MULTILINE)
-        return email
+        return _apply_substitutions('collapse_multiple_spaces', email)
 
     @staticmethod
     def remove_names(email, methods, replacement='ANONYMIZED_NAME'):
@@ -346,8 +566,7 @@ class EmailCleaning:
         for method in methods:
             assert method in allowed_methods, "Disallowed method! Must pass in list containing at least one of ['regex', 'email_adresses', 'database' (TODO)]"
         if 'regex' in methods:
-            email = re.sub(r'[A-Z]([a-z]+|\.)(?:\s+[A-Z]([a-z]+|\.))*(?:\s+[a-z][a-z\-]+){0,2}\s+[A-Z]([a-z]+|\.)',
-                           replacement, email)
+            email = _sub('names', replacement, email)
         if 'email_adresses' in methods:
             # needs to be called before removing names based on email adresses, otherwise this wont find anything!
             users = EmailCleaning.find_names_from_email_adresses(email)
@@ -373,29 +592,7 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up email
         """
-        # this function finds some anchor used in signatures/replies and deletes everything from there onwards
-        regex = []
-        regex.append([r'On.*?wrote:[\s\S]*', ''])
-        regex.append([r'am.*?schrieb:[\s\S]*', ''])
-        regex.append([r'Le.*?écrit:[\s\S]*', ''])
-        regex.append([r'Data:[\s\S]*', ''])
-        regex.append([r'Datum:[\s\S]*', ''])
-        regex.append([r'Sent:[\s\S]*', ''])
-        regex.append([r'From:[\s\S]*', ''])
-        regex.append([r'De:[\s\S]*', ''])
-        regex.append([r'Sent from (my\s)?((blackberry)|(iphone)|(samsung)|(macbook)|(apple)|(pc))[\s\S]*', ''])
-        regex.append([r'Von meinem ((blackberry)|(iphone)|(samsung)|(macbook)|(apple)|(pc))[\s\S]*', ''])
-        regex.append([r'Subject:[\s\S]*', ''])
-        # 08/20/2019 08:50 -> ''
-        regex.append([r'\d{2}/\d{2}/\d{4}\s\d{2}[\s\S]*', ''])
-        # the bars like | are only used in signatures
-        regex.append([r'\│.*', ''])
-        regex.append([
-                         r'(McKinsey & Company|McKinsey & Co.|Cheers|Sincerely|Many thanks|Best Regards|kind regards|Regards|Warm regards|Assistant|Assistant:|Executive Assistant:)[\s\S]*',
-                         ' '])
-        for rg in regex:
-            email = re.sub(rg[0], rg[1], email, flags=re.IGNORECASE | re.MULTILINE)
-        return email
+        return _apply_substitutions('remove_repeated_replies', email)
 
     @staticmethod
     def anonymize_urls(email, replacement='ANONYMIZED_URL', option='complex', disambiguate=[]):
@@ -410,28 +607,23 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up email
         """
-        # The complex alternative is from https://gist.github.com/gruber/8891611 with Python-specific modifications. I also added the lookbehind in the beginning becaues it was matching mails, not sure if I broke it by accident while porting to Python
-        # The simple alternative is https://stackoverflow.com/questions/6038061/regular-expression-to-find-urls-within-a-string
-        alternative_regex = r'(?i)(?<!@)\b((?:https?:(?:\/{1,3}|[a-z0-9%])|[a-z0-9.\-]+[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\\)(?:[^\s()<>{}\[\]]+|\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\))+(?:\([^\s()]*?\([^\s()]+\)[^\s()]*?\)|\([^\s]+?\)|[^\s`!()\[\]{};:\'\".,<>?«»“”‘’])|(?:(?<!@)[a-z0-9]+(?:[.\-][a-z0-9]+)*[.](?:com|net|org|edu|gov|mil|aero|asia|biz|cat|coop|info|int|jobs|mobi|museum|name|post|pro|tel|travel|xxx|ac|ad|ae|af|ag|ai|al|am|an|ao|aq|ar|as|at|au|aw|ax|az|ba|bb|bd|be|bf|bg|bh|bi|bj|bm|bn|bo|br|bs|bt|bv|bw|by|bz|ca|cc|cd|cf|cg|ch|ci|ck|cl|cm|cn|co|cr|cs|cu|cv|cx|cy|cz|dd|de|dj|dk|dm|do|dz|ec|ee|eg|eh|er|es|et|eu|fi|fj|fk|fm|fo|fr|ga|gb|gd|ge|gf|gg|gh|gi|gl|gm|gn|gp|gq|gr|gs|gt|gu|gw|gy|hk|hm|hn|hr|ht|hu|id|ie|il|im|in|io|iq|ir|is|it|je|jm|jo|jp|ke|kg|kh|ki|km|kn|kp|kr|kw|ky|kz|la|lb|lc|li|lk|lr|ls|lt|lu|lv|ly|ma|mc|md|me|mg|mh|mk|ml|mm|mn|mo|mp|mq|mr|ms|mt|mu|mv|mw|mx|my|mz|na|nc|ne|nf|ng|ni|nl|no|np|nr|nu|nz|om|pa|pe|pf|pg|ph|pk|pl|pm|pn|pr|ps|pt|pw|py|qa|re|ro|rs|ru|rw|sa|sb|sc|sd|se|sg|sh|si|sj|Ja|sk|sl|sm|sn|so|sr|ss|st|su|sv|sx|sy|sz|tc|td|tf|tg|th|tj|tk|tl|tm|tn|to|tp|tr|tt|tv|tw|tz|ua|ug|uk|us|uy|uz|va|vc|ve|vg|vi|vn|vu|wf|ws|ye|yt|yu|za|zm|zw)\b\?(?!@)))'
-        simple_alternative_regex = r'(http|ftp|https)?(://)?([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?'
-
         if option == 'simple':
-            chosen_regex = simple_alternative_regex
+            chosen_regex = 'urls_simple'
         elif option == 'complex':
-            chosen_regex = alternative_regex
+            chosen_regex = 'urls_complex'
 
         if disambiguate != []:
-            matches = re.findall(chosen_regex, email)
+            matches = _PATTERNS[chosen_regex].findall(email)
             for match in matches:
                 print(match)
                 match = ''.join(match)
                 print(match)
-                if re.search('mckinsey.com', match) and 'internal' in disambiguate:
+                if _PATTERNS['internal_url'].search(match) and 'internal' in disambiguate:
                     email = re.sub(match, replacement + 'INTERNAL', email)
-                if not re.search('mckinsey.com', match) and 'external' in disambiguate:
+                if not _PATTERNS['internal_url'].search(match) and 'external' in disambiguate:
                     email = re.sub(match, replacement + 'EXTERNAL', email)
         else:
-            email = re.sub(chosen_regex, replacement, email)
+            email = _sub(chosen_regex, replacement, email)
         return email
 
     @staticmethod
@@ -445,9 +637,7 @@ class EmailCleaning:
         Returns:
             email (Str): Cleaned up email
         """
-        email = re.sub(
-            r"([\w\d\-.]+\.pdf|[\w\d\-.]+\.docx|[\w\d\-.]+\.doc|[\w\d\-.]+\.pptx|[\w\d\-.]+\.ppt|[\w\d\-.]+\.txt|[\w\d\-.]+\.zip|[\w\d\-.]+\.xlsx|[\w\d\-.]+\.xls)",
-            replacement, email)
+        email = _sub('files', replacement, email)
         return email
 
     @staticmethod
@@ -462,14 +652,7 @@ class EmailCleaning:
             email (Str): Cleaned up email
         """
         # TODO allow to disambiguate between internal/external?
-        regex = []
-        # remove lotus notes email address
-        regex.append([r'([a-z\-]+\s?\n?){1,3}(\/[a-z0-9\-?]+){2,5}(\@|\/)mckinsey(\-external|@M[a-z]*)?', replacement])
-        # remove email address, john.snow@yahoo.com -> ANONYMIZED EMAIL
-        regex.append([r'[_a-z0-9-]+(\.[_a-z0-9-]+)*@[a-z0-9-]+(\.[a-z0-9-]+)*(\.[a-z]{2,4})', replacement])
-        for rg in regex:
-            email = re.sub(rg[0], rg[1], email, flags=re.IGNORECASE | re.MULTILINE)
-        return email
+        return _apply_substitutions('anonymize_email_adresses', email, replacement)
 
     @staticmethod
     def find_names_from_email_adresses(email):
@@ -483,12 +666,12 @@ class EmailCleaning:
         Returns:
             (?): Not sure
         """
-        senders = re.findall(r'\nFrom:([A-Za-z-\s]*)\n', email)
+        senders = _PATTERNS['senders'].findall(email)
         from_names = list(map(lambda x: '_'.join(x.lower().split()), senders))
 
         email = email.lower()
         email = unidecode.unidecode(email)
-        emails = re.findall(r"[a-z0-9\.\-+_,&:]+@[a-z0-9\.\-+_]+\.[a-z]+", email)
+        emails = _PATTERNS['email_adresses'].findall(email)
 
         users = list(np.unique(from_names + list(
             map(lambda x: x.replace('@external.mckinsey.com', '').replace('@mckinsey.com', ''), emails))))
@@ -534,29 +717,33 @@ class EmailCleaning:
         """
 
         emails = thread.split(email_break)  # EmailCleaning.insert_breaks(thread.split(email_break), email_break)
-        paragraphs = [' '.join(p.split()) for e in emails for p in re.split("\n{2,10}", e)]
-        unique_parags, parags_idx = np.unique(paragraphs, return_index=True)
-        non_repeating = EmailCleaning.remove_dups(unique_parags[np.argsort(parags_idx)])
+        paragraphs = [' '.join(p.split()) for e in emails for p in _PATTERNS['paragraph_break_bounded'].split(e)]
+        # unique paragraphs in order of first occurence
+        unique_parags = list(dict.fromkeys(paragraphs))
+        non_repeating = EmailCleaning.remove_dups(unique_parags)
         return ('\n\n').join(non_repeating)
 
     @staticmethod
     def remove_dups(unique_parags, email_break='\n\n==============+++EMAIL_BREAK+++==============\n\n'):
-        """Helper function for remove_repeating_parags.
+        """Helper function for remove_repeating_parags. Drops paragraphs that are contained in an earlier paragraph
+        or that are shorter than 30 chars (apart from the first one). Email breaks are never dropped and never count as earlier paragraphs.
+        Substrings are looked up in a ParagraphIndex of the paragraphs kept so far, so this is about linear in the length of the thread
 
         Args:
-            unique_parags (?): Unique paragraphs in the email
+            unique_parags (list of Str): Unique paragraphs in the email, in order
             email_break (str, optional): The delimiter used to separate emails in a thread. Defaults to '\n\n==============+++EMAIL_BREAK+++==============\n\n'.
 
         Returns:
-            list: List of unique paragraphs (ordered) .. or something?
+            list: List of unique paragraphs (ordered)
         """
-        # as is, this has quadratic time complexity in pargraphs, but those tend to be few. could be made faster with OrderedDicts probably
-        for_removal = []
-        for u in range(len(unique_parags)):
-            for i in range(u + 1, len(unique_parags)):
-                if unique_parags[i] != '\n\n==============+++EMAIL_BREAK+++==============\n\n' and unique_parags[
-                    u] != '\n\n==============+++EMAIL_BREAK+++==============\n\n':
-                    if (unique_parags[i] in unique_parags[u]) or len(unique_parags[
-                                                                         i]) < 30:  # (unique_parags[u] in unique_parags[i] or unique_parags[i] in unique_parags[u]) and len(unique_parags[u])>=35 and len(unique_parags[i])>=35:
-                        for_removal.append(i)
-        return [up for up in unique_parags[np.setdiff1d(range(len(unique_parags)), np.unique(for_removal))]]
+        # paragraphs that were dropped don't need to be in the index: whatever they contain is also in the earlier paragraph
+        # that contained them, or is shorter than 30 chars and dropped anyway
+        index = ParagraphIndex()
+        kept = []
+        for parag in unique_parags:
+            if parag != email_break and len(index) > 0 and (len(parag) < 30 or index.contains(parag)):
+                continue
+            kept.append(parag)
+            if parag != email_break:
+                index.add(parag)
+        return kept
@@ -0,0 +1,26 @@
+import json
+
+TEXT_FIELDS = ('email', 'text', 'body')
+
+
+def email_text(record, text_fields=TEXT_FIELDS):
+    """The email text of one JSONL record: either a plain string or the first of text_fields present in an object"""
+    if isinstance(record, str):
+        return record
+    for field in text_fields:
+        if isinstance(record.get(field), str):
+            return record[field]
+    return ''
+
+
+def iter_jsonl(path):
+    """Yields the JSON records of a JSONL file (one per line, empty lines skipped)"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_emails(path, text_fields=TEXT_FIELDS):
+    """Email texts of a JSONL file, see email_text"""
+    return [email_text(record, text_fields) for record in iter_jsonl(path)]
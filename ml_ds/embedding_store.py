@@ -0,0 +1,256 @@
+"""Embeddings of a labelled corpus on disk, memory-mapped when read, and the centroids built from them.
+
+A store is a directory with:
+    embeddings.bin   raw (count, dim) float16 or float32 array, read with np.memmap
+    labels.bin       raw (count,) int8 array, 1 for thank-you examples (or -1 when unlabelled)
+    meta.json        format version, model name, dimension, count, dtype and whether the rows are L2-normalized
+
+Nothing is pickled. The scorer's centroid is a store with a single row (see load_centroid), so it records which
+model it was computed with.
+
+Usage (from ml_ds/):
+    python embedding_store.py encode --examples labelled.jsonl --output ../models/embeddings [--dtype float16]
+    python embedding_store.py centroid --store ../models/embeddings --output ../thank_you_centroid
+    python embedding_store.py from-pickle --pickle ../positives_average.pickle --output ../thank_you_centroid
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 1
+DTYPES = ['float32', 'float16']
+UNLABELLED = -1
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# found from this file, not from the working directory
+DEFAULT_CENTROID_PATH = os.path.join(_ROOT, 'thank_you_centroid')
+LEGACY_AVERAGE_VECTOR_PATH = os.path.join(_ROOT, 'positives_average.pickle')
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class StoreWriter:
+    """Appends embeddings (and their labels) to a new store, batch by batch. meta.json is written on close, so a store
+    is only readable once it is complete
+
+        with StoreWriter('../models/embeddings', model_name) as writer:
+            for texts, labels in batches:
+                writer.append(scorer.encode(texts), labels)
+
+    Args:
+        path (Str): Store directory, created if needed. An existing store there is overwritten
+        model_name (Str): Model that computed the embeddings
+        dtype (str, optional): One of ['float32', 'float16']. Defaults to 'float32'.
+        normalize (bool, optional): L2-normalize rows on the way in. Defaults to False.
+        extra (dict, optional): Added to meta.json. Defaults to None.
+    """
+
+    def __init__(self, path, model_name, dtype='float32', normalize=False, extra=None):
+        assert dtype in DTYPES, "dtype must be one of %s" % DTYPES
+        self.path = path
+        self.model_name = model_name
+        self.dtype = dtype
+        self.normalize = normalize
+        self.extra = extra or {}
+        self.dim = None
+        self.count = 0
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            os.remove(os.path.join(path, 'meta.json'))
+        self._embeddings = open(os.path.join(path, 'embeddings.bin'), 'wb')
+        self._labels = open(os.path.join(path, 'labels.bin'), 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self._embeddings.close()
+            self._labels.close()
+
+    def append(self, vectors, labels=None):
+        """Adds the rows of vectors, shape (n, dim), with their labels (list of int, defaults to UNLABELLED)"""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError('Expected embeddings of dimension %d, got %d' % (self.dim, vectors.shape[1]))
+        if self.normalize:
+            vectors = _normalize(vectors)
+        labels = np.full(len(vectors), UNLABELLED, dtype=np.int8) if labels is None else np.asarray(labels, dtype=np.int8)
+        if len(labels) != len(vectors):
+            raise ValueError('Expected one label per embedding, got %d labels for %d embeddings' % (len(labels), len(vectors)))
+        self._embeddings.write(vectors.astype(self.dtype).tobytes())
+        self._labels.write(labels.tobytes())
+        self.count += len(vectors)
+
+    def close(self):
+        self._embeddings.close()
+        self._labels.close()
+        meta = dict(self.extra, format_version=FORMAT_VERSION, model_name=self.model_name, dim=self.dim or 0,
+                    count=self.count, dtype=self.dtype, normalized=self.normalize)
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(meta_path + '.tmp', meta_path)
+
+
+def write_store(path, vectors, model_name, labels=None, dtype='float32', normalize=False, extra=None):
+    """Writes a whole (small) array as a store, e.g. a centroid"""
+    with StoreWriter(path, model_name, dtype, normalize, extra) as writer:
+        writer.append(vectors, labels)
+    return path
+
+
+class EmbeddingStore:
+    """Read-only, memory-mapped view of a store
+
+    Args:
+        path (Str): Store directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] > FORMAT_VERSION:
+            raise ValueError('%s has format version %d, this code reads up to %d' % (path, self.meta['format_version'], FORMAT_VERSION))
+        count, dim = self.meta['count'], self.meta['dim']
+        if count:
+            self.vectors = np.memmap(os.path.join(path, 'embeddings.bin'), dtype=self.meta['dtype'], mode='r', shape=(count, dim))
+            self.labels = np.memmap(os.path.join(path, 'labels.bin'), dtype=np.int8, mode='r', shape=(count,))
+        else:
+            # np.memmap refuses empty files
+            self.vectors = np.zeros((0, dim), dtype=self.meta['dtype'])
+            self.labels = np.zeros(0, dtype=np.int8)
+
+    @property
+    def model_name(self):
+        return self.meta['model_name']
+
+    def __len__(self):
+        return len(self.labels)
+
+    def chunks(self, chunk_size=65536):
+        """Yields (float32 vectors, labels) chunk by chunk, so the whole store never has to fit in memory"""
+        for start in range(0, len(self), chunk_size):
+            yield np.asarray(self.vectors[start:start + chunk_size], dtype=np.float32), np.asarray(self.labels[start:start + chunk_size])
+
+    def centroid(self, label=1, normalize_rows=False, chunk_size=65536):
+        """Mean of the embeddings with the given label (all of them if label is None), one chunk at a time
+
+        Args:
+            label (int, optional): Defaults to 1 (thank-you examples).
+            normalize_rows (bool, optional): Average the L2-normalized rows instead of the rows as stored. Defaults to False.
+        """
+        total = np.zeros(self.meta['dim'], dtype=np.float64)
+        count = 0
+        for vectors, labels in self.chunks(chunk_size):
+            if label is not None:
+                vectors = vectors[labels == label]
+            if normalize_rows:
+                vectors = _normalize(vectors)
+            total += vectors.sum(axis=0, dtype=np.float64)
+            count += len(vectors)
+        if count == 0:
+            raise ValueError('No embeddings with label %s in %s' % (label, self.path))
+        return (total / count).astype(np.float32)
+
+
+def load_centroid(path=None):
+    """Centroid (average thank-you vector) of a single-row store. A legacy .pickle path is still read, with pickle.
+
+    Args:
+        path (Str, optional): Defaults to DEFAULT_CENTROID_PATH, or LEGACY_AVERAGE_VECTOR_PATH while that does not exist.
+
+    Returns:
+        (centroid (np.array), model name (Str or None))
+    """
+    if path is None:
+        path = DEFAULT_CENTROID_PATH if os.path.exists(DEFAULT_CENTROID_PATH) else LEGACY_AVERAGE_VECTOR_PATH
+    if path.endswith('.pickle'):
+        import pickle
+        with open(path, 'rb') as f:
+            return np.asarray(pickle.load(f), dtype=np.float32), None
+    store = EmbeddingStore(path)
+    if len(store) != 1:
+        raise ValueError('%s holds %d vectors, a centroid store holds one' % (path, len(store)))
+    return np.asarray(store.vectors[0], dtype=np.float32), store.model_name
+
+
+def encode_corpus(records, scorer, output, dtype='float32', normalize=False, batch_size=256, report_every=10000):
+    """Cleans and encodes labelled emails in batches straight into a new store
+
+    Args:
+        records (iterable of dict): JSONL records with an email (see email_io.email_text) and a "label"
+        scorer (ThankYouScorer): Cleans and encodes the emails
+        output (Str): Store directory
+    """
+    from email_io import email_text
+
+    start = time.perf_counter()
+    next_report = report_every
+    with StoreWriter(output, scorer.model_name, dtype, normalize) as writer:
+        texts, labels = [], []
+        for record in records:
+            texts.append(scorer.clean(email_text(record)))
+            labels.append(int(record.get('label', UNLABELLED)))
+            if len(texts) == batch_size:
+                writer.append(scorer.encode(texts), labels)
+                texts, labels = [], []
+                if report_every and writer.count >= next_report:
+                    elapsed = time.perf_counter() - start
+                    print('Encoded %d emails in %.1f s (%.1f emails/s)' % (writer.count, elapsed, writer.count / elapsed))
+                    next_report += report_every
+        if texts:
+            writer.append(scorer.encode(texts), labels)
+    return writer.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    encode_parser = subparsers.add_parser('encode', help='Embeddings of labelled example emails')
+    encode_parser.add_argument('--examples', required=True, help='JSONL with an email and a "label" (1 = thank-you) per line')
+    encode_parser.add_argument('--output', required=True)
+    encode_parser.add_argument('--dtype', choices=DTYPES, default='float32')
+    encode_parser.add_argument('--normalize', action='store_true')
+    encode_parser.add_argument('--batch-size', type=int, default=256)
+    centroid_parser = subparsers.add_parser('centroid', help='Average thank-you vector of a store')
+    centroid_parser.add_argument('--store', required=True)
+    centroid_parser.add_argument('--output', default=DEFAULT_CENTROID_PATH)
+    centroid_parser.add_argument('--label', type=int, default=1)
+    centroid_parser.add_argument('--normalize-rows', action='store_true')
+    pickle_parser = subparsers.add_parser('from-pickle', help='Convert positives_average.pickle to a centroid store')
+    pickle_parser.add_argument('--pickle', default=LEGACY_AVERAGE_VECTOR_PATH)
+    pickle_parser.add_argument('--model-name', default='paraphrase-distilroberta-base-v1')
+    pickle_parser.add_argument('--output', default=DEFAULT_CENTROID_PATH)
+    args = parser.parse_args()
+
+    if args.command == 'encode':
+        from email_io import iter_jsonl
+        from encode_score2 import ThankYouScorer
+
+        count = encode_corpus(iter_jsonl(args.examples), ThankYouScorer(), args.output, args.dtype, args.normalize, args.batch_size)
+        print('Stored %d embeddings in %s' % (count, args.output))
+    elif args.command == 'centroid':
+        store = EmbeddingStore(args.store)
+        write_store(args.output, store.centroid(args.label, args.normalize_rows), store.model_name,
+                    extra={'source': os.path.abspath(args.store), 'label': args.label})
+        print('Centroid of %s written to %s' % (args.store, args.output))
+    else:
+        centroid, _ = load_centroid(args.pickle)
+        write_store(args.output, centroid, args.model_name, extra={'source': os.path.basename(args.pickle)})
+        print('Centroid written to', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,356 @@
-from sentence_transformers import SentenceTransformer
-from email_cleaning import EmailCleaning
-from scipy import spatial
-import pickle
+from email_cleaning import EmailCleaning, cleaning_version
+from content_cache import ContentCache
+from embedding_store import load_centroid
+import json
+import numpy as np
+import os
+import threading
+import time
 
 
+def cosine_distances(vectors, reference):
+    """Vectorized scipy.spatial.distance.cosine of every row of vectors against one reference vector
+
+    Args:
+        vectors (np.array): Matrix of shape (n, dim) (or a single vector)
+        reference (np.array): Vector of shape (dim,)
+
+    Returns:
+        distances (np.array): Shape (n,)
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float64))
+    reference = np.asarray(reference, dtype=np.float64).ravel()
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference)
+    return 1.0 - (vectors @ reference) / norms
+
+
+class ThankYouScorer:
+    """Long-lived scorer. Loads the sentence transformer and the average thank-you vector once and keeps them
+    in memory, so that scoring an email only costs cleaning + encoding (and not reloading the weights every time)
+
+    Args:
+        model_name (str, optional): Name (or local path) of the SentenceTransformer. Defaults to 'paraphrase-distilroberta-base-v1'.
+        average_vector_path (str, optional): Centroid store of the average thank-you vector, see embedding_store (a legacy
+            .pickle is still read). Defaults to None (embedding_store.DEFAULT_CENTROID_PATH, next to ml_ds/ whatever the working directory).
+        load (bool, optional): Whether to load the model right away. If False, it gets loaded on first use. Defaults to True.
+        clean_cache (ContentCache, optional): Cache of cleaned emails, keyed by hash of the raw email, the pipeline and the
+            cleaning version (see email_cleaning.cleaning_version). Defaults to None (no caching).
+        embedding_cache (ContentCache, optional): Cache of embeddings, keyed by hash of the cleaned email and of the model (name,
+            backend, quantization, snapshot). Defaults to None (no caching).
+        backend (str, optional): One of ['torch', 'onnx']. 'onnx' runs an exported model under ONNX Runtime, see onnx_backend. Defaults to 'torch'.
+        onnx_dir (str, optional): Directory of the exported ONNX model. Defaults to None (onnx_backend.DEFAULT_ONNX_DIR).
+        quantized (bool, optional): Use the int8-quantized ONNX model. Defaults to False.
+        num_threads (int, optional): Threads used by the backend for one encode call. Defaults to None (backend default).
+        pipeline (CleaningPipeline, optional): Cleaning applied before encoding. clean_cache should only be shared between
+            scorers with the same pipeline. Defaults to None (EmailCleaning.full_clean).
+        prefilter (ThankYouPrefilter, optional): Decides obvious emails without the model, see prefilter. Defaults to None.
+        intents (IntentCentroids or ReloadingIntents, optional): Further intents scored on the same embedding by
+            classify_batch, see intents. Defaults to None.
+        threshold (float, optional): Score below which an email is a thank-you. Defaults to .4 (a cosine distance to the
+            average vector, k-NN scores need their own, about .5).
+        knn_index_dir (str, optional): Score against the k nearest labelled examples of this index (see knn_index) instead
+            of the average vector. Scores are then 1 - the weighted share of thank-you neighbours, pass threshold with it.
+            Defaults to None.
+        knn_k (int, optional): Neighbours that vote. Defaults to 10.
+        knn_nprobe (int, optional): Coarse groups searched per email. Defaults to 2.
+        snapshot_dir (str, optional): Local snapshot of the model and centroid written by model_snapshot, loaded instead of
+            model_name (and of the default centroid). Defaults to None.
+    """
+
+    def __init__(self, model_name='paraphrase-distilroberta-base-v1',
+                 average_vector_path=None, load=True, clean_cache=None, embedding_cache=None,
+                 backend='torch', onnx_dir=None, quantized=False, num_threads=None, pipeline=None, prefilter=None, intents=None,
+                 threshold=.4, knn_index_dir=None, knn_k=10, knn_nprobe=2, snapshot_dir=None):
+        assert backend in ['torch', 'onnx'], "Backend must be one of ['torch', 'onnx']"
+        self.model_name = model_name
+        self.snapshot_dir = snapshot_dir
+        snapshot_created = None
+        if snapshot_dir:
+            with open(os.path.join(snapshot_dir, 'snapshot.json')) as f:
+                snapshot = json.load(f)
+            self.model_name = snapshot['model_name']
+            snapshot_created = snapshot.get('created')
+        self.average_vector_path = average_vector_path
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.quantized = quantized
+        self.num_threads = num_threads
+        self.clean_fun = pipeline or EmailCleaning.full_clean
+        self.prefilter = prefilter
+        self.intents = intents
+        self.knn_index_dir = knn_index_dir
+        self.knn_k = knn_k
+        self.knn_nprobe = knn_nprobe
+        self.knn_index = None
+        self.threshold = threshold
+        self.clean_cache = clean_cache
+        self.embedding_cache = embedding_cache
+        # cache keys also hash what the cached value depends on besides the text, so that a persistent cache (SCORER_CACHE_DIR)
+        # never serves embeddings of another model or backend, or cleanings of another pipeline or set of terms
+        self._embedding_namespace = json.dumps([self.model_name, backend, onnx_dir if backend == 'onnx' else None, quantized,
+                                                snapshot_dir and os.path.abspath(snapshot_dir), snapshot_created])
+        self._pipeline_name = 'full_clean' if pipeline is None else repr(pipeline)
+        self.model = None
+        self.average_vector = None
+        self.load_time = None
+        self.last_encode_time = None
+        self.total_encode_time = 0.0
+        self.encode_calls = 0
+        self.encoded_texts = 0
+        self._lock = threading.Lock()
+        if load:
+            self.load()
+
+    def load(self):
+        """Loads the model and the average vector. Time it takes is kept in self.load_time"""
+        with self._lock:
+            if self.model is not None:
+                return self
+            start = time.perf_counter()
+            centroid_path = self.average_vector_path
+            if self.snapshot_dir and centroid_path is None:
+                centroid_path = os.path.join(self.snapshot_dir, 'centroid')
+            self.average_vector, centroid_model = load_centroid(centroid_path)
+            if centroid_model is not None and centroid_model != self.model_name:
+                print('Warning: the centroid was computed with %s, the scorer uses %s' % (centroid_model, self.model_name))
+            if self.knn_index_dir:
+                from knn_index import KnnIndex
+                self.knn_index = KnnIndex(self.knn_index_dir, self.knn_k, self.knn_nprobe)
+            if self.backend == 'onnx':
+                from onnx_backend import DEFAULT_ONNX_DIR, OnnxEncoder
+                self.model = OnnxEncoder(self.onnx_dir or DEFAULT_ONNX_DIR, self.quantized, self.num_threads)
+            else:
+                if self.num_threads:
+                    import torch
+                    torch.set_num_threads(self.num_threads)
+                # imported here, it takes seconds and the ONNX backend does without it
+                from sentence_transformers import SentenceTransformer
+                self.model = SentenceTransformer(os.path.join(self.snapshot_dir, 'model') if self.snapshot_dir else self.model_name)
+            self.load_time = time.perf_counter() - start
+        return self
+
+    def warm_up(self, text='Thank you for your help!'):
+        """Runs one dummy email through the whole pipeline so that the first real request does not pay for lazy init.
+        The warm-up call is not counted in the encode timings (those of earlier calls are kept)
+        """
+        self.load()
+        counters = self.last_encode_time, self.total_encode_time, self.encode_calls, self.encoded_texts
+        self.encode(self.clean_fun(text))
+        self.last_encode_time, self.total_encode_time, self.encode_calls, self.encoded_texts = counters
+        return self
+
+    def encode(self, cleaned_texts):
+        """Encodes already cleaned text(s). A list is sent through model.encode in one call. Keeps track of the time spent in model.encode
+
+        Args:
+            cleaned_texts (Str or list of Str): Output(s) of EmailCleaning.full_clean
+
+        Returns:
+            encoded_vectors (np.array): Sentence embedding (one row per text if a list was passed in)
+        """
+        if self.model is None:
+            self.load()
+        start = time.perf_counter()
+        encoded_vectors = self.model.encode(cleaned_texts)
+        self.last_encode_time = time.perf_counter() - start
+        self.total_encode_time += self.last_encode_time
+        self.encode_calls += 1
+        self.encoded_texts += 1 if isinstance(cleaned_texts, str) else len(cleaned_texts)
+        return encoded_vectors
+
+    def score(self, input_text):
+        """Cosine distance of the (cleaned) email to the average thank-you vector (or the k-NN score, see knn_index_dir). The lower, the more thank-you it is
+
+        Args:
+            input_text (Str): Raw email
+
+        Returns:
+            score (float): Cosine distance
+        """
+        return self.score_batch([input_text])[0]
+
+    def score_batch(self, input_texts):
+        """Same as score, but the whole batch goes through model.encode at once and the distances are computed in one go
+
+        Args:
+            input_texts (list of Str): Raw emails
+
+        Returns:
+            scores (list of float): Cosine distances, in the same order as input_texts
+        """
+        if len(input_texts) == 0:
+            return []
+        cleaned_texts = [self.clean(text) for text in input_texts]
+        scores = [self.prefilter_score(text, cleaned) for text, cleaned in zip(input_texts, cleaned_texts)]
+        model_scores = iter(self.score_cleaned_batch([cleaned for cleaned, score in zip(cleaned_texts, scores) if score is None]))
+        return [next(model_scores) if score is None else score for score in scores]
+
+    def prefilter_score(self, input_text, cleaned_text):
+        """Score given by the prefilter to an obvious email, None if the model has to score it (or there is no prefilter)"""
+        if self.prefilter is None:
+            return None
+        return self.prefilter.decide(input_text, cleaned_text)
+
+    def score_cleaned_batch(self, cleaned_texts):
+        """Same as score_batch, for emails that already went through clean"""
+        if len(cleaned_texts) == 0:
+            return []
+        encoded_vectors = self.encode_cached(cleaned_texts)
+        if self.knn_index is not None:
+            return self.knn_index.scores(encoded_vectors).tolist()
+        return cosine_distances(encoded_vectors, self.average_vector).tolist()
+
+    def classify_batch(self, input_texts):
+        """Scores and labels of every email against every intent of self.intents
+
+        Args:
+            input_texts (list of Str): Raw emails
+
+        Returns:
+            list of dict: {intent: {'score': cosine distance, 'label': 0/1}} per email, in the same order as input_texts
+        """
+        return self.classify_cleaned_batch([self.clean(text) for text in input_texts])
+
+    def classify_cleaned_batch(self, cleaned_texts):
+        """Same as classify_batch, for emails that already went through clean"""
+        if self.intents is None:
+            raise ValueError('No intents configured, see intents.IntentCentroids')
+        if len(cleaned_texts) == 0:
+            return []
+        # one embedding per email, one matrix multiply against all centroids
+        return self.intents.current().classify(self.encode_cached(cleaned_texts))
+
+    def clean(self, input_text):
+        """Cleaning of the scorer (EmailCleaning.full_clean by default), looked up in clean_cache first (if there is one)"""
+        if self.clean_cache is None:
+            return self.clean_fun(input_text)
+        version = cleaning_version()
+        key = ContentCache.key(input_text, '%s %s' % (self._pipeline_name, version))
+        cleaned_text = self.clean_cache.get(key)
+        if cleaned_text is None:
+            cleaned_text = self.clean_fun(input_text)
+            # not stored if the terms were reloaded meanwhile, it may have been cleaned with the new ones
+            if cleaning_version() == version:
+                self.clean_cache.put(key, cleaned_text)
+        return cleaned_text
+
+    def encode_cached(self, cleaned_texts):
+        """Same as encode on a list, but only texts that are not in embedding_cache go through model.encode (still in one call)
+
+        Args:
+            cleaned_texts (list of Str): Outputs of EmailCleaning.full_clean
+
+        Returns:
+            encoded_vectors (np.array): One row per text
+        """
+        if self.embedding_cache is None:
+            return self.encode(cleaned_texts)
+        keys = [ContentCache.key(text, self._embedding_namespace) for text in cleaned_texts]
+        vectors = {}
+        for key in set(keys):
+            vector = self.embedding_cache.get(key)
+            if vector is not None:
+                vectors[key] = vector
+        # identical texts within the batch are encoded only once
+        missing = dict((key, text) for key, text in zip(keys, cleaned_texts) if key not in vectors)
+        if missing:
+            for key, vector in zip(missing, self.encode(list(missing.values()))):
+                vectors[key] = vector
+                self.embedding_cache.put(key, vector)
+        return np.stack([vectors[key] for key in keys])
+
+    def cache_stats(self):
+        """Hit/miss counters of both caches"""
+        return {
+            'clean_cache': self.clean_cache.stats() if self.clean_cache is not None else None,
+            'embedding_cache': self.embedding_cache.stats() if self.embedding_cache is not None else None,
+        }
+
+    def timings(self):
+        """Load time and encode times (in seconds), reported separately"""
+        return {
+            'load_time': self.load_time,
+            'last_encode_time': self.last_encode_time,
+            'mean_encode_time': self.total_encode_time / self.encode_calls if self.encode_calls else None,
+            'encode_calls': self.encode_calls,
+            'encoded_texts': self.encoded_texts,
+        }
+
+
+_default_scorer = None
+_default_scorer_lock = threading.Lock()
+
+
+def default_caches():
+    """Clean and embedding caches configured from the environment: SCORER_CACHE_SIZE (entries, 0 disables caching),
+    SCORER_CACHE_TTL (seconds) and SCORER_CACHE_DIR (directory for the on-disk tier, off if not set)
+    """
+    max_entries = int(os.environ.get('SCORER_CACHE_SIZE', 10000))
+    if max_entries <= 0:
+        return None, None
+    ttl = float(os.environ.get('SCORER_CACHE_TTL', 24 * 3600))
+    cache_dir = os.environ.get('SCORER_CACHE_DIR')
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    return (
+        ContentCache(max_entries, ttl, os.path.join(cache_dir, 'cleaned.sqlite') if cache_dir else None),
+        ContentCache(max_entries, ttl, os.path.join(cache_dir, 'embeddings.sqlite') if cache_dir else None),
+    )
+
+
+def get_scorer():
+    """Shared scorer for this process (used by the API and batch jobs), created on first call"""
+    global _default_scorer
+    with _default_scorer_lock:
+        if _default_scorer is None:
+            clean_cache, embedding_cache = default_caches()
+            # CLEANING_MIN_LENGTH stops the cleaning early once the text gets shorter than that
+            pipeline = None
+            prefilter = None
+            # SCORER_PREFILTER=1 decides obvious thank-yous and business emails without the model. Off by default, its
+            # agreement with the model hasn't been measured on real traffic yet (run prefilter.py evaluate first)
+            if os.environ.get('SCORER_PREFILTER') == '1':
+                from prefilter import ThankYouPrefilter
+                prefilter = ThankYouPrefilter(max_thanks_words=int(os.environ.get('PREFILTER_MAX_THANKS_WORDS', 3)),
+                                              min_other_words=int(os.environ.get('PREFILTER_MIN_OTHER_WORDS', 80)))
+            # INTENTS_PATH points to an intents.npz (see intents.py), checked for changes every INTENTS_CHECK_INTERVAL seconds
+            intents = None
+            if os.environ.get('INTENTS_PATH'):
+                from intents import ReloadingIntents
+                intents = ReloadingIntents(os.environ['INTENTS_PATH'], float(os.environ.get('INTENTS_CHECK_INTERVAL', 5)))
+            # THANKS_THRESHOLD is the score below which an email is a thank-you (scorer.threshold, used by the API too)
+            threshold = float(os.environ.get('THANKS_THRESHOLD', .4))
+            # SCORER_KNN=1 scores against the nearest labelled examples of the index in SCORER_KNN_INDEX instead of the
+            # average vector. Off by default, it misses its latency target (see knn_index). Its scores are votes, not
+            # distances, so it also needs THANKS_THRESHOLD set for them (about .5)
+            knn_index_dir = None
+            if os.environ.get('SCORER_KNN') == '1':
+                if not os.environ.get('SCORER_KNN_INDEX') or not os.environ.get('THANKS_THRESHOLD'):
+                    raise ValueError('SCORER_KNN=1 needs SCORER_KNN_INDEX and THANKS_THRESHOLD (about .5 for k-NN votes)')
+                knn_index_dir = os.environ['SCORER_KNN_INDEX']
+            if os.environ.get('CLEANING_MIN_LENGTH'):
+                from cleaning_pipeline import CleaningPipeline
+                pipeline = CleaningPipeline(min_length=int(os.environ['CLEANING_MIN_LENGTH']))
+            # SCORER_BACKEND=onnx (with SCORER_ONNX_DIR, SCORER_QUANTIZED=1) switches to the ONNX Runtime backend,
+            # SCORER_CENTROID to another centroid store (see embedding_store.py), SCORER_SNAPSHOT to a model snapshot
+            # (see model_snapshot.py) that loads from local files only
+            _default_scorer = ThankYouScorer(average_vector_path=os.environ.get('SCORER_CENTROID'),
+                                             snapshot_dir=os.environ.get('SCORER_SNAPSHOT'),
+                                             clean_cache=clean_cache, embedding_cache=embedding_cache,
+                                             backend=os.environ.get('SCORER_BACKEND', 'torch'),
+                                             onnx_dir=os.environ.get('SCORER_ONNX_DIR'),
+                                             quantized=os.environ.get('SCORER_QUANTIZED') == '1',
+                                             num_threads=int(os.environ.get('SCORER_THREADS', 0)) or None,
+                                             pipeline=pipeline, prefilter=prefilter,
+                                             intents=intents, threshold=threshold, knn_index_dir=knn_index_dir,
+                                             knn_k=int(os.environ.get('SCORER_KNN_K', 10)),
+                                             knn_nprobe=int(os.environ.get('SCORER_KNN_NPROBE', 2)))
+    return _default_scorer
 
-"""Unpickle avergae vectpr pf thank-you vectors"""
-with open('../positives_average.pickle', 'rb') as f:
-    average_vector = pickle.load(f)
 
 def get_score(input_text):
-    cleaned_text=EmailCleaning.full_clean(input_text)
-    model = SentenceTransformer('paraphrase-distilroberta-base-v1')
-    encoded_vector=model.encode(cleaned_text)
-    score=spatial.distance.cosine(average_vector, encoded_vector)
-    return score
\ No newline at end of file
+    return get_scorer().score(input_text)
+
+
+def get_scores(list_of_texts):
+    return get_scorer().score_batch(list_of_texts)
@@ -0,0 +1,163 @@
+"""Several intents (thank-you, out-of-office, unsubscribe, meeting acceptance, ..) scored on the same sentence embedding.
+
+An intent set is a matrix of L2-normalized centroids, one row per intent, with a cosine-distance threshold per intent,
+stored in one .npz file (no pickle). Scoring a batch of embeddings against all intents is a single matrix multiply.
+
+Usage (from ml_ds/):
+    python intents.py build --intent thank_you thanks.jsonl 0.4 --intent out_of_office ooo.jsonl 0.35 --output ../intents.npz
+    python intents.py from-average --output ../intents.npz
+"""
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+
+def _normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class IntentCentroids:
+    """Normalized centroid matrix with a threshold per intent
+
+    Args:
+        names (list of Str): Intent names, one per centroid
+        centroids (np.array): Shape (intents, dim), normalized on the way in
+        thresholds (list of float): Cosine distance below which an email has the intent, one per centroid
+    """
+
+    def __init__(self, names, centroids, thresholds):
+        self.names = [str(name) for name in names]
+        self.centroids = np.ascontiguousarray(_normalize(centroids))
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        if not len(self.names) == len(self.centroids) == len(self.thresholds):
+            raise ValueError('Expected one centroid and one threshold per intent, got %d names, %d centroids, %d thresholds'
+                             % (len(self.names), len(self.centroids), len(self.thresholds)))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['names'].tolist(), data['centroids'], data['thresholds'])
+
+    def save(self, path):
+        # written next to the target and renamed, so a reloading worker never sees a half-written file
+        tmp_path = '%s.tmp%d.npz' % (path, os.getpid())
+        np.savez(tmp_path, names=np.array(self.names), centroids=self.centroids, thresholds=self.thresholds)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_examples(cls, examples, thresholds):
+        """Centroids as the mean of the normalized embeddings of each intent's examples
+
+        Args:
+            examples (dict): Intent name -> embeddings of its example emails, shape (n, dim)
+            thresholds (dict): Intent name -> threshold
+        """
+        names = list(examples)
+        return cls(names, [_normalize(examples[name]).mean(axis=0) for name in names], [thresholds[name] for name in names])
+
+    def distances(self, vectors):
+        """Cosine distances of every embedding to every centroid, shape (n, intents)"""
+        return 1.0 - _normalize(vectors) @ self.centroids.T
+
+    def classify(self, vectors):
+        """One {intent: {'score': cosine distance, 'label': 0/1}} dict per embedding"""
+        distances = self.distances(vectors)
+        labels = distances < self.thresholds
+        return [dict((name, {'score': float(row[i]), 'label': int(row_labels[i])}) for i, name in enumerate(self.names))
+                for row, row_labels in zip(distances, labels)]
+
+    def current(self):
+        # same interface as ReloadingIntents
+        return self
+
+    def threshold(self, name):
+        return float(self.thresholds[self.names.index(name)])
+
+    def stats(self):
+        return {'intents': dict(zip(self.names, self.thresholds.tolist()))}
+
+    def __len__(self):
+        return len(self.names)
+
+
+class ReloadingIntents:
+    """IntentCentroids read from a file and read again when the file changes, at most every check_interval seconds.
+    Every worker notices the new file on its own, nothing needs to be restarted. A file that fails to load is
+    reported in stats() and the previous centroids stay in use
+
+    Args:
+        path (Str): .npz file written by IntentCentroids.save
+        check_interval (float, optional): Seconds between checks of the file's modification time. Defaults to 5.
+    """
+
+    def __init__(self, path, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime_ns
+        self._intents = IntentCentroids.load(path)
+        self._last_check = time.monotonic()
+        self.reloads = 0
+        self.last_error = None
+
+    def current(self):
+        """The centroids to use now (reloaded first if the file changed)"""
+        if time.monotonic() - self._last_check >= self.check_interval:
+            with self._lock:
+                if time.monotonic() - self._last_check >= self.check_interval:
+                    self._reload_if_changed()
+        return self._intents
+
+    def _reload_if_changed(self):
+        self._last_check = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            self._intents = IntentCentroids.load(self.path)
+            self._mtime = mtime
+            self.reloads += 1
+            self.last_error = None
+        except Exception as error:
+            self.last_error = '%s: %s' % (type(error).__name__, error)
+
+    def stats(self):
+        intents = self._intents
+        return {'path': self.path, 'intents': dict(zip(intents.names, intents.thresholds.tolist())),
+                'reloads': self.reloads, 'last_error': self.last_error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Centroids from example emails (JSONL) of every intent')
+    build_parser.add_argument('--intent', nargs=3, action='append', required=True, metavar=('NAME', 'EMAILS', 'THRESHOLD'))
+    build_parser.add_argument('--output', required=True)
+    average_parser = subparsers.add_parser('from-average', help='Single thank-you intent from the existing average vector')
+    average_parser.add_argument('--average-vector', help='Centroid store. Defaults to the scorer\'s, see embedding_store.load_centroid')
+    average_parser.add_argument('--name', default='thank_you')
+    average_parser.add_argument('--threshold', type=float, default=.4)
+    average_parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    if args.command == 'from-average':
+        from embedding_store import load_centroid
+        intents = IntentCentroids([args.name], [load_centroid(args.average_vector)[0]], [args.threshold])
+    else:
+        from email_io import load_emails
+        from encode_score2 import ThankYouScorer
+
+        scorer = ThankYouScorer()
+        examples = dict((name, scorer.encode([scorer.clean(email) for email in load_emails(path)])) for name, path, _ in args.intent)
+        intents = IntentCentroids.from_examples(examples, dict((name, float(threshold)) for name, _, threshold in args.intent))
+    intents.save(args.output)
+    print('Saved %d intents to %s' % (len(intents), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""k-nearest-neighbour scoring against labelled example embeddings, as an alternative to the single average vector.
+
+The index is a directory of .npy files, memory-mapped when loaded (so forked workers share the pages):
+    embeddings.npy   L2-normalized example embeddings, int8 with a per-row scale in scales.npy, or float16
+                     (float16 is exact to ~1e-3 but numpy converts it to float32 several times slower than int8)
+    labels.npy       1 for thank-you examples, 0 for the others
+    centroids.npy    coarse k-means centroids (float32); examples are stored grouped by nearest centroid
+    offsets.npy      start of every centroid's group in embeddings.npy
+    index.json       dtype, dimension and counts
+
+Search is approximate (IVF): only the groups of the nprobe centroids closest to the query are scanned. Groups k-means
+left empty are never probed.
+
+Latency: the goal was well under 1 ms per email at a few hundred thousand examples, it is not met. With 300,000 int8
+examples (about 1,100 groups, nprobe 2, recall@10 of 0.99 against exact search) bench measures 1.0-1.6 ms per email
+scored in batches of 32 (the API's micro-batches) and 1.9-2.7 ms one at a time, on one slow core. Most of it is
+reading the ~550 scanned rows and converting them from int8; fewer rows (nprobe 1, recall 0.95) gets to about 1 ms.
+So the API and batch jobs only score with it when asked to: SCORER_KNN=1 with SCORER_KNN_INDEX and a THANKS_THRESHOLD
+for its votes (see encode_score2.get_scorer).
+
+Usage (from ml_ds/):
+    python knn_index.py build --examples labelled.jsonl --output ../models/knn [--dtype float16]
+    python knn_index.py build --store ../models/embeddings --output ../models/knn  (embeddings from embedding_store.py)
+    python knn_index.py bench --examples 300000 [--dtype float16] [--nprobe 2]
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+DTYPES = ['int8', 'float16']
+
+
+def _normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _kmeans(vectors, clusters, iterations=10, sample_size=20000, seed=0):
+    """Spherical k-means centroids of (a sample of) normalized vectors"""
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = np.bincount(assignment, minlength=clusters) == 0
+        # empty clusters keep their old centroid
+        sums[empty] = centroids[empty]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def _assign(vectors, centroids, chunk_size=65536):
+    return np.concatenate([np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+                           for start in range(0, len(vectors), chunk_size)])
+
+
+def build(embeddings, labels, output_dir, dtype='int8', clusters=None, seed=0):
+    """Writes an index of labelled embeddings to output_dir
+
+    Args:
+        embeddings (np.array): Shape (n, dim), normalized here
+        labels (list of int): 1 for thank-you examples, 0 for the others
+        output_dir (Str): Created if needed
+        dtype (str, optional): One of ['int8', 'float16']. Defaults to 'int8'.
+        clusters (int, optional): Number of coarse centroids. Defaults to about 2 * sqrt(n).
+        seed (int, optional): Defaults to 0.
+    """
+    assert dtype in DTYPES, "dtype must be one of %s" % DTYPES
+    embeddings = _normalize(embeddings)
+    labels = np.asarray(labels, dtype=np.int8)
+    clusters = min(len(embeddings), clusters or max(1, int(2 * np.sqrt(len(embeddings)))))
+    centroids = _kmeans(embeddings, clusters, seed=seed)
+    assignment = _assign(embeddings, centroids)
+    order = np.argsort(assignment, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=clusters))]).astype(np.int64)
+    embeddings, labels = embeddings[order], labels[order]
+
+    os.makedirs(output_dir, exist_ok=True)
+    if dtype == 'int8':
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+        np.save(os.path.join(output_dir, 'scales.npy'), scales.astype(np.float32))
+        np.save(os.path.join(output_dir, 'embeddings.npy'), np.round(embeddings / scales[:, None]).astype(np.int8))
+    else:
+        np.save(os.path.join(output_dir, 'embeddings.npy'), embeddings.astype(np.float16))
+    np.save(os.path.join(output_dir, 'labels.npy'), labels)
+    np.save(os.path.join(output_dir, 'centroids.npy'), centroids.astype(np.float32))
+    np.save(os.path.join(output_dir, 'offsets.npy'), offsets)
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump({'dtype': dtype, 'dim': int(embeddings.shape[1]), 'examples': int(len(embeddings)), 'clusters': int(clusters),
+                   'positives': int(labels.sum())}, f, indent=2)
+    return output_dir
+
+
+class KnnIndex:
+    """Memory-mapped index written by build
+
+    Args:
+        index_dir (Str): Output directory of build
+        k (int, optional): Neighbours that vote. Defaults to 10.
+        nprobe (int, optional): Coarse groups scanned per query; more is slower and closer to exact search. Defaults to 2.
+    """
+
+    def __init__(self, index_dir, k=10, nprobe=2):
+        with open(os.path.join(index_dir, 'index.json')) as f:
+            self.meta = json.load(f)
+        self.k = k
+        self.nprobe = nprobe
+        self.embeddings = np.load(os.path.join(index_dir, 'embeddings.npy'), mmap_mode='r')
+        self.scales = np.load(os.path.join(index_dir, 'scales.npy'), mmap_mode='r') if self.meta['dtype'] == 'int8' else None
+        self.labels = np.load(os.path.join(index_dir, 'labels.npy'))
+        self.centroids = np.load(os.path.join(index_dir, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(index_dir, 'offsets.npy'))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _rows(self, start, end):
+        rows = np.asarray(self.embeddings[start:end], dtype=np.float32)
+        if self.scales is not None:
+            rows *= self.scales[start:end, None]
+        return rows
+
+    def _similarities(self, start, end, queries):
+        similarities = np.asarray(self.embeddings[start:end], dtype=np.float32) @ queries.T
+        # the int8 scale is per row, applied to the n x q similarities instead of the n x dim rows
+        return similarities * self.scales[start:end, None] if self.scales is not None else similarities
+
+    def _search_many(self, queries, k, nprobe):
+        """(indices, similarities) of the k nearest examples of every normalized query, most similar first.
+        The centroids are compared to all queries in one matmul, and every probed group is read (and converted from
+        int8) once for all the queries probing it, most of the cost of a query when they come one at a time"""
+        k = k or self.k
+        sizes = np.diff(self.offsets)
+        # k-means can leave groups empty, probing only those would find no neighbour at all
+        nprobe = min(nprobe or self.nprobe, int((sizes > 0).sum()))
+        centroid_similarities = queries @ self.centroids.T
+        centroid_similarities[:, sizes == 0] = -np.inf
+        probes = np.argpartition(-centroid_similarities, nprobe - 1, axis=1)[:, :nprobe]
+        found = [([], []) for _ in range(len(queries))]
+        for group in np.unique(probes):
+            probing = np.flatnonzero((probes == group).any(axis=1))
+            start, end = self.offsets[group], self.offsets[group + 1]
+            similarities = self._similarities(start, end, queries[probing])
+            for column, query in enumerate(probing):
+                found[query][0].append(similarities[:, column])
+                found[query][1].append(np.arange(start, end))
+        results = []
+        for similarities, indices in found:
+            similarities, indices = np.concatenate(similarities), np.concatenate(indices)
+            top = np.argpartition(-similarities, k - 1)[:k] if len(similarities) > k else np.arange(len(similarities))
+            top = top[np.argsort(-similarities[top])]
+            results.append((indices[top], similarities[top]))
+        return results
+
+    def search(self, query, k=None, nprobe=None):
+        """Indices and cosine similarities of the (approximately) k most similar examples to one query, most similar first"""
+        return self._search_many(_normalize(query)[:1], k, nprobe)[0]
+
+    def scores(self, vectors, k=None, nprobe=None):
+        """1 - similarity-weighted share of thank-you examples among the k nearest neighbours of every vector.
+        Like a cosine distance to the average vector, the lower the more thank-you it is (0.5 is a tie).
+        Scoring a batch at once is several times cheaper per vector than one at a time (see bench)
+
+        Args:
+            vectors (np.array): Embeddings, shape (n, dim) (or a single vector)
+
+        Returns:
+            scores (np.array): Shape (n,)
+        """
+        scores = []
+        for indices, similarities in self._search_many(_normalize(vectors), k, nprobe):
+            weights = np.clip(similarities, 0, None) + 1e-6
+            scores.append(1.0 - float((weights * self.labels[indices]).sum() / weights.sum()))
+        return np.array(scores)
+
+
+def bench(examples, dim=768, dtype='int8', k=10, nprobe=2, clusters=None, queries=200, batch_size=32, seed=0):
+    """Query latency and recall against exact search on random clustered data, to size nprobe.
+    query_ms is one search at a time, score_ms all queries in one scores call, batch_score_ms batches of batch_size
+    (the API's micro-batches), all per query"""
+    import tempfile
+
+    rng = np.random.default_rng(seed)
+    topics = _normalize(rng.normal(size=(max(1, examples // 500), dim)))
+    embeddings = _normalize(topics[rng.integers(len(topics), size=examples)] + .5 * rng.normal(size=(examples, dim)) / np.sqrt(dim))
+    labels = rng.integers(2, size=examples)
+    with tempfile.TemporaryDirectory() as index_dir:
+        start = time.perf_counter()
+        build(embeddings, labels, index_dir, dtype, clusters, seed)
+        build_time = time.perf_counter() - start
+        index = KnnIndex(index_dir, k, nprobe)
+        query_vectors = _normalize(embeddings[rng.integers(examples, size=queries)] + .5 * rng.normal(size=(queries, dim)) / np.sqrt(dim))
+        start = time.perf_counter()
+        found = [set(index.search(query)[0].tolist()) for query in query_vectors]
+        query_time = (time.perf_counter() - start) / queries
+        start = time.perf_counter()
+        index.scores(query_vectors)
+        score_time = (time.perf_counter() - start) / queries
+        start = time.perf_counter()
+        for batch_start in range(0, queries, batch_size):
+            index.scores(query_vectors[batch_start:batch_start + batch_size])
+        batch_time = (time.perf_counter() - start) / queries
+        exact = index._rows(0, len(index)) @ query_vectors.T
+        recall = np.mean([len(found[i] & set(np.argsort(-exact[:, i])[:k].tolist())) / k for i in range(queries)])
+        size = index.embeddings.nbytes + (index.scales.nbytes if index.scales is not None else 0)
+    return {'examples': examples, 'dtype': dtype, 'clusters': index.meta['clusters'], 'nprobe': nprobe, 'build_s': build_time,
+            'query_ms': 1000 * query_time, 'score_ms': 1000 * score_time,
+            'batch_score_ms': 1000 * batch_time, 'recall_at_k': float(recall), 'embeddings_mb': size / 2 ** 20}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Index labelled example emails')
+    source = build_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--examples', help='JSONL with an email and a "label" (1 = thank-you) per line')
+    source.add_argument('--store', help='Labelled embeddings written by embedding_store.py')
+    build_parser.add_argument('--output', required=True)
+    build_parser.add_argument('--dtype', choices=DTYPES, default='int8')
+    build_parser.add_argument('--clusters', type=int)
+    bench_parser = subparsers.add_parser('bench', help='Latency and recall on random data')
+    bench_parser.add_argument('--examples', type=int, default=300000)
+    bench_parser.add_argument('--dtype', choices=DTYPES, default='int8')
+    bench_parser.add_argument('--k', type=int, default=10)
+    bench_parser.add_argument('--nprobe', type=int, default=2)
+    bench_parser.add_argument('--clusters', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        print(json.dumps(bench(args.examples, dtype=args.dtype, k=args.k, nprobe=args.nprobe, clusters=args.clusters), indent=2))
+        return
+    if args.store:
+        from embedding_store import EmbeddingStore
+        store = EmbeddingStore(args.store)
+        print('Index written to', build(store.vectors, store.labels, args.output, args.dtype, args.clusters))
+        return
+    from email_io import email_text, iter_jsonl
+    from encode_score2 import ThankYouScorer
+
+    records = list(iter_jsonl(args.examples))
+    scorer = ThankYouScorer()
+    embeddings = scorer.encode([scorer.clean(email_text(record)) for record in records])
+    print('Index written to', build(embeddings, [int(record['label']) for record in records], args.output, args.dtype, args.clusters))
+
+
+if __name__ == '__main__':
+    main()
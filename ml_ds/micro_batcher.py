@@ -0,0 +1,156 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class _Call:
+    # a function queued by MicroBatcher.call, told apart from the items of batch_fun
+    def __init__(self, fun):
+        self.fun = fun
+
+    def run(self, future):
+        try:
+            future.set_result(self.fun())
+        except Exception as e:
+            future.set_exception(e)
+
+
+class MicroBatcher:
+    """Coalesces single requests coming from many threads into batches. Requests arriving within max_wait_ms of the first
+    one (up to max_batch_size of them) are handed to batch_fun in one call, and every caller gets back its own result.
+    Meant to sit in front of the scorer, so concurrent API requests share one model.encode call:
+
+        batcher = MicroBatcher(scorer.score_cleaned_batch, max_batch_size=32, max_wait_ms=5)
+        score = batcher.submit(cleaned_text)
+
+    Args:
+        batch_fun (callable): Takes a list of items and returns a list of results in the same order
+        max_batch_size (int, optional): Defaults to 32.
+        max_wait_ms (float, optional): How long the first request of a batch waits for others to join. Defaults to 5.
+        max_queue_size (int, optional): Requests waiting at most, submit raises queue.Full beyond that. Defaults to 0 (unbounded).
+    """
+
+    def __init__(self, batch_fun, max_batch_size=32, max_wait_ms=5, max_queue_size=0):
+        self.batch_fun = batch_fun
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self.batches = 0
+        self.items = 0
+        self.max_queue_depth = 0
+        # batch sizes, bucketed by the next power of two
+        self.batch_size_histogram = {}
+
+    def _ensure_started(self):
+        # the worker thread is started lazily and again after a fork, threads don't survive fork()
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.max_queue_size)
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, item, timeout=None):
+        """Queues item, waits until its batch went through batch_fun and returns its result.
+        Exceptions raised by batch_fun are re-raised in every caller of that batch
+
+        Args:
+            item: One input of batch_fun
+            timeout (float, optional): Seconds to wait for the result. Defaults to None (wait forever).
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put_nowait((item, future))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return future.result(timeout)
+
+    def submit_many(self, items, timeout=None):
+        """Same as submit for a list of items, which may end up spread over several batches. Blocks (up to timeout)
+        while the queue is full instead of failing right away
+
+        Args:
+            items (list): Inputs of batch_fun
+            timeout (float, optional): Seconds to wait for room in the queue and for each result. Defaults to None (wait forever).
+
+        Returns:
+            list: Results in the same order as items
+        """
+        self._ensure_started()
+        futures = []
+        for item in items:
+            future = Future()
+            self._queue.put((item, future), timeout=timeout)
+            futures.append(future)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return [future.result(timeout) for future in futures]
+
+    def call(self, fun, timeout=None):
+        """Runs fun() on the batcher's thread, between two batches, and returns its result. For work that must not
+        run concurrently with batch_fun, such as warming the model up
+
+        Args:
+            fun (callable): Takes no argument
+            timeout (float, optional): Seconds to wait for the result. Defaults to None (wait forever).
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((_Call(fun), future), timeout=timeout)
+        return future.result(timeout)
+
+    def _collect(self):
+        batch = []
+        deadline = None
+        while len(batch) < self.max_batch_size:
+            if deadline is None:
+                entry = self._queue.get()
+            else:
+                remaining = deadline - time.monotonic()
+                try:
+                    entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            item, future = entry
+            if isinstance(item, _Call):
+                # run right away, the batch collected so far waits for it
+                item.run(future)
+                continue
+            batch.append(entry)
+            if deadline is None:
+                deadline = time.monotonic() + self.max_wait_ms / 1000
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, future in batch]
+            try:
+                results = self.batch_fun(items)
+            except Exception as e:
+                for item, future in batch:
+                    future.set_exception(e)
+            else:
+                for (item, future), result in zip(batch, results):
+                    future.set_result(result)
+            bucket = 1 << (len(batch) - 1).bit_length()
+            with self._lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.batch_size_histogram[bucket] = self.batch_size_histogram.get(bucket, 0) + 1
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'max_queue_depth': self.max_queue_depth,
+            'batches': self.batches,
+            'items': self.items,
+            'mean_batch_size': self.items / self.batches if self.batches else None,
+            'batch_size_histogram': dict(('<=%d' % bucket, count) for bucket, count in sorted(self.batch_size_histogram.items())),
+        }
@@ -0,0 +1,69 @@
+"""Snapshot of the scorer's model and centroid in one local directory, so a new worker loads them from disk in one go
+instead of resolving the model name on the Hugging Face hub (and its cache) on every start.
+
+A snapshot is a directory with:
+    model/          SentenceTransformer.save of the model (safetensors weights, tokenizer and config)
+    centroid/       the average thank-you vector, as an embedding store (see embedding_store)
+    snapshot.json   name of the model it was taken from, library versions and date
+
+Point SCORER_SNAPSHOT at it (or pass snapshot_dir to ThankYouScorer).
+
+Usage (from ml_ds/):
+    python model_snapshot.py save --output ../models/snapshot [--model-name paraphrase-distilroberta-base-v1]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+
+from embedding_store import write_store
+
+
+def save_snapshot(scorer, output):
+    """Writes the (loaded) model and centroid of a torch-backend scorer to output, replacing an older snapshot there
+
+    Args:
+        scorer (ThankYouScorer): Scorer to snapshot
+        output (Str): Snapshot directory
+
+    Returns:
+        output (Str)
+    """
+    import sentence_transformers
+
+    if scorer.backend != 'torch':
+        raise ValueError('Only the torch backend can be snapshotted, the ONNX export (onnx_backend.py) is already a local directory')
+    scorer.load()
+    # written next to the target and renamed, a worker starting meanwhile never sees half a snapshot
+    tmp_output = output.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_output, ignore_errors=True)
+    os.makedirs(tmp_output)
+    scorer.model.save(os.path.join(tmp_output, 'model'))
+    write_store(os.path.join(tmp_output, 'centroid'), scorer.average_vector, scorer.model_name)
+    with open(os.path.join(tmp_output, 'snapshot.json'), 'w') as f:
+        json.dump({'model_name': scorer.model_name, 'created': datetime.datetime.now().isoformat(),
+                   'python': platform.python_version(), 'sentence_transformers': sentence_transformers.__version__}, f, indent=2)
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp_output, output)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    save_parser = subparsers.add_parser('save', help='Snapshot the model and centroid')
+    save_parser.add_argument('--output', required=True)
+    save_parser.add_argument('--model-name', default='paraphrase-distilroberta-base-v1')
+    save_parser.add_argument('--average-vector', help='Centroid store. Defaults to the scorer\'s, see embedding_store.load_centroid')
+    args = parser.parse_args()
+
+    from encode_score2 import ThankYouScorer
+
+    scorer = ThankYouScorer(args.model_name, args.average_vector)
+    print('Snapshot written to', save_snapshot(scorer, args.output))
+
+
+if __name__ == '__main__':
+    main()
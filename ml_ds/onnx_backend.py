@@ -0,0 +1,200 @@
+"""ONNX Runtime backend for the sentence transformer, for CPU-only nodes.
+
+Export the model once (optionally with dynamic int8 quantization), check that it gives the same labels as PyTorch
+on a held-out set, then switch the scorer over with SCORER_BACKEND=onnx (see encode_score2.get_scorer).
+
+Usage (from ml_ds/):
+    python onnx_backend.py export [--output-dir ../models/onnx] [--quantize]
+    python onnx_backend.py parity --emails heldout.jsonl [--quantized] [--threads 4]
+
+Needs onnx and onnxruntime (and transformers, which comes with sentence_transformers), which are not in requirements.txt
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+DEFAULT_MODEL_NAME = 'paraphrase-distilroberta-base-v1'
+DEFAULT_ONNX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models', 'onnx')
+MODEL_FILE = 'model.onnx'
+QUANTIZED_MODEL_FILE = 'model.int8.onnx'
+CONFIG_FILE = 'onnx_config.json'
+
+
+def _import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError('The onnx backend needs onnxruntime: pip install onnx onnxruntime')
+    return onnxruntime
+
+
+def export(model_name=DEFAULT_MODEL_NAME, output_dir=DEFAULT_ONNX_DIR, quantize=False, opset_version=14):
+    """Exports the transformer of a SentenceTransformer to ONNX, next to its tokenizer. Pooling is done in numpy by OnnxEncoder
+
+    Args:
+        model_name (Str, optional): SentenceTransformer name or path. Defaults to 'paraphrase-distilroberta-base-v1'.
+        output_dir (Str, optional): Defaults to models/onnx in the repo.
+        quantize (bool, optional): Also write a dynamically int8-quantized copy of the model. Defaults to False.
+        opset_version (int, optional): Defaults to 14.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Pooling, Transformer
+
+    model = SentenceTransformer(model_name, device='cpu')
+    modules = list(model)
+    if len(modules) != 2 or not isinstance(modules[0], Transformer) or not isinstance(modules[1], Pooling) \
+            or not modules[1].pooling_mode_mean_tokens:
+        raise ValueError('Only Transformer + mean Pooling models can be exported, got %s' % [type(m).__name__ for m in modules])
+    transformer = modules[0]
+    auto_model = transformer.auto_model.eval()
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, input_ids, attention_mask):
+            return self.auto_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    os.makedirs(output_dir, exist_ok=True)
+    dummy = transformer.tokenizer(['Thank you for your help!'], return_tensors='pt', padding=True)
+    model_path = os.path.join(output_dir, MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(TokenEmbeddings(), (dummy['input_ids'], dummy['attention_mask']), model_path,
+                          input_names=['input_ids', 'attention_mask'], output_names=['token_embeddings'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'token_embeddings': {0: 'batch', 1: 'sequence'}},
+                          opset_version=opset_version)
+    transformer.tokenizer.save_pretrained(output_dir)
+    if quantize:
+        _import_onnxruntime()
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(model_path, os.path.join(output_dir, QUANTIZED_MODEL_FILE), weight_type=QuantType.QInt8)
+    with open(os.path.join(output_dir, CONFIG_FILE), 'w') as f:
+        json.dump({'model_name': model_name, 'max_seq_length': model.max_seq_length, 'pooling': 'mean',
+                   'quantized': quantize}, f, indent=2)
+    return output_dir
+
+
+class OnnxEncoder:
+    """Drop-in replacement for SentenceTransformer.encode running an exported model (see export) under ONNX Runtime
+
+    Args:
+        model_dir (Str, optional): Output directory of export. Defaults to models/onnx in the repo.
+        quantized (bool, optional): Use the int8 model. Defaults to False.
+        num_threads (int, optional): Intra-op threads of the session. Defaults to None (onnxruntime decides).
+    """
+
+    def __init__(self, model_dir=DEFAULT_ONNX_DIR, quantized=False, num_threads=None):
+        onnxruntime = _import_onnxruntime()
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        self.max_seq_length = self.config['max_seq_length']
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        model_file = QUANTIZED_MODEL_FILE if quantized else MODEL_FILE
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, model_file), options,
+                                                    providers=['CPUExecutionProvider'])
+
+    def _encode_batch(self, sentences):
+        tokens = self.tokenizer(sentences, padding=True, truncation=True, max_length=self.max_seq_length, return_tensors='np')
+        attention_mask = tokens['attention_mask'].astype(np.int64)
+        token_embeddings = self.session.run(None, {'input_ids': tokens['input_ids'].astype(np.int64),
+                                                   'attention_mask': attention_mask})[0]
+        # mean pooling over the real (non-padding) tokens, same as sentence_transformers' Pooling
+        mask = attention_mask[:, :, None].astype(token_embeddings.dtype)
+        return (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        """Same contract as SentenceTransformer.encode: a string gives one vector, a list gives one row per sentence"""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        if len(sentences) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        # sorting by length keeps padding (and wasted compute) per batch low
+        order = np.argsort([-len(s) for s in sentences], kind='stable')
+        embeddings = np.concatenate([self._encode_batch([sentences[i] for i in order[start:start + batch_size]])
+                                     for start in range(0, len(sentences), batch_size)])
+        embeddings = embeddings[np.argsort(order, kind='stable')].astype(np.float32)
+        return embeddings[0] if single else embeddings
+
+
+def check_parity(emails, onnx_encoder, torch_model, average_vector, threshold=.4):
+    """Compares ONNX against PyTorch embeddings (and the labels they give at threshold) on the same emails
+
+    Args:
+        emails (list of Str): Raw held-out emails
+        onnx_encoder (OnnxEncoder): Candidate backend
+        torch_model (SentenceTransformer): Reference backend
+        average_vector (np.array): Average thank-you vector
+        threshold (float, optional): Cosine distance below which an email is a thank-you. Defaults to .4.
+
+    Returns:
+        dict: Embedding cosine similarity (min/mean), max score difference, label agreement and the indices that disagree
+    """
+    from email_cleaning import EmailCleaning
+    from encode_score2 import cosine_distances
+
+    cleaned = [EmailCleaning.full_clean(email) for email in emails]
+    reference = np.atleast_2d(torch_model.encode(cleaned))
+    candidate = np.atleast_2d(onnx_encoder.encode(cleaned))
+    similarity = (candidate * reference).sum(axis=1) / (np.linalg.norm(candidate, axis=1) * np.linalg.norm(reference, axis=1))
+    reference_scores = cosine_distances(reference, average_vector)
+    candidate_scores = cosine_distances(candidate, average_vector)
+    disagreements = np.flatnonzero((reference_scores < threshold) != (candidate_scores < threshold))
+    return {
+        'emails': len(emails),
+        'min_embedding_similarity': float(similarity.min()),
+        'mean_embedding_similarity': float(similarity.mean()),
+        'max_score_difference': float(np.abs(reference_scores - candidate_scores).max()),
+        'label_agreement': 1.0 - len(disagreements) / len(emails),
+        'disagreements': disagreements.tolist(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='Export the model to ONNX')
+    export_parser.add_argument('--model-name', default=DEFAULT_MODEL_NAME)
+    export_parser.add_argument('--output-dir', default=DEFAULT_ONNX_DIR)
+    export_parser.add_argument('--quantize', action='store_true', help='Also write a dynamically int8-quantized model')
+    parity_parser = subparsers.add_parser('parity', help='Compare ONNX and PyTorch on held-out emails')
+    parity_parser.add_argument('--emails', required=True, help='JSONL file with held-out emails')
+    parity_parser.add_argument('--model-name', default=DEFAULT_MODEL_NAME)
+    parity_parser.add_argument('--onnx-dir', default=DEFAULT_ONNX_DIR)
+    parity_parser.add_argument('--quantized', action='store_true')
+    parity_parser.add_argument('--threads', type=int)
+    parity_parser.add_argument('--threshold', type=float, default=.4)
+    parity_parser.add_argument('--min-agreement', type=float, default=1.0,
+                               help='Exit with an error if fewer labels than this agree. Defaults to 1.0')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print('Exported to', export(args.model_name, args.output_dir, args.quantize))
+        return
+    from email_io import load_emails
+    from encode_score2 import ThankYouScorer
+
+    reference = ThankYouScorer(args.model_name, backend='torch', num_threads=args.threads)
+    report = check_parity(load_emails(args.emails), OnnxEncoder(args.onnx_dir, args.quantized, args.threads),
+                          reference.model, reference.average_vector, args.threshold)
+    print(json.dumps(report, indent=2))
+    if report['label_agreement'] < args.min_agreement:
+        raise SystemExit('Label agreement %.4f is below %.4f' % (report['label_agreement'], args.min_agreement))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+class ParagraphIndex:
+    """Substring index over a growing set of paragraphs (generalized suffix automaton).
+
+    Adding a paragraph costs O(len(paragraph)) and checking whether some text is contained in any of the
+    paragraphs added so far costs O(len(text)), no matter how many paragraphs there are. Exact repeats are
+    answered from a hash set before walking the automaton.
+
+    index = ParagraphIndex()
+    index.add('thanks for the deck, see you tomorrow')
+    index.contains('the deck')  # -> True
+    """
+
+    def __init__(self, paragraphs=()):
+        # state 0 is the root; transitions, suffix links and lengths of the longest string of each state
+        self._next = [{}]
+        self._link = [-1]
+        self._len = [0]
+        self._paragraphs = set()
+        self.longest = 0
+        for paragraph in paragraphs:
+            self.add(paragraph)
+
+    def __len__(self):
+        return len(self._paragraphs)
+
+    def __contains__(self, text):
+        return self.contains(text)
+
+    def _new_state(self, length, transitions, link):
+        self._next.append(transitions)
+        self._link.append(link)
+        self._len.append(length)
+        return len(self._len) - 1
+
+    def _clone(self, p, q, c):
+        """Splits state q so that the transition p -c-> q becomes solid. Returns the clone"""
+        nxt, link, length = self._next, self._link, self._len
+        clone = self._new_state(length[p] + 1, dict(nxt[q]), link[q])
+        while p != -1 and nxt[p].get(c) == q:
+            nxt[p][c] = clone
+            p = link[p]
+        link[q] = clone
+        return clone
+
+    def _extend(self, last, c):
+        nxt, link, length = self._next, self._link, self._len
+        q = nxt[last].get(c)
+        if q is not None:
+            # the new suffix already exists in the automaton (it was seen in an earlier paragraph)
+            if length[last] + 1 == length[q]:
+                return q
+            return self._clone(last, q, c)
+        cur = self._new_state(length[last] + 1, {}, 0)
+        p = last
+        while p != -1 and c not in nxt[p]:
+            nxt[p][c] = cur
+            p = link[p]
+        if p != -1:
+            q = nxt[p][c]
+            if length[p] + 1 == length[q]:
+                link[cur] = q
+            else:
+                link[cur] = self._clone(p, q, c)
+        return cur
+
+    def add(self, paragraph):
+        """Adds one paragraph to the index. Re-adding a paragraph is a no-op"""
+        if paragraph in self._paragraphs:
+            return
+        self._paragraphs.add(paragraph)
+        self.longest = max(self.longest, len(paragraph))
+        last = 0
+        for c in paragraph:
+            last = self._extend(last, c)
+
+    def contains(self, text):
+        """Whether text is a substring of (or equal to) any paragraph added so far"""
+        if text in self._paragraphs:
+            return True
+        if len(text) > self.longest:
+            return False
+        nxt = self._next
+        state = 0
+        for c in text:
+            state = nxt[state].get(c)
+            if state is None:
+                return False
+        return True
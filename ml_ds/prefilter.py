@@ -0,0 +1,153 @@
+"""Cheap first tier in front of the sentence transformer: decides the obvious cases from a gratitude lexicon and
+the length of the cleaned email, and leaves everything else to the model.
+
+- A message whose new text thanks someone, and whose cleaned text is (almost) nothing else, is a thank-you.
+  The cleaning strips "thanks", "thank you", greetings and signatures, so a short thank-you note is nearly empty by then.
+- A long cleaned message without any gratitude word in its new text is not a thank-you.
+The new text is the message above its quoted history (what remove_repeated_replies keeps), so a "thanks" quoted from
+an earlier message doesn't count.
+
+Its agreement with the model hasn't been measured on real traffic yet. Before turning it on (SCORER_PREFILTER=1),
+check how much traffic it takes off the model, and how often it agrees with the model, on a sample of real emails:
+    python prefilter.py evaluate --emails sample.jsonl [--max-thanks-words 3] [--min-other-words 80]
+"""
+import argparse
+import json
+import re
+import threading
+import time
+
+from email_cleaning import EmailCleaning
+
+# cosine distances reported for the emails the prefilter decides, on the two sides of any sensible threshold
+THANKS_SCORE = 0.0
+OTHER_SCORE = 1.0
+
+GRATITUDE_WORDS = {
+    'thanks', 'thank', 'thx', 'tnx', 'ty', 'thankyou', 'appreciated', 'appreciate', 'grateful', 'gratitude', 'kudos',
+    'merci', 'danke', 'dankeschön', 'vielen', 'gracias', 'grazie', 'obrigado', 'obrigada', 'bedankt', 'dank', 'tack',
+    'kiitos', 'takk', 'tak', 'dziękuję', 'spasibo',
+}
+
+_WORD = re.compile(r'\w+')
+# placeholders left by the cleaning, they don't count as content
+_PLACEHOLDER = re.compile(r'ANONYMIZED_[A-Z]+')
+
+
+class ThankYouPrefilter:
+    """Lexicon and length rules, see the module docstring
+
+    Args:
+        max_thanks_words (int, optional): A thanking email with at most this many words left after cleaning is a thank-you. Defaults to 3.
+        min_other_words (int, optional): An email without gratitude words and at least this many words after cleaning
+            is not a thank-you. Defaults to 80.
+        gratitude_words (set of Str, optional): Lowercase words that count as thanking. Defaults to GRATITUDE_WORDS.
+    """
+
+    def __init__(self, max_thanks_words=3, min_other_words=80, gratitude_words=GRATITUDE_WORDS):
+        self.max_thanks_words = max_thanks_words
+        self.min_other_words = min_other_words
+        self.gratitude_words = frozenset(gratitude_words)
+        self._lock = threading.Lock()
+        self.seen = 0
+        self.thanks = 0
+        self.other = 0
+
+    def thanks_in(self, text):
+        return any(word in self.gratitude_words for word in _WORD.findall(text.lower()))
+
+    def decide(self, raw_text, cleaned_text):
+        """THANKS_SCORE or OTHER_SCORE when the email is an obvious case, None when the model has to decide
+
+        Args:
+            raw_text (Str): Email before cleaning (or its new part, see thread_cleaner). Gratitude words are only
+                looked for above its quoted history
+            cleaned_text (Str): The same email after cleaning, as it would be sent to the model
+        """
+        words = len(_WORD.findall(_PLACEHOLDER.sub(' ', cleaned_text)))
+        decision = None
+        if words <= self.max_thanks_words:
+            if self.thanks_in(EmailCleaning.remove_repeated_replies(raw_text)):
+                decision = THANKS_SCORE
+        elif words >= self.min_other_words and not self.thanks_in(EmailCleaning.remove_repeated_replies(raw_text)):
+            decision = OTHER_SCORE
+        with self._lock:
+            self.seen += 1
+            if decision == THANKS_SCORE:
+                self.thanks += 1
+            elif decision == OTHER_SCORE:
+                self.other += 1
+        return decision
+
+    def stats(self):
+        with self._lock:
+            return {
+                'seen': self.seen,
+                'short_circuited_thanks': self.thanks,
+                'short_circuited_other': self.other,
+                'short_circuited_fraction': (self.thanks + self.other) / self.seen if self.seen else None,
+            }
+
+
+def evaluate(emails, prefilter, scorer, threshold=.4):
+    """Runs the prefilter and the full model on the same emails
+
+    Args:
+        emails (list of Str): Raw emails
+        prefilter (ThankYouPrefilter): Prefilter to evaluate
+        scorer (ThankYouScorer): Scorer without a prefilter, used as reference
+        threshold (float, optional): Cosine distance below which the model calls an email a thank-you. Defaults to .4.
+
+    Returns:
+        dict: Fraction short-circuited, label agreement with the model on the short-circuited emails (overall and per
+        side), the disagreeing indices and the time per email of both tiers
+    """
+    cleaned = [scorer.clean(email) for email in emails]
+    start = time.perf_counter()
+    decisions = [prefilter.decide(email, text) for email, text in zip(emails, cleaned)]
+    prefilter_time = time.perf_counter() - start
+    start = time.perf_counter()
+    model_labels = [score < threshold for score in scorer.score_cleaned_batch(cleaned)]
+    model_time = time.perf_counter() - start
+    decided = [i for i, decision in enumerate(decisions) if decision is not None]
+    disagreements = [i for i in decided if (decisions[i] < threshold) != model_labels[i]]
+    disagreeing = set(disagreements)
+
+    def agreement(side):
+        indices = [i for i in decided if decisions[i] == side]
+        return 1.0 - sum(1 for i in indices if i in disagreeing) / len(indices) if indices else None
+
+    return {
+        'emails': len(emails),
+        'short_circuited_fraction': len(decided) / len(emails) if emails else None,
+        'short_circuited_thanks': sum(1 for i in decided if decisions[i] == THANKS_SCORE),
+        'short_circuited_other': sum(1 for i in decided if decisions[i] == OTHER_SCORE),
+        'agreement': 1.0 - len(disagreements) / len(decided) if decided else None,
+        'agreement_thanks': agreement(THANKS_SCORE),
+        'agreement_other': agreement(OTHER_SCORE),
+        'disagreements': disagreements,
+        'prefilter_ms_per_email': 1000 * prefilter_time / len(emails) if emails else None,
+        'model_ms_per_email': 1000 * model_time / len(emails) if emails else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    evaluate_parser = subparsers.add_parser('evaluate', help='Compare the prefilter with the full model on a set of emails')
+    evaluate_parser.add_argument('--emails', required=True, help='JSONL file with emails')
+    evaluate_parser.add_argument('--max-thanks-words', type=int, default=3)
+    evaluate_parser.add_argument('--min-other-words', type=int, default=80)
+    evaluate_parser.add_argument('--threshold', type=float, default=.4)
+    args = parser.parse_args()
+
+    from email_io import load_emails
+    from encode_score2 import ThankYouScorer
+
+    report = evaluate(load_emails(args.emails), ThankYouPrefilter(args.max_thanks_words, args.min_other_words),
+                      ThankYouScorer(), args.threshold)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""Guarded execution of the cleaning regexes, against catastrophic backtracking.
+
+Patterns like r'On.*?wrote:[\\s\\S]*' or the nested quantifiers of the name regex can take minutes on adversarial or
+very long single-line emails. A RegexGuard runs the same patterns with a time budget per cleaning step, using the
+`regex` module (which can abort a match after a timeout, from any thread, unlike `re`), and with google-re2 (linear
+time, no backtracking at all) for the patterns it supports if asked to.
+
+When a step runs out of its budget, the guard falls back to skipping it (the step's input is passed on unchanged), to
+running it again on the start of the email only (the rest is passed on unchanged), or to rejecting the email with
+RegexBudgetExceeded. Content is never dropped. Every trip is counted per step, see stats().
+
+Turn it on for a process with email_cleaning.set_regex_guard(RegexGuard(...)), the API does by default.
+"""
+import re
+import threading
+import time
+from collections import Counter
+
+import regex
+
+import email_cleaning
+
+# Steps that run the single patterns of email_cleaning._PATTERNS
+PATTERN_STEPS = {
+    'names': 'remove_names',
+    'urls_complex': 'anonymize_urls',
+    'urls_simple': 'anonymize_urls',
+    'files': 'anonymize_files',
+}
+
+FALLBACKS = ['skip', 'truncate', 'reject']
+ENGINES = ['regex', 're2']
+
+
+class RegexBudgetExceeded(Exception):
+    """Raised by the 'reject' fallback when a step runs out of its budget"""
+
+    def __init__(self, step, budget_ms):
+        super().__init__('Cleaning step %s took more than %g ms' % (step, budget_ms))
+        self.step = step
+
+
+def _compile_regex(pattern):
+    # VERSION0 is regex's re-compatible mode
+    return regex.compile(pattern.pattern, pattern.flags | regex.VERSION0)
+
+
+def _compile_re2(pattern):
+    """pattern compiled with google-re2, or None when re2 doesn't support it (lookarounds, backreferences, ..)"""
+    import re2
+    inline_flags = ''.join(flag for value, flag in [(re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's')] if pattern.flags & value)
+    try:
+        return re2.compile(('(?%s)' % inline_flags if inline_flags else '') + pattern.pattern)
+    except Exception:
+        return None
+
+
+class RegexGuard:
+    """Runs the substitutions of the cleaning steps with a time budget per step
+
+    Args:
+        budget_ms (float, optional): Time one step may take on one email. Defaults to 250.
+        fallback (str, optional): One of ['skip', 'truncate', 'reject']. When a step runs out of time, 'skip' returns its
+            input, 'truncate' runs it again on the first truncate_chars characters and passes the rest on unchanged (and
+            skips it if that times out too), 'reject' raises RegexBudgetExceeded. Defaults to 'skip'.
+        truncate_chars (int, optional): Length of the start of the email the 'truncate' fallback cleans. Defaults to 10000.
+        engine (str, optional): One of ['regex', 're2']. 're2' runs every pattern google-re2 supports in linear time
+            (the others still go through regex with the budget). Careful, re2's \\w, \\s and \\b only know ASCII, so
+            results can differ from re on accented names. Defaults to 'regex'.
+    """
+
+    def __init__(self, budget_ms=250, fallback='skip', truncate_chars=10000, engine='regex'):
+        assert fallback in FALLBACKS, "fallback must be one of %s" % FALLBACKS
+        assert engine in ENGINES, "engine must be one of %s" % ENGINES
+        self.budget_ms = budget_ms
+        self.fallback = fallback
+        self.truncate_chars = truncate_chars
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._compile()
+        self.reset()
+
+    def _compile_pattern(self, pattern):
+        # (compiled pattern, whether it needs the timeout)
+        if self.engine == 're2':
+            linear = _compile_re2(pattern)
+            if linear is not None:
+                return linear, False
+        return _compile_regex(pattern), True
+
+    def _compile_step(self, substitutions):
+        return [(self._compile_pattern(pattern), replacement) for pattern, replacement in substitutions]
+
+    def _compile(self):
+        # every pattern of the cleaning steps. _sources keeps the lists they were compiled from, to notice the steps
+        # email_cleaning.set_terms replaced since
+        self._sources = dict(email_cleaning._SUBSTITUTIONS)
+        self.substitutions = dict((step, self._compile_step(substitutions)) for step, substitutions in self._sources.items())
+        self.patterns = dict((name, self._compile_pattern(email_cleaning._PATTERNS[name])) for name in PATTERN_STEPS)
+        compiled = [c for subs in self.substitutions.values() for c, _ in subs] + list(self.patterns.values())
+        self.linear_patterns = sum(1 for _, needs_timeout in compiled if not needs_timeout)
+        self.total_patterns = len(compiled)
+
+    def reset(self):
+        with self._lock:
+            self.calls = Counter()
+            self.trips = Counter()
+            self.truncated = Counter()
+            self.skipped = Counter()
+            self.rejected = Counter()
+
+    def _run(self, substitutions, email, replacement):
+        deadline = time.perf_counter() + self.budget_ms / 1000
+        for (pattern, needs_timeout), repl in substitutions:
+            repl = replacement if repl is None else repl
+            if needs_timeout:
+                # raises TimeoutError once the deadline of the step is over
+                email = pattern.sub(repl, email, timeout=max(deadline - time.perf_counter(), 0.0001))
+            else:
+                email = pattern.sub(repl, email)
+        return email
+
+    def _guarded(self, step, substitutions, email, replacement):
+        with self._lock:
+            self.calls[step] += 1
+        try:
+            return self._run(substitutions, email, replacement)
+        except TimeoutError:
+            with self._lock:
+                self.trips[step] += 1
+        if self.fallback == 'reject':
+            with self._lock:
+                self.rejected[step] += 1
+            raise RegexBudgetExceeded(step, self.budget_ms)
+        if self.fallback == 'truncate' and len(email) > self.truncate_chars:
+            try:
+                output = self._run(substitutions, email[:self.truncate_chars], replacement)
+                with self._lock:
+                    self.truncated[step] += 1
+                return output + email[self.truncate_chars:]
+            except TimeoutError:
+                pass
+        with self._lock:
+            self.skipped[step] += 1
+        return email
+
+    def apply(self, step, email, replacement=None):
+        """Guarded version of email_cleaning._apply_substitutions"""
+        substitutions = email_cleaning._SUBSTITUTIONS[step]
+        if substitutions is not self._sources.get(step):
+            # new terms (email_cleaning.set_terms), compiled before they're marked as the ones in use
+            self.substitutions[step] = self._compile_step(substitutions)
+            self._sources[step] = substitutions
+        return self._guarded(step, self.substitutions[step], email, replacement)
+
+    def sub(self, name, replacement, email):
+        """Guarded email_cleaning._PATTERNS[name].sub(replacement, email)"""
+        return self._guarded(PATTERN_STEPS[name], [(self.patterns[name], replacement)], email, replacement)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'engine': self.engine,
+                'budget_ms': self.budget_ms,
+                'fallback': self.fallback,
+                'linear_patterns': self.linear_patterns,
+                'total_patterns': self.total_patterns,
+                'calls': sum(self.calls.values()),
+                'trips': dict(self.trips),
+                'truncated': dict(self.truncated),
+                'skipped': dict(self.skipped),
+                'rejected': dict(self.rejected),
+            }
+
+    def __getstate__(self):
+        # only the configuration travels (e.g. to CleaningPool workers), patterns are compiled again on the other side
+        return {'budget_ms': self.budget_ms, 'fallback': self.fallback, 'truncate_chars': self.truncate_chars, 'engine': self.engine}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
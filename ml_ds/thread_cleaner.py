@@ -0,0 +1,198 @@
+import hashlib
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from email_cleaning import EmailCleaning
+
+# paragraphs are separated by blank lines (possibly with spaces or quote markers on them)
+_PARAGRAPH_BREAK = re.compile(r'\n[ \t>]*\n')
+_QUOTE_PREFIX = re.compile(r'^[ \t>]+', re.MULTILINE)
+_WHITESPACE = re.compile(r'\s+')
+# rough size of one fingerprint or cleaned-form entry (key, OrderedDict slot), besides the cleaned text itself
+_ENTRY_BYTES = 150
+
+
+def paragraph_fingerprint(paragraph):
+    """Hash of a paragraph that ignores '>' quoting and whitespace, so a paragraph and its quoted copy in a reply match"""
+    normalized = _WHITESPACE.sub(' ', _QUOTE_PREFIX.sub('', paragraph)).strip()
+    return hashlib.sha1(normalized.encode('utf-8', 'surrogatepass')).digest()[:12]
+
+
+def _entry_size(value):
+    # value of a fingerprint (None) or of a cleaned form (length of the new part, cleaned text)
+    return _ENTRY_BYTES + (sys.getsizeof(value[1]) if value is not None else 0)
+
+
+class _ThreadState:
+    __slots__ = ['paragraphs', 'cleaned', 'last_seen', 'size']
+
+    def __init__(self):
+        # fingerprints of every paragraph seen in the thread so far, in LRU order
+        self.paragraphs = OrderedDict()
+        # hash of a whole message -> (length of its new part, cleaned form)
+        self.cleaned = OrderedDict()
+        self.last_seen = time.time()
+        # approximate bytes held by the two dicts
+        self.size = 0
+
+
+class ThreadCleaner:
+    """Thread-aware cleaning: every reply repeats the quoted history of its conversation, so only the part of a message
+    that was not seen in earlier messages of the same conversation goes through the cleaning.
+
+    The quoted history is the trailing run of paragraphs that were all seen before (in any earlier message of the
+    conversation, quoted with '>' or not). What is above it, the reply and its "On ... wrote:" header, is cleaned as
+    usual. A message scored again (same text) gets its cleaned form back without cleaning it again.
+
+    State is bounded: at most max_threads conversations and about max_bytes in all (least recently used conversations are
+    evicted first, and conversations idle for longer than ttl), and at most max_paragraphs fingerprints and max_messages
+    cleaned forms per conversation.
+
+    Args:
+        clean_fun (callable, optional): Cleaning of the new part of a message. Defaults to EmailCleaning.full_clean.
+        max_threads (int, optional): Defaults to 10000.
+        max_bytes (int, optional): Approximate memory the state may take, cleaned texts included. Defaults to 64 MB.
+        max_paragraphs (int, optional): Paragraph fingerprints kept per conversation. Defaults to 2000.
+        max_messages (int, optional): Cleaned forms kept per conversation. Defaults to 50.
+        ttl (float, optional): Seconds of inactivity after which a conversation is forgotten. None means never. Defaults to 7 days.
+    """
+
+    def __init__(self, clean_fun=EmailCleaning.full_clean, max_threads=10000, max_bytes=64 * 2 ** 20, max_paragraphs=2000,
+                 max_messages=50, ttl=7 * 24 * 3600):
+        self.clean_fun = clean_fun
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.max_paragraphs = max_paragraphs
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self._threads = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.messages = 0
+        self.message_hits = 0
+        self.chars_in = 0
+        self.chars_skipped = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _state(self, conversation_id):
+        now = time.time()
+        state = self._threads.get(conversation_id)
+        if state is not None and self.ttl is not None and now - state.last_seen > self.ttl:
+            self._drop(conversation_id)
+            self.expirations += 1
+            state = None
+        if state is None:
+            state = self._threads[conversation_id] = _ThreadState()
+            while len(self._threads) > self.max_threads:
+                self._drop(next(iter(self._threads)))
+                self.evictions += 1
+        self._threads.move_to_end(conversation_id)
+        state.last_seen = now
+        return state
+
+    def _drop(self, conversation_id):
+        self._bytes -= self._threads.pop(conversation_id).size
+
+    def _resize(self, state, size):
+        state.size += size
+        self._bytes += size
+
+    def _remember(self, state, entries, key, value, max_entries):
+        if key in entries:
+            self._resize(state, -_entry_size(entries[key]))
+        entries[key] = value
+        entries.move_to_end(key)
+        self._resize(state, _entry_size(value))
+        while len(entries) > max_entries:
+            self._resize(state, -_entry_size(entries.popitem(last=False)[1]))
+
+    def split(self, conversation_id, email):
+        """Splits email into (new part, fingerprints of all its paragraphs) against what was seen in the conversation
+        so far, without recording anything. A message with nothing new (resent, forwarded or a CC copy differing in
+        whitespace only) is its own new part"""
+        breaks = list(_PARAGRAPH_BREAK.finditer(email))
+        starts = [0] + [b.end() for b in breaks]
+        ends = [b.start() for b in breaks] + [len(email)]
+        fingerprints = [paragraph_fingerprint(email[start:end]) for start, end in zip(starts, ends)]
+        with self._lock:
+            state = self._threads.get(conversation_id)
+            seen = state.paragraphs if state is not None else {}
+            new = len(fingerprints)
+            while new > 0 and fingerprints[new - 1] in seen:
+                new -= 1
+        if new == 0:
+            # cleaning '' would score an empty email, the whole message is cleaned instead, as full_clean would
+            return email, fingerprints
+        # the new part ends with its last paragraph, the break in front of the quoted history is dropped
+        return email[:ends[new - 1]], fingerprints
+
+    def clean(self, conversation_id, email):
+        """Cleaned form of the new part of email (the whole email the first time a conversation is seen)
+
+        Args:
+            conversation_id (hashable): Identifier of the conversation the message belongs to
+            email (Str): Raw message, usually with the quoted history of the conversation below the reply
+
+        Returns:
+            email (Str): Cleaned up new part of the message
+        """
+        return self.clean_new_part(conversation_id, email)[1]
+
+    def clean_new_part(self, conversation_id, email):
+        """Same as clean, but returns (new part, cleaned new part), for checks that look at the raw new text
+
+        Args:
+            conversation_id (hashable): Identifier of the conversation the message belongs to
+            email (Str): Raw message, usually with the quoted history of the conversation below the reply
+        """
+        message_key = hashlib.sha1(email.encode('utf-8', 'surrogatepass')).digest()[:12]
+        with self._lock:
+            state = self._state(conversation_id)
+            cached = state.cleaned.get(message_key)
+            self.messages += 1
+            self.chars_in += len(email)
+            if cached is not None:
+                self.message_hits += 1
+                self.chars_skipped += len(email)
+                state.cleaned.move_to_end(message_key)
+                new_length, cleaned = cached
+                return email[:new_length], cleaned
+        new_part, fingerprints = self.split(conversation_id, email)
+        cleaned = self.clean_fun(new_part)
+        with self._lock:
+            self.chars_skipped += len(email) - len(new_part)
+            state = self._state(conversation_id)
+            # the new part is a prefix of the message, its length is enough to cut it again
+            self._remember(state, state.cleaned, message_key, (len(new_part), cleaned), self.max_messages)
+            # the whole message is recorded, so the next reply's quote of it (history included) is recognized
+            for fingerprint in fingerprints:
+                self._remember(state, state.paragraphs, fingerprint, None, self.max_paragraphs)
+            # least recently used conversations go first, never the one just updated
+            while self._bytes > self.max_bytes and len(self._threads) > 1:
+                self._drop(next(iter(self._threads)))
+                self.evictions += 1
+        return new_part, cleaned
+
+    def forget(self, conversation_id):
+        with self._lock:
+            if conversation_id in self._threads:
+                self._drop(conversation_id)
+
+    def __len__(self):
+        return len(self._threads)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'threads': len(self._threads),
+                'bytes': self._bytes,
+                'messages': self.messages,
+                'message_hits': self.message_hits,
+                'skipped_char_ratio': self.chars_skipped / self.chars_in if self.chars_in else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
@@ -0,0 +1,160 @@
+"""Generator of synthetic (but realistic looking) email threads, for benchmarks and differential checks of the cleaning.
+
+Threads have the newest message on top and the quoted history below, with "On ... wrote:", Outlook and Lotus Notes
+headers, Lotus Notes addresses, signatures with phone numbers, URLs, attachments and '>' quoting.
+
+Usage (from ml_ds/):
+    python thread_generator.py --count 1000 --messages 1 10 --paragraphs 1 5 --seed 0 > threads.jsonl
+"""
+import argparse
+import json
+import random
+
+FIRST_NAMES = ['John', 'Anna', 'Peter', 'Maria', 'Wouter', 'Sofia', 'Luca', 'Priya', 'Kenji', 'Fatima', 'Olivier', 'Ingrid']
+LAST_NAMES = ['Smith', 'Lee', 'Brown', 'von Trapp', 'van Dijk', 'Rossi', 'Sharma', 'Tanaka', 'Haddad', 'Dubois', 'Larsen']
+OFFICES = ['NYC', 'LON', 'MUC', 'SGP', 'PAR', 'TOR']
+TITLES = ['Engagement Manager', 'Associate', 'Senior Partner', 'Executive Assistant', 'Business Analyst']
+DOMAINS = ['example.com', 'client-corp.com', 'mckinsey.com', 'gmail.com', 'yahoo.com']
+GREETINGS = ['Hi {first},', 'Dear {first},', 'Hello all,', 'Hi team,', 'hey', 'Folks,', 'Good morning {first},']
+SIGN_OFFS = ['Best regards,', 'Kind regards', 'Thanks,', 'Cheers', 'Many thanks,', 'Regards,', 'Sincerely,', 'Warm regards,']
+THANK_YOUS = ['Thanks!', 'Thank you so much!', 'Many thanks, much appreciated.', 'Great, thanks a lot!', 'thx',
+              'Thank you for the quick turnaround.', 'Perfect, thank you!']
+WORDS = ('the report is ready please review attached deck before friday meeting we need numbers from finance team and '
+         'update model assumptions for quick turnaround on this workstream client steering committee agenda budget '
+         'timeline slides data analysis interviews synthesis draft final version call tomorrow morning could you '
+         'share latest estimates market sizing revenue growth margin benchmark').split()
+EXTENSIONS = ['pptx', 'xlsx', 'pdf', 'docx', 'zip', 'txt']
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def _person(rng):
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    address = '%s.%s@%s' % (first.lower(), last.lower().replace(' ', ''), rng.choice(DOMAINS))
+    return first, last, address
+
+
+def _sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(5, 20))]
+    sentence = ' '.join(words).capitalize() + rng.choice(['.', '.', '.', '?', '!'])
+    extra = rng.random()
+    if extra < .08:
+        sentence += ' See https://www.%s/%s?id=%d' % (rng.choice(DOMAINS), rng.choice(WORDS), rng.randint(1, 999))
+    elif extra < .14:
+        sentence += ' I attached %s_v%d.%s.' % (rng.choice(WORDS), rng.randint(1, 9), rng.choice(EXTENSIONS))
+    elif extra < .18:
+        sentence += ' Ping %s if needed.' % _person(rng)[2]
+    return sentence
+
+
+def _paragraph(rng):
+    if rng.random() < .1:
+        # bullet list, one item per line
+        return '\n'.join('- ' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 8))) for _ in range(rng.randint(2, 5)))
+    return ' '.join(_sentence(rng) for _ in range(rng.randint(1, 5)))
+
+
+def _signature(rng, first, last, address):
+    lines = [rng.choice(SIGN_OFFS), '%s %s' % (first, last)]
+    if rng.random() < .6:
+        lines.append(rng.choice(TITLES))
+    if rng.random() < .5:
+        lines.append('+%d %d %d %04d | %s' % (rng.randint(1, 49), rng.randint(100, 999), rng.randint(100, 999),
+                                              rng.randint(0, 9999), address))
+    return '\n'.join(lines)
+
+
+def _date(rng):
+    return '%s, %s %d, 20%02d at %d:%02d %s' % (rng.choice(DAYS), rng.choice(MONTHS), rng.randint(1, 28), rng.randint(15, 24),
+                                               rng.randint(1, 12), rng.randint(0, 59), rng.choice(['AM', 'PM']))
+
+
+def _reply_header(rng, first, last, address):
+    style = rng.random()
+    if style < .4:
+        return 'On %s %s %s <%s> wrote:' % (_date(rng), first, last, address)
+    if style < .75:
+        recipient = _person(rng)
+        return 'From: %s %s <%s>\nSent: %s\nTo: %s %s <%s>\nSubject: Re: %s' % (
+            first, last, address, _date(rng), recipient[0], recipient[1], recipient[2], ' '.join(rng.choice(WORDS) for _ in range(3)))
+    office = rng.choice(OFFICES)
+    return '----- Forwarded by %s %s/%s/McKinsey on %02d/%02d/20%02d %02d:%02d %s -----\n%s %s/%s/McKinsey@McKinsey' % (
+        first, last, office, rng.randint(1, 12), rng.randint(1, 28), rng.randint(15, 24), rng.randint(1, 12),
+        rng.randint(0, 59), rng.choice(['AM', 'PM']), first, last, office)
+
+
+def generate_message(rng, paragraphs=(1, 5), thank_you=None):
+    """One email body: greeting, paragraphs (or a short thank-you note) and a signature
+
+    Args:
+        rng (random.Random): Source of randomness
+        paragraphs (tuple of int, optional): Min and max number of paragraphs. Defaults to (1, 5).
+        thank_you (bool, optional): Force a short thank-you note (True) or a business email (False). Defaults to random.
+    """
+    first, last, address = _person(rng)
+    if thank_you is None:
+        thank_you = rng.random() < .2
+    parts = []
+    if rng.random() < .7:
+        parts.append(rng.choice(GREETINGS).format(first=rng.choice(FIRST_NAMES)))
+    if thank_you:
+        parts.append(rng.choice(THANK_YOUS))
+    else:
+        parts.extend(_paragraph(rng) for _ in range(rng.randint(*paragraphs)))
+    if rng.random() < .8:
+        parts.append(_signature(rng, first, last, address))
+    return rng.choice(['\n\n', '\n\n', '\n \n', '\n\n\n']).join(parts), (first, last, address)
+
+
+def generate_conversation(rng, messages=(1, 10), paragraphs=(1, 5)):
+    """The messages of one conversation in order, each with the earlier ones quoted below its reply header (the last
+    one is generate_thread's thread)
+
+    Args:
+        rng (random.Random): Source of randomness
+        messages (tuple of int, optional): Min and max number of messages in the thread. Defaults to (1, 10).
+        paragraphs (tuple of int, optional): Min and max number of paragraphs per message. Defaults to (1, 5).
+    """
+    conversation = []
+    thread = ''
+    for i in range(rng.randint(*messages)):
+        body, sender = generate_message(rng, paragraphs)
+        if thread:
+            quoted = thread
+            if rng.random() < .3:
+                quoted = '\n'.join('> ' + line for line in thread.split('\n'))
+            body = body + '\n\n' + _reply_header(rng, *previous_sender) + '\n\n' + quoted
+        thread, previous_sender = body, sender
+        conversation.append(thread)
+    return conversation
+
+
+def generate_thread(rng, messages=(1, 10), paragraphs=(1, 5)):
+    """A thread as seen in the newest message: new text on top, every earlier message quoted below its reply header
+
+    Args:
+        rng (random.Random): Source of randomness
+        messages (tuple of int, optional): Min and max number of messages in the thread. Defaults to (1, 10).
+        paragraphs (tuple of int, optional): Min and max number of paragraphs per message. Defaults to (1, 5).
+    """
+    return generate_conversation(rng, messages, paragraphs)[-1]
+
+
+def generate_corpus(count, messages=(1, 10), paragraphs=(1, 5), seed=0):
+    rng = random.Random(seed)
+    return [generate_thread(rng, messages, paragraphs) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--messages', type=int, nargs=2, default=[1, 10], metavar=('MIN', 'MAX'))
+    parser.add_argument('--paragraphs', type=int, nargs=2, default=[1, 5], metavar=('MIN', 'MAX'))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for thread in generate_corpus(args.count, tuple(args.messages), tuple(args.paragraphs), args.seed):
+        print(json.dumps({'email': thread}))
+
+
+if __name__ == '__main__':
+    main()
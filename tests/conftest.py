@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the ml_ds modules import each other by name, like in api/api.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml_ds'))
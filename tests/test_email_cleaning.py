@@ -0,0 +1,121 @@
+"""Cleaning outputs compared with fixed expected outputs.
+
+cleaning_expected.json holds the outputs of the cleaning steps before they were sped up (one regex substitution after
+another, the quadratic remove_dups, ..) on a few sample emails, so any change of the output shows up here.
+"""
+import json
+import os
+import re
+
+import pytest
+
+from cleaning_terms import phrase_pattern
+from email_cleaning import EmailCleaning
+from paragraph_index import ParagraphIndex
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cleaning_expected.json'), encoding='utf-8') as f:
+    EXPECTED = json.load(f)
+
+EMAIL_BREAK = '\n\n==============+++EMAIL_BREAK+++==============\n\n'
+
+
+@pytest.mark.parametrize('step, kwargs, expected', EXPECTED['steps'], ids=[step for step, _, _ in EXPECTED['steps']])
+def test_steps(step, kwargs, expected):
+    assert [getattr(EmailCleaning, step)(email, **kwargs) for email in EXPECTED['samples']] == expected
+
+
+@pytest.mark.parametrize('email, strict, non_strict', EXPECTED['normalize_whitespace'])
+def test_normalize_whitespace(email, strict, non_strict):
+    assert EmailCleaning.normalize_whitespace(email) == strict
+    assert EmailCleaning.normalize_whitespace(email, strict=False) == non_strict
+
+
+@pytest.mark.parametrize('email, expected', [
+    ('best mckinsey company regards', ' '),
+    ('best pacific time regards', 'best   regards'),
+    ('Sent from my  iphone', 'Sent from my  iphone'),
+    ('thank\n you', ' '),
+    ('kind  regards, see you', ' , see you'),
+    ('Thank you in December', '  in December'),
+])
+def test_clean_fixed_terms(email, expected):
+    assert EmailCleaning.clean_fixed_terms(email) == expected
+
+
+def test_paragraph_index():
+    index = ParagraphIndex(['thanks for the deck, see you tomorrow', 'the numbers look good'])
+    assert len(index) == 2
+    assert index.contains('the deck')
+    assert 'numbers look' in index
+    assert index.contains('thanks for the deck, see you tomorrow')
+    assert not index.contains('deck, see you today')
+    # no match across two paragraphs
+    assert not index.contains('tomorrowthe numbers')
+    index.add('the numbers look good')
+    assert len(index) == 2
+    assert len(ParagraphIndex()) == 0
+    assert not ParagraphIndex().contains('the deck')
+
+
+@pytest.mark.parametrize('parags, expected', [
+    (['thanks for the numbers, they look good to me', 'they look good', 'short one',
+      'thanks for the numbers, they look good to me and to Anna'],
+     ['thanks for the numbers, they look good to me', 'thanks for the numbers, they look good to me and to Anna']),
+    (['first paragraph is here and long enough to keep', EMAIL_BREAK, 'first paragraph is here and long enough',
+      EMAIL_BREAK, 'a brand new paragraph that is long enough'],
+     ['first paragraph is here and long enough to keep', EMAIL_BREAK, EMAIL_BREAK,
+      'a brand new paragraph that is long enough']),
+    (['tiny', 'also tiny', 'and a third paragraph, long enough to stay'],
+     ['tiny', 'and a third paragraph, long enough to stay']),
+    (['Von meinem iPhone gesendet und so weiter und so fort', 'iPhone gesendet und so weiter und so fort!'],
+     ['Von meinem iPhone gesendet und so weiter und so fort', 'iPhone gesendet und so weiter und so fort!']),
+    ([], []),
+])
+def test_remove_dups(parags, expected):
+    assert EmailCleaning.remove_dups(parags) == expected
+
+
+@pytest.mark.parametrize('thread, expected', [
+    ('Thanks, the numbers look good to me.\n\nOn Monday Anna wrote:\n\nHere are the numbers for the steering '
+     'committee.\n\n' + EMAIL_BREAK + 'Here are the numbers for the steering committee.\n\nBest, Anna',
+     'Thanks, the numbers look good to me.\n\nHere are the numbers for the steering committee.'),
+    ('one\n\n\n\ntwo paragraphs that are long enough to count\n\ntwo paragraphs that are long enough to count',
+     'one\n\ntwo paragraphs that are long enough to count'),
+    ('', ''),
+])
+def test_remove_repeating_parags(thread, expected):
+    assert EmailCleaning.remove_repeating_parags(thread) == expected
+
+
+PHRASES = ['thank you', 'thanks', 'thank you so much', 'best regards', 'best', 'Kind Regards', 'a.b (c)']
+TEXTS = ['Thank you so much, best regards', 'THANKS and best wishes', 'kind  regards', 'kind regards', 'a.b (c) axb (c)',
+         'thank\nyou', 'nothing here', '']
+
+
+@pytest.mark.parametrize('space', [' ', r'\s+'])
+def test_phrase_pattern_matches_like_alternation(space):
+    pattern = re.compile(phrase_pattern(PHRASES, space))
+    alternation = re.compile('(?i:%s)' % '|'.join(re.escape(phrase).replace(r'\ ', space) for phrase in PHRASES))
+    for text in TEXTS:
+        assert [m.span() for m in pattern.finditer(text)] == [m.span() for m in alternation.finditer(text)]
+
+
+def test_phrase_pattern_priority():
+    # the first phrase that matches wins, like in an alternation
+    assert re.match(phrase_pattern(['thank you', 'thank you so much']), 'thank you so much').group() == 'thank you'
+    assert re.match(phrase_pattern(['thank you so much', 'thank you']), 'thank you so much').group() == 'thank you so much'
+
+
+def test_phrase_pattern_literal_phrases():
+    pattern = re.compile(phrase_pattern(['sent from my iphone', 'best regards'], r'\s+', ['sent from my iphone']))
+    assert pattern.search('Sent from my iPhone')
+    assert not pattern.search('sent from my  iphone')
+    assert pattern.search('best \n regards')
+
+
+def test_phrase_pattern_edge_cases():
+    assert phrase_pattern([]) == '(?!)'
+    assert not re.search(phrase_pattern([]), 'anything')
+    # phrases starting with a space can't be led by a class of first characters
+    pattern = re.compile(phrase_pattern([' regards', 'cheers']))
+    assert [m.group() for m in pattern.finditer('kind regards and cheers')] == [' regards', 'cheers']